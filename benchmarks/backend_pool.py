@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Пул локальных llama-server на поддельных бэкендах.
+
+Три поддельных llama-server (FastAPI в том же процессе) отвечают на
+/v1/chat/completions и /health и запоминают, какие разговоры к ним пришли.
+Проверяется, что:
+
+- новые разговоры распределяются по всем бэкендам, а следующие ходы
+  разговора идут на тот же бэкенд;
+- остановленный бэкенд выводится из пула, его разговоры переезжают на
+  оставшиеся, и клиенты не получают ошибок;
+- поднятый снова бэкенд возвращается в пул по проверке /health и получает
+  новые разговоры.
+
+Запуск из корня проекта: python benchmarks/backend_pool.py
+"""
+
+import asyncio
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+from mock_upstream import completion, proxy_client, server
+from config import config as Config
+from providers.local import LocalProvider
+
+BACKENDS = 3
+CONVERSATIONS = 12
+PROBE_INTERVAL = 0.2
+MODEL = "devstral2-small"
+
+
+class MockLlamaServer:
+    """Поддельный llama-server: запоминает разговоры, которые к нему пришли"""
+
+    def __init__(self, name):
+        self.name = name
+        self.conversations = []
+        self.port = 0
+        self._server = None
+        self._task = None
+        self.app = FastAPI()
+        self.app.get("/health")(self.health)
+        self.app.post("/v1/chat/completions")(self.chat)
+
+    async def health(self):
+        return {"status": "ok"}
+
+    async def chat(self, request: Request):
+        body = await request.json()
+        self.conversations.append(body["messages"][1]["content"])
+        await asyncio.sleep(0.05)  # Чтобы одновременные запросы были видны как занятость бэкенда
+        response = completion(MODEL, f"answer from {self.name}")
+        return response.json()
+
+    async def start(self):
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="error"))
+        self._task = asyncio.create_task(self._server.serve())
+        while not self._server.started:
+            await asyncio.sleep(0.01)
+        self.port = self._server.servers[0].sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.should_exit = True
+        await self._task
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+
+def conversation(index, turn):
+    messages = [{"role": "system", "content": "You are a coding agent."},
+                {"role": "user", "content": f"conversation {index}"}]
+    for step in range(turn):
+        messages += [{"role": "assistant", "content": f"step {step} done"},
+                     {"role": "user", "content": f"continue {step}"}]
+    return {"model": MODEL, "temperature": 0.7, "messages": messages}
+
+
+async def run_turn(client, turn, conversations=range(CONVERSATIONS)):
+    responses = await asyncio.gather(*[
+        client.post("/v1/chat/completions", json=conversation(index, turn)) for index in conversations
+    ])
+    assert all(response.status_code == 200 for response in responses), [r.text for r in responses if r.status_code != 200]
+
+
+def placement(backends):
+    """Разговор -> бэкенд, на который ушли его запросы с прошлого сброса"""
+    owners = {}
+    for backend in backends:
+        for name in backend.conversations:
+            owners.setdefault(name, set()).add(backend.name)
+        backend.conversations.clear()
+    return owners
+
+
+async def main():
+    server.response_cache.enabled = False
+    server.single_flight.enabled = False
+    backends = [MockLlamaServer(f"llama-{index}") for index in range(BACKENDS)]
+    for backend in backends:
+        await backend.start()
+
+    local_config = Config.get_provider_config("local")
+    local_config["backends"] = [backend.url for backend in backends]
+    local_config["backend_pool"] = {"probe_interval": PROBE_INTERVAL, "probe_timeout": 0.5}
+    provider = LocalProvider()
+    server.settings_snapshot.providers["local"] = provider
+    pool = provider.pool
+
+    try:
+        async with proxy_client() as client:
+            # Распределение и привязка разговоров
+            await run_turn(client, 0)
+            await run_turn(client, 1)
+            owners = placement(backends)
+            load = Counter(next(iter(names)) for names in owners.values())
+            assert all(len(names) == 1 for names in owners.values()), owners
+            assert len(load) == BACKENDS and max(load.values()) - min(load.values()) <= 1, load
+            print(f"spread: {dict(sorted(load.items()))}, every conversation stayed on one backend")
+
+            # Бэкенд упал: его разговоры переезжают, клиенты ошибок не видят
+            down = backends[0]
+            moved = [name for name, names in owners.items() if down.name in names]
+            await down.stop()
+            await run_turn(client, 2)
+            owners = placement(backends)
+            assert not pool.backends[0].healthy, pool.stats()
+            assert all(down.name not in names for names in owners.values()), owners
+            print(f"ejected {down.name}: {len(moved)} conversations moved, "
+                  f"last error: {pool.backends[0].last_error}")
+
+            # Бэкенд поднялся: проверка /health возвращает его, новые разговоры идут на него
+            await down.start()
+            for _ in range(50):
+                if pool.backends[0].healthy:
+                    break
+                await asyncio.sleep(PROBE_INTERVAL / 2)
+            assert pool.backends[0].healthy, pool.stats()
+            await run_turn(client, 0, conversations=range(CONVERSATIONS, 2 * CONVERSATIONS))
+            owners = placement(backends)
+            load = Counter(next(iter(names)) for names in owners.values())
+            assert load[down.name] > 0, load
+            print(f"restored {down.name}: new conversations {dict(sorted(load.items()))}")
+            print(f"pool: affinity_hits={pool.affinity_hits} misses={pool.affinity_misses} rebalanced={pool.rebalanced}")
+    finally:
+        await provider.aclose()
+        for backend in backends:
+            if backend._server.started and not backend._server.should_exit:
+                await backend.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""
+Общие части сценариев с поддельным upstream.
+
+Провайдеру из текущего снимка настроек подставляется AsyncOpenAI клиент
+на httpx.MockTransport: запросы проходят через весь сервер (маршрутизация,
+лимиты, SSE ретрансляция), но вместо сети отвечает handler сценария.
+"""
+
+import json
+import os
+import sys
+
+import httpx
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def use_mock_upstream(provider_name, handler):
+    """Направить все клиенты провайдера в handler(request) -> httpx.Response"""
+    return use_upstream(provider_name, httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+def use_upstream(provider_name, http_client, base_url=None, timeout=None):
+    """Подменить клиенты провайдера клиентом на http_client (и base_url, если задан)"""
+    provider = server.settings_snapshot.providers[provider_name]
+    client = AsyncOpenAI(
+        api_key="test",
+        base_url=base_url or provider.base_url,
+        http_client=http_client,
+        timeout=timeout if timeout is not None else http_client.timeout,
+        max_retries=0,
+    )
+    for url in [provider.base_url, *provider.clients]:
+        provider.clients[url] = client
+    return provider
+
+
+def proxy_client(timeout=30):
+    """Клиент к приложению сервера без сети"""
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://proxy", timeout=timeout)
+
+
+def completion(model, content):
+    return httpx.Response(200, json={
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": 1,
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+    })
+
+
+def sse_frame(content):
+    chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": 1, "model": "mock",
+             "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+    return f"data: {json.dumps(chunk)}\n\n".encode()
+
+
+def stream_text(body):
+    """Склеить content из SSE ответа прокси"""
+    parts = []
+    for line in body.splitlines():
+        if line.startswith("data: ") and line != "data: [DONE]":
+            for choice in json.loads(line[6:]).get("choices", []):
+                parts.append(choice.get("delta", {}).get("content") or "")
+    return "".join(parts)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Объединение одинаковых запросов (single_flight) на поддельном upstream.
+
+N одновременных одинаковых запросов с temperature=0 отправляются в прокси
+волнами: обычный ответ, стрим и ошибка upstream (для обычного ответа
+и для стрима). Проверяется, что
+upstream получил ровно один вызов на каждую волну, все клиенты получили
+одинаковое тело, а ошибка лидера дошла до всех подписчиков. В конце ни
+одного вызова не должно остаться в single_flight.
+
+Запуск из корня проекта: python benchmarks/single_flight.py
+"""
+
+import asyncio
+
+import httpx
+
+from mock_upstream import completion, proxy_client, server, sse_frame, stream_text, use_mock_upstream
+
+CLIENTS = 20
+MODEL = "devstral2-small"
+UPSTREAM_DELAY = 0.3
+
+
+class Upstream:
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    async def __call__(self, request):
+        self.calls += 1
+        await asyncio.sleep(UPSTREAM_DELAY)  # Все клиенты успевают прийти, пока лидер ждет ответ
+        if self.fail:
+            return httpx.Response(400, json={"error": {"message": "mock upstream rejected the request"}})
+        if b'"stream":true' in request.content.replace(b" ", b""):
+            async def frames():
+                for word in ("one ", "two ", "three"):
+                    yield sse_frame(word)
+                    await asyncio.sleep(0.02)
+                yield b"data: [DONE]\n\n"
+            return httpx.Response(200, content=frames(), headers={"content-type": "text/event-stream"})
+        return completion(MODEL, "shared answer")
+
+
+async def wave(client, upstream, stream, prompt):
+    upstream.calls = 0
+    body = {"model": MODEL, "temperature": 0, "stream": stream, "messages": [{"role": "user", "content": prompt}]}
+    return await asyncio.gather(*[client.post("/v1/chat/completions", json=body) for _ in range(CLIENTS)])
+
+
+async def main():
+    server.response_cache.enabled = False  # Иначе повторы отвечает кэш, а не single_flight
+    upstream = Upstream()
+    use_mock_upstream("local", upstream)
+
+    async with proxy_client() as client:
+        responses = await wave(client, upstream, False, "plain")
+        contents = {r.json()["choices"][0]["message"]["content"] for r in responses}
+        assert upstream.calls == 1, upstream.calls
+        assert {r.status_code for r in responses} == {200} and contents == {"shared answer"}, contents
+        print(f"plain:  {CLIENTS} clients, {upstream.calls} upstream call, bodies: {contents}")
+
+        responses = await wave(client, upstream, True, "stream")
+        texts = {stream_text(r.text) for r in responses}
+        assert upstream.calls == 1, upstream.calls
+        assert {r.status_code for r in responses} == {200} and texts == {"one two three"}, texts
+        print(f"stream: {CLIENTS} clients, {upstream.calls} upstream call, bodies: {texts}")
+
+        # Ошибка до начала стрима тоже должна завершить подписчиков, а не оставить их ждать
+        upstream.fail = True
+        for stream in (False, True):
+            responses = await asyncio.wait_for(wave(client, upstream, stream, "error"), timeout=10)
+            statuses = {r.status_code for r in responses}
+            assert upstream.calls == 1, upstream.calls
+            assert 200 not in statuses, statuses
+            print(f"error (stream={stream}): {CLIENTS} clients, {upstream.calls} upstream call, "
+                  f"statuses: {sorted(statuses)}")
+
+    stats = server.single_flight.stats()
+    assert stats["in_flight"] == 0 and stats["streams"] == 0, stats
+    print(f"single_flight: leaders={stats['leaders']} coalesced={stats['coalesced']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Освобождение ресурсов, когда стрим обрывается посередине.
+
+Прокси запускается в uvicorn, upstream - простой TCP сервер, который
+отвечает SSE кадрами и запоминает, когда прокси закрыл соединение с ним.
+Три сценария:
+
+- upstream прислал первый кадр и замолчал: стрим должен оборваться по
+  таймауту чтения (http.timeouts.read), соединение с upstream закрыться,
+  а слот провайдера и счетчик in_flight освободиться;
+- клиент ушел посреди медленного стрима: прокси должен закрыть соединение
+  с upstream за ограниченное время, чтобы llama-server освободил слот;
+- клиент ушел, пока upstream еще не прислал заголовки: starlette не
+  начинает отдавать ответ, но соединение с upstream, слот, in_flight и
+  удержание HTTP пула все равно должны освободиться.
+
+Запуск из корня проекта: python benchmarks/stream_idle_timeout.py
+"""
+
+import asyncio
+import time
+
+import httpx
+import uvicorn
+
+from mock_upstream import server, sse_frame, use_upstream
+from utils.concurrency import ConcurrencyLimiter
+
+IDLE_TIMEOUT = 0.5  # Таймаут чтения upstream в сценарии
+HEADER_DELAY = 0.4  # Пауза upstream перед заголовками (меньше таймаута чтения, без повторов)
+CLOSE_BOUND = 1.0   # За сколько секунд после обрыва соединение с upstream должно закрыться
+MODEL = "devstral2-small"
+
+
+class StallingUpstream:
+    """HTTP сервер upstream: через header_delay отвечает, отдает frames кадров с паузой interval, затем молчит"""
+
+    def __init__(self):
+        self.frames = 0
+        self.interval = 0.0
+        self.header_delay = 0.0
+        self.responded_at = None
+        self.closed_at = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        self.closed_at = None
+        headers = await reader.readuntil(b"\r\n\r\n")
+        length = next((int(line.split(b":")[1]) for line in headers.split(b"\r\n")
+                       if line.lower().startswith(b"content-length:")), 0)
+        await reader.readexactly(length)
+        await asyncio.sleep(self.header_delay)
+        self.responded_at = time.monotonic()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        try:
+            sent = 0
+            while True:
+                if sent < self.frames:
+                    frame = sse_frame(f"word{sent} ")
+                    writer.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                    await writer.drain()
+                    sent += 1
+                # Закрытие соединения прокси видно как EOF при чтении
+                try:
+                    if await asyncio.wait_for(reader.read(1), self.interval or 0.05) == b"":
+                        break
+                except asyncio.TimeoutError:
+                    pass
+        except ConnectionError:
+            pass
+        self.closed_at = time.monotonic()
+        writer.close()
+
+    async def wait_closed(self, since):
+        while self.closed_at is None and time.monotonic() - since < 10:
+            await asyncio.sleep(0.01)
+        return self.closed_at - since if self.closed_at is not None else None
+
+    def close(self):
+        self._server.close()
+
+
+def request_body():
+    return {"model": MODEL, "stream": True, "messages": [{"role": "user", "content": "write a long story"}]}
+
+
+async def check_idle_timeout(proxy_url, upstream, limiter):
+    upstream.frames, upstream.interval = 1, 0.0
+    frames = 0
+    async with httpx.AsyncClient(timeout=10) as client:
+        async with client.stream("POST", f"{proxy_url}/v1/chat/completions", json=request_body()) as response:
+            try:
+                async for line in response.aiter_lines():
+                    if line.startswith("data: "):
+                        frames += 1
+                        cut_from = time.monotonic()
+            except httpx.HTTPError:
+                pass  # Прокси оборвал стрим
+    closed_after = await upstream.wait_closed(cut_from)
+    await asyncio.sleep(0.05)
+    assert closed_after is not None and closed_after < IDLE_TIMEOUT + CLOSE_BOUND, closed_after
+    assert limiter.active == 0, limiter.stats()
+    assert server.metrics.in_flight("local") == 0
+    print(f"stalled upstream: {frames} frame(s), upstream closed {closed_after:.2f}s after the last frame "
+          f"(read timeout {IDLE_TIMEOUT}s), slot active={limiter.active}, in_flight={server.metrics.in_flight('local')}")
+
+
+async def check_client_disconnect(proxy_url, upstream, limiter):
+    upstream.frames, upstream.interval = 1000, 0.1
+    async with httpx.AsyncClient(timeout=10) as client:
+        async with client.stream("POST", f"{proxy_url}/v1/chat/completions", json=request_body()) as response:
+            frames = 0
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    frames += 1
+                    if frames == 3:
+                        break
+        left_at = time.monotonic()
+    closed_after = await upstream.wait_closed(left_at)
+    await asyncio.sleep(0.05)
+    assert closed_after is not None and closed_after < CLOSE_BOUND, closed_after
+    assert limiter.active == 0, limiter.stats()
+    assert server.metrics.in_flight("local") == 0
+    print(f"client disconnect: upstream closed {closed_after * 1000:.0f} ms after the client left, "
+          f"slot active={limiter.active}, in_flight={server.metrics.in_flight('local')}")
+
+
+async def check_disconnect_before_first_chunk(proxy_url, upstream, limiter):
+    upstream.frames, upstream.interval, upstream.header_delay = 1000, 0.1, HEADER_DELAY
+    upstream.responded_at = None
+
+    async def request():
+        async with httpx.AsyncClient(timeout=10) as client:
+            async with client.stream("POST", f"{proxy_url}/v1/chat/completions", json=request_body()) as response:
+                async for _ in response.aiter_lines():
+                    pass
+
+    client_task = asyncio.create_task(request())
+    await asyncio.sleep(HEADER_DELAY / 3)
+    client_task.cancel()  # Клиент ушел, пока upstream молчит
+    try:
+        await client_task
+    except asyncio.CancelledError:
+        pass
+    while upstream.responded_at is None:
+        await asyncio.sleep(0.01)
+    closed_after = await upstream.wait_closed(upstream.responded_at)
+    await asyncio.sleep(0.05)
+    upstream.header_delay = 0.0
+    assert closed_after is not None and closed_after < CLOSE_BOUND, closed_after
+    assert limiter.active == 0, limiter.stats()
+    assert server.metrics.in_flight("local") == 0
+    assert server.http_pool.stats()["requests"] == 0, server.http_pool.stats()
+    print(f"client left before the first chunk: upstream closed {closed_after * 1000:.0f} ms after it answered, "
+          f"slot active={limiter.active}, in_flight={server.metrics.in_flight('local')}, "
+          f"pool holds={server.http_pool.stats()['requests']}")
+
+
+async def main():
+    server.response_cache.enabled = False
+    server.single_flight.enabled = False
+    upstream = StallingUpstream()
+    port = await upstream.start()
+    timeout = httpx.Timeout(connect=1.0, read=IDLE_TIMEOUT, write=1.0, pool=1.0)
+    use_upstream("local", httpx.AsyncClient(timeout=timeout), base_url=f"http://127.0.0.1:{port}/v1")
+    # Слот провайдера должен вернуться и после обрыва по таймауту, и после ухода клиента
+    limiter = ConcurrencyLimiter("local", 4)
+    server.concurrency_limits._limiters[("local", None)] = limiter
+
+    proxy = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=0, log_level="warning"))
+    serving = asyncio.create_task(proxy.serve())
+    while not proxy.started:
+        await asyncio.sleep(0.01)
+    proxy_url = "http://127.0.0.1:%d" % proxy.servers[0].sockets[0].getsockname()[1]
+    try:
+        await check_idle_timeout(proxy_url, upstream, limiter)
+        await check_client_disconnect(proxy_url, upstream, limiter)
+        await check_disconnect_before_first_chunk(proxy_url, upstream, limiter)
+    finally:
+        proxy.should_exit = True
+        await serving
+        upstream.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
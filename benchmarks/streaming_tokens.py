@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Подсчет токенов длинного streaming ответа.
+
+Ответ модели (~5k токенов кода и текста) приходит мелкими дельтами, как от
+upstream. После каждой дельты нужно текущее число токенов вывода (для usage
+в чанках). Сравниваются прежний способ - encode_ordinary всего накопленного
+текста на каждом чанке - и StreamingTokenCounter, который кодирует только
+новые фрагменты. На каждом чанке итог счетчика сверяется с полным
+подсчетом накопленного текста. Если токенизатор не разбивает текст на
+фрагменты (например, без файлов энкодинга работает ApproximateEncoding),
+точного совпадения нет: проверяется, что расхождение не больше токена на
+каждый зафиксированный кусок.
+
+Запуск из корня проекта: python benchmarks/streaming_tokens.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.token_counter import StreamingTokenCounter  # noqa: E402
+from utils.tokenizer_registry import TokenizerRegistry  # noqa: E402
+
+TARGET_TOKENS = 5000
+
+
+def build_response(target_tokens=TARGET_TOKENS):
+    """Текст, похожий на ответ агента: пояснения, код, пути, числа и отступы"""
+    block = (
+        "Here is the updated parser. It reports errors with line numbers:\n\n"
+        "```python\n"
+        "def parse(lines):\n"
+        "    for number, line in enumerate(lines, 1):\n"
+        "        if not line.strip():\n"
+        "            continue  # skip blank lines\n"
+        "        key, _, value = line.partition('=')\n"
+        "        if not value:\n"
+        "            raise ValueError(f'line {number}: expected key=value, got {line!r}')\n"
+        "        yield key.strip(), value.strip()\n"
+        "```\n\n"
+        "Run `pytest tests/test_parser.py -k errors` (3 tests, 0.42s).\n"
+    )
+    # ~130 токенов на блок
+    return block * (target_tokens // 130)
+
+
+def split_deltas(text, seed=7):
+    """Дельты по 1-12 символов, как у SSE чанков upstream"""
+    rng = random.Random(seed)
+    deltas = []
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 12)
+        deltas.append(text[position:position + size])
+        position += size
+    return deltas
+
+
+def main():
+    encoding = TokenizerRegistry().encoding("deepseek")
+    text = build_response()
+    deltas = split_deltas(text)
+
+    started = time.process_time()
+    accumulated = ""
+    full_counts = []
+    lengths = []
+    for delta in deltas:
+        accumulated += delta
+        full_counts.append(len(encoding.encode_ordinary(accumulated)))
+        lengths.append(len(accumulated))
+    full_time = time.process_time() - started
+
+    started = time.process_time()
+    counter = StreamingTokenCounter(encoding)
+    streamed_counts = [counter.add(delta) for delta in deltas]
+    streaming_time = time.process_time() - started
+
+    # Равенство на каждом чанке, а не только в конце
+    exact = StreamingTokenCounter._get_splitter(encoding) is not None
+    if exact:
+        mismatches = [index for index, (full, streamed) in enumerate(zip(full_counts, streamed_counts)) if full != streamed]
+        assert not mismatches, f"first mismatch at chunk {mismatches[0]}"
+        assert streamed_counts[-1] == len(encoding.encode_ordinary(text))
+    else:
+        # Хвост фиксируется кусками по COMMIT_CHARS и больше символов: на каждом стыке не больше токена погрешности
+        print(f"note: {encoding.name} does not split text into pieces, counts are checked within one token per committed chunk")
+        mismatches = [
+            index for index, (full, streamed, length) in enumerate(zip(full_counts, streamed_counts, lengths))
+            if abs(full - streamed) > length // StreamingTokenCounter.COMMIT_CHARS
+        ]
+        assert not mismatches, f"first mismatch beyond tolerance at chunk {mismatches[0]}"
+    full_count = full_counts[-1]
+
+    print(f"{len(deltas)} chunks, {full_count} output tokens ({encoding.name})")
+    print(f"encode_ordinary(accumulated) per chunk: {full_time * 1000:9.1f} ms CPU")
+    print(f"StreamingTokenCounter.add per chunk:    {streaming_time * 1000:9.1f} ms CPU")
+    if exact:
+        print(f"speedup: {full_time / streaming_time:.1f}x, counts match encode_ordinary on every chunk")
+    else:
+        print(f"speedup: {full_time / streaming_time:.1f}x, final count {streamed_counts[-1]} vs {full_count}")
+
+if __name__ == "__main__":
+    main()
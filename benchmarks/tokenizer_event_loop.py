@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Задержка event loop во время подсчета токенов большого промпта.
+
+Несколько "стримов" отдают чанк каждые 10 мс и замеряют фактические паузы
+между чанками. Параллельно считается промпт размером с большой контекст Cline
+(~150k токенов): сначала синхронно в event loop (count_tokens), затем через
+count_tokens_async. При синхронном подсчете паузы стримов вырастают на время
+токенизации, при асинхронном остаются около 10 мс.
+
+Запуск из корня проекта: python benchmarks/tokenizer_event_loop.py
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.token_counter import TokenCounter  # noqa: E402
+
+CHUNK_INTERVAL = 0.01
+STREAMS = 4
+
+
+def build_prompt(target_tokens=150000):
+    """Текст, похожий на контекст агента: код, пути файлов и обычный текст"""
+    block = (
+        "def process(items):\n"
+        "    for index, item in enumerate(items):\n"
+        "        if item.get('status') == 'ready':\n"
+        "            yield index, item['payload']\n"
+        "# src/components/FileTree.tsx: 128 lines, last modified 2024-05-01\n"
+        "The user asked to refactor the parser so that errors are reported with line numbers.\n"
+    )
+    # ~70 токенов на блок
+    return block * (target_tokens // 70)
+
+
+async def stream(gaps, stop):
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(CHUNK_INTERVAL)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+
+async def run(counter, prompt, use_async):
+    gaps = []
+    stop = asyncio.Event()
+    streams = [asyncio.create_task(stream(gaps, stop)) for _ in range(STREAMS)]
+    await asyncio.sleep(0.2)  # Стримы разогнались
+
+    started = time.perf_counter()
+    if use_async:
+        tokens = await counter.count_tokens_async(prompt, "deepseek")
+    else:
+        tokens = counter.count_tokens(prompt, "deepseek")
+    elapsed = time.perf_counter() - started
+
+    await asyncio.sleep(0.2)
+    stop.set()
+    await asyncio.gather(*streams)
+    gaps.sort()
+    return {
+        "tokens": tokens,
+        "tokenize_ms": elapsed * 1000,
+        "p50_gap_ms": statistics.median(gaps) * 1000,
+        "p99_gap_ms": gaps[int(len(gaps) * 0.99) - 1] * 1000,
+        "max_gap_ms": gaps[-1] * 1000,
+    }
+
+
+async def main():
+    counter = TokenCounter()
+    prompt = build_prompt()
+    counter.count_tokens(prompt[:1000], "deepseek")  # Загрузка энкодинга не входит в замер
+
+    print(f"Prompt: {len(prompt)} chars, {STREAMS} streams with a chunk every {CHUNK_INTERVAL * 1000:.0f} ms")
+    for name, use_async in (("inline count_tokens", False), ("count_tokens_async", True)):
+        result = await run(counter, prompt, use_async)
+        print(
+            f"{name:22} tokens={result['tokens']:>7}  tokenize={result['tokenize_ms']:7.1f} ms  "
+            f"inter-chunk p50={result['p50_gap_ms']:5.1f} ms  p99={result['p99_gap_ms']:6.1f} ms  "
+            f"max={result['max_gap_ms']:6.1f} ms"
+        )
+    counter.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
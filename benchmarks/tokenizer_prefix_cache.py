@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Процессорное время токенизатора на растущем разговоре агента.
+
+Воспроизводится разговор из 50 ходов: на каждом ходу клиент присылает всю
+историю заново (system, запросы пользователя, ответы ассистента с
+вызовами инструментов и их результаты). Промпт каждого хода считается
+двумя способами: прежним count_tokens(str(messages)), который кодирует всю
+историю каждый раз, и count_messages с кэшем по сообщениям, который кодирует
+только новые сообщения. Итог count_messages сверяется с подсчетом без кэша.
+
+Запуск из корня проекта: python benchmarks/tokenizer_prefix_cache.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.token_counter import TokenCounter  # noqa: E402
+
+TURNS = 50
+
+
+def build_conversation(turns=TURNS):
+    """Ходы разговора: список сообщений, которые добавляются на каждом ходу"""
+    system = {
+        "role": "system",
+        "content": "You are a coding agent working in a TypeScript monorepo. Use the tools to read and edit files.\n" * 200,
+    }
+    source = (
+        "export function parseConfig(text: string): Config {\n"
+        "  const lines = text.split('\\n');\n"
+        "  return lines.reduce((config, line) => applyLine(config, line), defaultConfig());\n"
+        "}\n"
+    )
+    history = [[system]]
+    for turn in range(turns):
+        call_id = f"call_{turn}"
+        history.append([
+            {"role": "user", "content": f"Step {turn}: fix the parser error reported in src/config/parse{turn}.ts"},
+            {
+                "role": "assistant",
+                "content": f"Reading src/config/parse{turn}.ts to find the failing branch.",
+                "tool_calls": [{
+                    "id": call_id,
+                    "type": "function",
+                    "function": {"name": "read_file", "arguments": f'{{"path": "src/config/parse{turn}.ts"}}'},
+                }],
+            },
+            {"role": "tool", "tool_call_id": call_id, "content": source * 40},
+        ])
+    return history
+
+
+def main():
+    turns = build_conversation()
+    counter = TokenCounter()
+    counter.count_tokens("warm up", "deepseek")  # Загрузка энкодинга не входит в замер
+
+    messages = []
+    full_time = cached_time = 0.0
+    for added in turns:
+        messages = messages + added
+
+        started = time.process_time()
+        counter.count_tokens(str(messages), "deepseek")
+        full_time += time.process_time() - started
+
+        started = time.process_time()
+        cached_total = counter.count_messages(messages, "deepseek")
+        cached_time += time.process_time() - started
+
+    # Итог с кэшем должен совпадать с подсчетом того же промпта без кэша
+    fresh_total = TokenCounter().count_messages(messages, "deepseek")
+    assert cached_total == fresh_total, (cached_total, fresh_total)
+
+    stats = counter.stats()
+    print(f"{len(turns) - 1} turns, final prompt: {len(messages)} messages, {cached_total} tokens")
+    print(f"count_tokens(str(messages)):  {full_time * 1000:8.1f} ms CPU")
+    print(f"count_messages (cached):      {cached_time * 1000:8.1f} ms CPU  "
+          f"hits={stats['hits']} misses={stats['misses']}")
+    print(f"speedup: {full_time / cached_time:.1f}x, cached total matches a full count")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,20 @@ import os
 import json
 from typing import Dict, Any
 
+from utils.model_registry import ModelRegistry
+
 class Config:
     _settings = None
+    _model_registry = None
+
+    @classmethod
+    def get_settings_path(cls) -> str:
+        return os.path.join(os.path.dirname(__file__), 'settings.json')
 
     @classmethod
     def load_settings(cls):
         if cls._settings is None:
-            settings_path = os.path.join(os.path.dirname(__file__), 'settings.json')
+            settings_path = cls.get_settings_path()
             try:
                 with open(settings_path, 'r', encoding='utf-8') as f:
                     cls._settings = json.load(f)
@@ -44,31 +51,158 @@ class Config:
             },
             "default_provider": "local",
             "server": {"host": "0.0.0.0", "port": 8000},
-            "logging": {"save_to_file": False, "file_path": "logs/proxy_logs.txt", "max_size": 10485760},
+            "logging": {"save_to_file": False, "file_path": "logs/proxy_logs.txt", "max_size": 10485760, "max_logs": 100},
+            "http": {
+                "max_connections": 100,
+                "max_keepalive_connections": 20,
+                "keepalive_expiry": 30.0,
+                "http2": False,
+                "timeouts": {"connect": 10.0, "read": 600.0, "write": 30.0, "pool": 10.0}
+            },
+            "cache": {
+                "enabled": True,
+                "only_deterministic": True,
+                "max_entries": 1000,
+                "max_bytes": 52428800,
+                "ttl": 3600,
+                "disk_path": None
+            },
+            "single_flight": {"enabled": True, "only_deterministic": True},
+            "retry": {"enabled": True, "max_retries": 3, "base_delay": 0.5, "max_delay": 8.0, "max_elapsed": 30.0},
+            "rate_limit": {"max_wait": 60.0},
+            "concurrency": {"max_queue": 100, "queue_timeout": 60.0, "retry_after": 2},
+            "failover": {
+                "enabled": True,
+                "breaker": {"failure_rate": 0.5, "min_calls": 5, "window_seconds": 60.0, "slow_call_seconds": 60.0, "open_seconds": 30.0, "half_open_calls": 1}
+            },
+            "routing": {"ewma_alpha": 0.2, "aliases": {}},
+            "overflow": {"enabled": False, "from": "local", "to": "deepseek-chat", "max_in_flight": 4, "max_queue_wait": 2.0, "max_ttft": 5.0, "latency_window": 30.0},
+            "tokenizer": {"inline_chars": 20000, "max_workers": 2, "cache_entries": 10000, "default": "cl100k_base", "assets_dir": "tokenizers", "preload": False},
+            "reload": {"watch": True, "watch_interval": 2.0},
             "language": "en"
         }
 
     @classmethod
     def save_settings(cls):
-        settings_path = os.path.join(os.path.dirname(__file__), 'settings.json')
+        settings_path = cls.get_settings_path()
         os.makedirs(os.path.dirname(settings_path), exist_ok=True)
-        with open(settings_path, 'w', encoding='utf-8') as f:
+        # Через временный файл: запущенный сервер следит за settings.json и не должен прочитать его наполовину
+        tmp_path = settings_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(cls._settings, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, settings_path)
+        cls._model_registry = None
 
     @classmethod
-    def get_providers(cls) -> Dict[str, Any]:
+    def read_settings(cls, settings_path: str = None) -> Dict[str, Any]:
+        """
+        Прочитать и проверить settings.json для перезагрузки без перезапуска.
+        В отличие от load_settings не подставляет значения по умолчанию: ValueError при любой ошибке.
+        """
+        settings_path = settings_path or cls.get_settings_path()
+        try:
+            with open(settings_path, 'r', encoding='utf-8') as f:
+                settings = json.load(f)
+        except OSError as e:
+            raise ValueError(f"Cannot read {settings_path}: {e}")
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON in {settings_path}: {e}")
+        cls._validate_settings(settings)
+        return settings
+
+    @classmethod
+    def _validate_settings(cls, settings: Dict[str, Any]):
+        if not isinstance(settings, dict):
+            raise ValueError("settings must be a JSON object")
+        defaults = cls._get_default_settings()
+        for section, value in settings.items():
+            if isinstance(defaults.get(section), dict) and not isinstance(value, dict):
+                raise ValueError(f"Section '{section}' must be an object")
+        if not settings.get("providers"):
+            raise ValueError("No providers configured")
+        providers = settings["providers"]
+        for provider_name, provider_config in providers.items():
+            if not isinstance(provider_config, dict):
+                raise ValueError(f"Provider '{provider_name}' must be an object")
+            cls._validate_limits(provider_config, f"provider '{provider_name}'")
+            models = provider_config.get("models", [])
+            if not isinstance(models, list):
+                raise ValueError(f"Models of provider '{provider_name}' must be a list")
+            for model in models:
+                if not isinstance(model, dict) or not isinstance(model.get("name"), str):
+                    raise ValueError(f"Every model of provider '{provider_name}' needs a name")
+                for field in ("context_window", "max_tokens"):
+                    if field in model and not isinstance(model[field], int):
+                        raise ValueError(f"{field} of model '{model['name']}' must be an integer")
+                pricing = model.get("pricing", {})
+                if not isinstance(pricing, dict) or not all(isinstance(price, (int, float)) for price in pricing.values()):
+                    raise ValueError(f"Pricing of model '{model['name']}' must map price names to numbers")
+                cls._validate_limits(model, f"model '{model['name']}'")
+        # Параметры, которые применяются при перезагрузке без перезапуска
+        for section, field, minimum in (("tokenizer", "inline_chars", 0), ("tokenizer", "max_workers", 1),
+                                        ("tokenizer", "cache_entries", 0)):
+            value = settings.get(section, {}).get(field)
+            if value is not None and (not isinstance(value, int) or value < minimum):
+                raise ValueError(f"{section}.{field} must be an integer >= {minimum}")
+        ewma_alpha = settings.get("routing", {}).get("ewma_alpha")
+        if ewma_alpha is not None and (not isinstance(ewma_alpha, (int, float)) or not 0 < ewma_alpha <= 1):
+            raise ValueError("routing.ewma_alpha must be a number in (0, 1]")
+        watch_interval = settings.get("reload", {}).get("watch_interval")
+        if watch_interval is not None and (not isinstance(watch_interval, (int, float)) or watch_interval < 0):
+            raise ValueError("reload.watch_interval must be a number >= 0")
+
+    @classmethod
+    def _validate_limits(cls, config: Dict[str, Any], owner: str):
+        """Лимиты провайдера или модели применяются при перезагрузке, поэтому проверяются заранее"""
+        for field in ("max_concurrency", "max_queue"):
+            value = config.get(field)
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ValueError(f"{field} of {owner} must be an integer >= 0")
+        rate_limit = config.get("rate_limit")
+        if rate_limit is None:
+            return
+        if not isinstance(rate_limit, dict) or not all(
+                value is None or (isinstance(value, (int, float)) and value >= 0) for value in rate_limit.values()):
+            raise ValueError(f"rate_limit of {owner} must map limit names to numbers >= 0")
+
+    @classmethod
+    def apply_settings(cls, settings: Dict[str, Any], model_registry: ModelRegistry = None):
+        """Заменить настройки и реестр моделей целиком (после read_settings)"""
+        cls._settings = settings
+        cls._model_registry = model_registry
+
+    @classmethod
+    def get_settings(cls, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Текущие настройки или переданные settings (для построения снимка до apply_settings)"""
+        if settings is not None:
+            return settings
         cls.load_settings()
-        return cls._settings.get("providers", {})
+        return cls._settings
+
+    @classmethod
+    def get_providers(cls, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        return cls.get_settings(settings).get("providers", {})
 
     @classmethod
-    def get_provider_config(cls, provider_name: str) -> Dict[str, Any]:
-        providers = cls.get_providers()
+    def get_provider_config(cls, provider_name: str, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        providers = cls.get_providers(settings)
         return providers.get(provider_name, {})
 
     @classmethod
-    def get_default_provider(cls) -> str:
-        cls.load_settings()
-        return cls._settings.get("default_provider", "local")
+    def get_model_config(cls, provider_name: str, model_name: str = None) -> Dict[str, Any]:
+        """
+        Получить настройки модели провайдера.
+        Если model_name не указан или не найден, возвращает настройки первой модели.
+        """
+        models = cls.get_provider_config(provider_name).get("models", [])
+        for model in models:
+            if model.get("name") == model_name:
+                return model
+        return models[0] if models else {}
+
+    @classmethod
+    def get_default_provider(cls, settings: Dict[str, Any] = None) -> str:
+        return cls.get_settings(settings).get("default_provider", "local")
 
     @classmethod
     def get_server_config(cls) -> Dict[str, Any]:
@@ -80,6 +214,71 @@ class Config:
         cls.load_settings()
         return cls._settings.get("logging", {"save_to_file": False, "file_path": "logs/proxy_logs.txt", "max_size": 10485760})
 
+    @classmethod
+    def get_http_config(cls, provider_name: str) -> Dict[str, Any]:
+        """
+        Параметры HTTP пула для провайдера.
+        Общие значения из секции "http" переопределяются секцией "http" провайдера.
+        """
+        cls.load_settings()
+        http_config = dict(cls._settings.get("http", {}))
+        provider_http = cls.get_provider_config(provider_name).get("http", {})
+        timeouts = {**http_config.get("timeouts", {}), **provider_http.get("timeouts", {})}
+        http_config.update(provider_http)
+        http_config["timeouts"] = timeouts
+        return http_config
+
+    @classmethod
+    def get_cache_config(cls) -> Dict[str, Any]:
+        cls.load_settings()
+        return cls._settings.get("cache", {"enabled": False})
+
+    @classmethod
+    def get_single_flight_config(cls) -> Dict[str, Any]:
+        cls.load_settings()
+        return cls._settings.get("single_flight", {"enabled": True, "only_deterministic": True})
+
+    @classmethod
+    def get_retry_config(cls, provider_name: str, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        Политика повторов для провайдера.
+        Общие значения из секции "retry" переопределяются секцией "retry" провайдера.
+        """
+        retry_config = dict(cls.get_settings(settings).get("retry", {}))
+        retry_config.update(cls.get_provider_config(provider_name, settings).get("retry", {}))
+        return retry_config
+
+    @classmethod
+    def get_rate_limit_config(cls) -> Dict[str, Any]:
+        cls.load_settings()
+        return cls._settings.get("rate_limit", {"max_wait": 60.0})
+
+    @classmethod
+    def get_concurrency_config(cls) -> Dict[str, Any]:
+        cls.load_settings()
+        return cls._settings.get("concurrency", {"max_queue": 100, "queue_timeout": 60.0, "retry_after": 2})
+
+    @classmethod
+    def get_failover_config(cls) -> Dict[str, Any]:
+        cls.load_settings()
+        return cls._settings.get("failover", {"enabled": True})
+
+    @classmethod
+    def get_routing_config(cls, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        return cls.get_settings(settings).get("routing", {"ewma_alpha": 0.2, "aliases": {}})
+
+    @classmethod
+    def get_overflow_config(cls, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        return cls.get_settings(settings).get("overflow", {"enabled": False})
+
+    @classmethod
+    def get_tokenizer_config(cls, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        return cls.get_settings(settings).get("tokenizer", {"inline_chars": 20000, "max_workers": 2, "cache_entries": 10000, "default": "cl100k_base", "assets_dir": "tokenizers", "preload": False})
+
+    @classmethod
+    def get_reload_config(cls, settings: Dict[str, Any] = None) -> Dict[str, Any]:
+        return cls.get_settings(settings).get("reload", {"watch": True, "watch_interval": 2.0})
+
     @classmethod
     def get_language(cls) -> str:
         cls.load_settings()
@@ -90,26 +289,26 @@ class Config:
         cls.load_settings()
         return cls._settings.get("max_tokens", 8000)
 
+    @classmethod
+    def get_model_registry(cls) -> ModelRegistry:
+        """
+        Неизменяемый снимок моделей (цены, лимиты, окна контекста), построенный один раз.
+        При изменении настроек строится заново и подменяется целиком.
+        """
+        registry = cls._model_registry
+        if registry is None:
+            cls.load_settings()
+            registry = ModelRegistry.from_config(cls.get_providers(), cls.get_max_tokens())
+            cls._model_registry = registry
+        return registry
+
     @classmethod
     def get_model_max_tokens(cls, provider_name: str, model_name: str = None) -> int:
         """
         Получить max_tokens для конкретной модели.
         Если model_name не указан, возвращает max_tokens первой модели провайдера.
         """
-        cls.load_settings()
-        provider_config = cls.get_provider_config(provider_name)
-        models = provider_config.get("models", [])
-        
-        if not models:
-            return cls.get_max_tokens()
-        
-        if model_name:
-            for model in models:
-                if model.get("name") == model_name:
-                    return model.get("max_tokens", cls.get_max_tokens())
-        
-        # Если модель не найдена, возвращаем max_tokens первой модели
-        return models[0].get("max_tokens", cls.get_max_tokens())
+        return cls.get_model_registry().max_tokens(provider_name, model_name)
 
     # Legacy properties for backward compatibility
     @property
@@ -178,19 +377,17 @@ class Config:
 
     @property
     def PRICES(self):
-        providers = self.get_providers()
+        # Цены первой модели каждого провайдера; цены конкретной модели - get_model_registry().model()
+        registry = self.get_model_registry()
         prices = {}
-        for provider_name, provider_config in providers.items():
-            if provider_config.get("enabled", False):
-                models = provider_config.get("models", [])
-                if models:
-                    # Use pricing from first model
-                    pricing = models[0].get("pricing", {})
-                    prices[provider_name] = {
-                        "input_cache_hit": pricing.get("input_cache_hit", 0.0) / 1_000_000,
-                        "input_cache_miss": pricing.get("input_cache_miss", 0.0) / 1_000_000,
-                        "output": pricing.get("output", 0.0) / 1_000_000
-                    }
+        for provider_name, provider_config in self.get_providers().items():
+            if provider_config.get("enabled", False) and provider_config.get("models"):
+                spec = registry.model(provider_name)
+                prices[provider_name] = {
+                    "input_cache_hit": spec.input_cache_hit,
+                    "input_cache_miss": spec.input_cache_miss,
+                    "output": spec.output
+                }
         return prices
 
 # Create singleton instance for backward compatibility
@@ -4,6 +4,7 @@ import threading
 import requests
 import time
 import os
+import json
 from server import app
 import uvicorn
 from config import config as Config
@@ -459,6 +460,12 @@ class ProxyGUI:
         logging_config = Config.get_logging_config()
         self.save_logs_to_file = tk.BooleanVar(value=logging_config.get("save_to_file", False))
 
+        # Новые записи логов от сервера, ожидающие отрисовки в GUI потоке
+        self.pending_log_entries = []
+        self.pending_log_lock = threading.Lock()
+        self.last_log_seq = 0
+        self.latest_stats = {}
+
         # Ссылки на виджеты для обновления текстов
         self.provider_frame = None
         self.language_frame = None
@@ -681,6 +688,9 @@ class ProxyGUI:
         if not self.server_running:
             self.server_running = True
             self.stop_server_flag = False
+            # Новый процесс сервера начинает нумерацию логов заново
+            self.last_log_seq = 0
+            self.latest_stats = {}
             lang = self.current_language.get()
             self.start_button.config(text=self.translations[lang]['stop_button'], state="normal")
             threading.Thread(target=self.run_server, daemon=True).start()
@@ -739,17 +749,8 @@ class ProxyGUI:
         trans = self.translations[lang]
 
         if self.server_running and self.server_process and self.server_process.poll() is None:
-            try:
-                server_config = Config.get_server_config()
-                port = server_config.get("port", 8000)
-                response = requests.get(f"http://localhost:{port}/stats", timeout=2)
-                if response.status_code == 200:
-                    data = response.json()
-                    self.total_requests_label.config(text=trans['total_requests'].format(count=data['total_requests']))
-                    self.total_tokens_label.config(text=trans['total_tokens'].format(count=data['total_tokens']))
-                    self.total_cost_label.config(text=trans['total_cost'].format(cost=f"{data['total_cost']:.6f}"))
-            except:
-                pass
+            # Статистика приходит через подписку на события сервера (log_update_worker)
+            self.render_stats()
         else:
             # Если сервер не запущен или процесс умер, сбрасываем состояние
             if self.server_running:
@@ -781,98 +782,175 @@ class ProxyGUI:
             self.log_update_thread.join(timeout=1.0)
 
     def log_update_worker(self):
-        """Рабочий поток для обновления логов"""
+        """Рабочий поток: одна SSE подписка на логи и статистику сервера"""
         while not self.stop_log_updates and self.server_running:
             try:
-                self.update_logs()
-                time.sleep(1)  # Обновление каждую секунду
+                self.consume_server_events()
             except Exception as e:
                 print(f"Ошибка в потоке обновления логов: {e}")
-                time.sleep(2)
+            time.sleep(2)  # Переподключение (сервер еще стартует или был перезапущен)
 
-    def update_logs(self):
-        """Обновление логов запросов и ответов"""
-        if not self.server_running:
+    def consume_server_events(self):
+        """Чтение потока /logs/stream: event: log - новая запись, event: stats - изменения статистики"""
+        server_config = Config.get_server_config()
+        port = server_config.get("port", 8000)
+        url = f"http://localhost:{port}/logs/stream"
+
+        with requests.get(url, params={"since": self.last_log_seq}, stream=True, timeout=(2, 30)) as response:
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if self.stop_log_updates or not self.server_running:
+                    return
+                if not line:
+                    event = None
+                elif line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[5:])
+                    if event == "log":
+                        self.handle_log_entry(data)
+                    elif event == "stats":
+                        self.latest_stats.update(data)
+                        self.root.after(0, self.render_stats)
+
+    def handle_log_entry(self, entry):
+        """Добавить запись лога; при разрыве в seq дочитать пропущенное через /logs?since="""
+        if entry["seq"] <= self.last_log_seq:
             return
-            
-        try:
-            server_config = Config.get_server_config()
-            port = server_config.get("port", 8000)
+        entries = [entry]
+        if entry["seq"] > self.last_log_seq + 1 and self.last_log_seq > 0:
+            try:
+                server_config = Config.get_server_config()
+                port = server_config.get("port", 8000)
+                # /logs отдает пропущенное постранично, старые записи первыми
+                missed = []
+                since = self.last_log_seq
+                while True:
+                    response = requests.get(f"http://localhost:{port}/logs", params={"since": since}, timeout=2)
+                    if response.status_code != 200:
+                        break
+                    page = response.json()["logs"]
+                    missed.extend(page)
+                    if not page or page[-1]["seq"] >= entry["seq"]:
+                        break
+                    since = page[-1]["seq"]
+                entries = missed + entries
+            except Exception as e:
+                print(f"Ошибка получения пропущенных логов: {e}")
+
+        with self.pending_log_lock:
+            schedule = not self.pending_log_entries
+            for log in entries:
+                if log["seq"] <= self.last_log_seq:
+                    continue
+                self.last_log_seq = log["seq"]
+                self.pending_log_entries.append(log)
+
+        # Несколько событий подряд отрисовываем одним вызовом в GUI потоке
+        if schedule:
+            self.root.after(0, self.render_logs)
+
+    def render_logs(self):
+        """Дорисовка новых записей логов в GUI потоке"""
+        with self.pending_log_lock:
+            entries, self.pending_log_entries = self.pending_log_entries, []
+        if not entries:
+            return
+        self.update_requests_text([log for log in entries if log["type"] == "request"])
+        self.update_responses_text([log for log in entries if log["type"] != "request"])
+        self.update_all_logs_text(entries)
 
-            # Получаем логи запросов
-            response = requests.get(f"http://localhost:{port}/logs/requests", timeout=2)
-            if response.status_code == 200:
-                data = response.json()
-                print(f"Получено запросов: {len(data['request_logs'])}")
-                # Обновляем в основном потоке GUI
-                self.root.after(0, lambda: self.update_requests_text(data['request_logs']))
+    def render_stats(self):
+        """Отрисовка последней статистики, полученной от сервера"""
+        if not self.latest_stats:
+            return
+        lang = self.current_language.get()
+        trans = self.translations[lang]
+        self.total_requests_label.config(text=trans['total_requests'].format(count=self.latest_stats.get('total_requests', 0)))
+        self.total_tokens_label.config(text=trans['total_tokens'].format(count=self.latest_stats.get('total_tokens', 0)))
+        self.total_cost_label.config(text=trans['total_cost'].format(cost=f"{self.latest_stats.get('total_cost', 0.0):.6f}"))
 
-            # Получаем логи ответов
-            response = requests.get(f"http://localhost:{port}/logs/responses", timeout=2)
-            if response.status_code == 200:
-                data = response.json()
-                print(f"Получено ответов: {len(data['response_logs'])}")
-                self.root.after(0, lambda: self.update_responses_text(data['response_logs']))
+    # Максимум строк в панели логов; старые записи удаляются
+    MAX_PANE_LINES = 2000
+    LOG_SEPARATOR = "-" * 50
 
-            # Получаем все логи
-            response = requests.get(f"http://localhost:{port}/logs/all", timeout=2)
-            if response.status_code == 200:
-                data = response.json()
-                print(f"Всего логов: {len(data['logs'])}")
-                self.root.after(0, lambda: self.update_all_logs_text(data['logs']))
+    def append_to_pane(self, text_widget, block, newest_first):
+        """Вставить блок новых записей одним вызовом, обрезать старые и сохранить позицию прокрутки.
 
-        except Exception as e:
-            print(f"Ошибка обновления логов: {e}")
+        newest_first: панель показывает новые записи сверху (вставка в начало,
+        обрезка с конца), иначе новые записи дописываются в конец.
+        """
+        if not block:
+            return
+        first_visible = int(text_widget.index("@0,0").split(".")[0])
+        top, bottom = text_widget.yview()
+        added_lines = block.count("\n")
+
+        text_widget.config(state=tk.NORMAL)
+        if newest_first:
+            text_widget.insert("1.0", block)
+        else:
+            text_widget.insert(tk.END, block)
+
+        # Обрезаем по границе записи (строке-разделителю), чтобы не оставлять обрывки
+        removed_lines = 0
+        total_lines = int(text_widget.index("end-1c").split(".")[0])
+        if total_lines > self.MAX_PANE_LINES:
+            if newest_first:
+                cut = text_widget.search(self.LOG_SEPARATOR, f"{self.MAX_PANE_LINES}.0", backwards=True, stopindex="1.0")
+                if cut:
+                    text_widget.delete(f"{cut} +1 line linestart", tk.END)
+            else:
+                cut = text_widget.search(self.LOG_SEPARATOR, f"{total_lines - self.MAX_PANE_LINES}.0", stopindex=tk.END)
+                if cut:
+                    removed_lines = int(cut.split(".")[0])
+                    text_widget.delete("1.0", f"{cut} +1 line linestart")
+        text_widget.config(state=tk.DISABLED)
+
+        # Восстанавливаем прокрутку: у края остаемся у края, иначе держим те же строки
+        if newest_first:
+            if top > 0.0:
+                text_widget.yview(f"{first_visible + added_lines}.0")
+        elif bottom >= 1.0:
+            text_widget.see(tk.END)
+        else:
+            text_widget.yview(f"{max(1, first_visible - removed_lines)}.0")
 
     def update_requests_text(self, logs):
-        """Обновление текста запросов в GUI потоке"""
-        self.requests_text.config(state=tk.NORMAL)
-        self.requests_text.delete(1.0, tk.END)
-        
+        """Дорисовка новых запросов в GUI потоке"""
+        parts = []
         for log in reversed(logs):  # Новые сверху
             timestamp = time.strftime("%H:%M:%S", time.localtime(log['timestamp']))
-            self.requests_text.insert(tk.END, f"[{timestamp}] {log['provider']}:\n")
-            self.requests_text.insert(tk.END, f"Запрос: {log['user_message']}\n")
-            self.requests_text.insert(tk.END, f"Сообщений: {log['messages_count']}, Stream: {log['stream']}\n")
-            self.requests_text.insert(tk.END, "-" * 50 + "\n")
-        
-        self.requests_text.config(state=tk.DISABLED)
+            parts.append(f"[{timestamp}] {log['provider']}:\n")
+            parts.append(f"Запрос: {log['user_message']}\n")
+            parts.append(f"Сообщений: {log['messages_count']}, Stream: {log['stream']}\n")
+            parts.append(self.LOG_SEPARATOR + "\n")
+        self.append_to_pane(self.requests_text, "".join(parts), newest_first=True)
 
     def update_responses_text(self, logs):
-        """Обновление текста ответов в GUI потоке"""
-        self.responses_text.config(state=tk.NORMAL)
-        self.responses_text.delete(1.0, tk.END)
-        
+        """Дорисовка новых ответов в GUI потоке"""
+        parts = []
         for log in reversed(logs):  # Новые сверху
             timestamp = time.strftime("%H:%M:%S", time.localtime(log['timestamp']))
-            self.responses_text.insert(tk.END, f"[{timestamp}] {log['provider']}:\n")
-            self.responses_text.insert(tk.END, f"Ответ: {log['response']}\n")
-            self.responses_text.insert(tk.END, f"Токены: {log['input_tokens']}+{log['output_tokens']}\n")
-            self.responses_text.insert(tk.END, "-" * 50 + "\n")
-        
-        self.responses_text.config(state=tk.DISABLED)
+            parts.append(f"[{timestamp}] {log['provider']}:\n")
+            parts.append(f"Ответ: {log['response']}\n")
+            cancelled = " (клиент отключился)" if log.get('cancelled') else ""
+            parts.append(f"Токены: {log['input_tokens']}+{log['output_tokens']}{cancelled}\n")
+            parts.append(self.LOG_SEPARATOR + "\n")
+        self.append_to_pane(self.responses_text, "".join(parts), newest_first=True)
 
     def update_all_logs_text(self, logs):
-        """Обновление всех логов в GUI потоке"""
-        self.all_logs_text.config(state=tk.NORMAL)
-        self.all_logs_text.delete(1.0, tk.END)
-
-        log_content = ""
-        for log in logs:  # Уже отсортированы по времени
+        """Дорисовка новых записей общей ленты в GUI потоке"""
+        parts = []
+        for log in logs:  # Уже в порядке поступления
             timestamp = time.strftime("%H:%M:%S", time.localtime(log['timestamp']))
             if log['type'] == 'request':
-                line = f"[{timestamp}] ЗАПРОС {log['provider']}:\n📤 {log['user_message']}\n"
-                self.all_logs_text.insert(tk.END, line)
-                log_content += line
+                parts.append(f"[{timestamp}] ЗАПРОС {log['provider']}:\n📤 {log['user_message']}\n")
             else:
-                line = f"[{timestamp}] ОТВЕТ {log['provider']}:\n📥 {log['response']}\nТокены: {log['input_tokens']}+{log['output_tokens']}\n"
-                self.all_logs_text.insert(tk.END, line)
-                log_content += line
-            separator = "-" * 50 + "\n"
-            self.all_logs_text.insert(tk.END, separator)
-            log_content += separator
-
-        self.all_logs_text.config(state=tk.DISABLED)
+                parts.append(f"[{timestamp}] ОТВЕТ {log['provider']}:\n📥 {log['response']}\nТокены: {log['input_tokens']}+{log['output_tokens']}\n")
+            parts.append(self.LOG_SEPARATOR + "\n")
+        log_content = "".join(parts)
+        self.append_to_pane(self.all_logs_text, log_content, newest_first=False)
 
         # Сохранение в файл, если чекбокс активен
         if self.save_logs_to_file.get():
@@ -2,18 +2,18 @@ from openai import AsyncOpenAI
 import asyncio
 import aiohttp
 import json
-import httpx
 import base64
 import uuid
 import time
 from config import config as Config
+from utils.http_pool import http_pool
 import logging
 
 logger = logging.getLogger(__name__)
 
 class GigaChatProvider:
-    def __init__(self):
-        provider_config = Config.get_provider_config("gigachat")
+    def __init__(self, provider_config=None):
+        provider_config = Config.get_provider_config("gigachat") if provider_config is None else provider_config
         self.api_key = provider_config.get("api_key", "")
         self.base_url = provider_config.get("base_url", "https://gigachat.devices.sberbank.ru/api/v1")
         self.auth_url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
@@ -50,12 +50,16 @@ class GigaChatProvider:
         self._initialize_client()
 
     def _initialize_client(self):
-        """Initialize or reinitialize the OpenAI client with current token"""
-        if self.access_token:
+        """Initialize the OpenAI client or update its token (the HTTP transport is shared)"""
+        if self.access_token and self.client is not None:
+            self.client.api_key = self.access_token
+        elif self.access_token:
             self.client = AsyncOpenAI(
                 api_key=self.access_token,
                 base_url=self.base_url,
-                http_client=httpx.AsyncClient(verify=False)
+                http_client=http_pool.get_client("gigachat", verify=False),
+                timeout=http_pool.get_timeout("gigachat"),
+                max_retries=0
             )
         else:
             self.client = None
@@ -138,8 +142,9 @@ class GigaChatProvider:
             logger.error(f"Error fetching models: {e}")
             return []
 
-    async def chat_completion(self, messages, **kwargs):
+    async def chat_completion(self, messages, model=None, **kwargs):
         """Выполнить чат-запрос к GigaChat"""
+        model = model or self.model
         try:
             # Ensure we have a valid access token
             token = await self._get_access_token()
@@ -154,10 +159,10 @@ class GigaChatProvider:
             ]
             filtered_kwargs = {k: v for k, v in kwargs.items() if k in supported_params and v is not None}
 
-            logger.info(f"Calling GigaChat with model: {self.model}")
+            logger.info(f"Calling GigaChat with model: {model}")
             
             response = await self.client.chat.completions.create(
-                model=self.model,
+                model=model,
                 messages=messages,
                 **filtered_kwargs
             )
@@ -173,7 +178,7 @@ class GigaChatProvider:
                 if token and self.client:
                     try:
                         response = await self.client.chat.completions.create(
-                            model=self.model,
+                            model=model,
                             messages=messages,
                             **filtered_kwargs
                         )
@@ -1,22 +1,107 @@
 from openai import AsyncOpenAI
+from providers.sse import open_sse_stream
 from config import config as Config
+from utils.http_pool import http_pool
+from utils.backend_pool import BackendPool, PooledStream
 
 class LocalProvider:
-    def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key="dummy-key",  # Для локальной модели не нужен реальный ключ
-            base_url="http://localhost:10003/v1"
-        )
-        self.model = "gpt-oss-120b"  # Имя модели из llama-server
-
-    async def chat_completion(self, messages, **kwargs):
+    def __init__(self, provider_config=None):
+        provider_config = Config.get_provider_config("local") if provider_config is None else provider_config
+        self.base_url = provider_config.get("base_url", "http://localhost:10003/v1")
+        self.api_key = provider_config.get("api_key") or "dummy-key"  # Для локальной модели не нужен реальный ключ
+        self.clients = {}  # Один клиент на каждый base_url (модели могут жить на разных llama-server)
+        # Несколько llama-server с одной моделью: разговоры распределяются с привязкой к бэкенду
+        self.pool = None
+        if provider_config.get("backends"):
+            self.pool = BackendPool.from_config(provider_config["backends"], provider_config.get("backend_pool", {}))
+        # Имя модели из llama-server (первая модель в настройках)
+        models = provider_config.get("models", [])
+        self.model = models[0]["name"] if models else "gpt-oss-120b"
+
+    @property
+    def client(self):
+        """Клиент base_url провайдера; создается при первом обращении внутри event loop, а не при импорте"""
+        return self._get_client(None)
+
+    def _get_client(self, model, spec=None):
+        return self._client_for(self._model_spec(model, spec).base_url or self.base_url)
+
+    def _model_spec(self, model, spec=None):
+        # spec - ModelSpec из снимка настроек запроса (model_spec); без него - из текущего реестра
+        return spec or Config.get_model_registry().model("local", model)
+
+    def _client_for(self, base_url):
+        client = self.clients.get(base_url)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=base_url,
+                http_client=http_pool.get_client("local"),
+                timeout=http_pool.get_timeout("local"),
+                max_retries=0
+            )
+            self.clients[base_url] = client
+        return client
+
+    async def chat_completion(self, messages, model=None, **kwargs):
+        model = model or self.model
         # Фильтрация параметров для локальной модели
         supported_params = ['temperature', 'max_tokens', 'stream', 'top_p', 'frequency_penalty', 'presence_penalty', 'stop', 'tools', 'tool_choice']
         filtered_kwargs = {k: v for k, v in kwargs.items() if k in supported_params and v is not None}
-        
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            **filtered_kwargs
-        )
-        return response
\ No newline at end of file
+
+        lease = self._acquire_backend(model, messages, kwargs.get("model_spec"))
+        if lease is None:
+            return await self._get_client(model, kwargs.get("model_spec")).chat.completions.create(
+                model=model,
+                messages=messages,
+                **filtered_kwargs
+            )
+        try:
+            response = await self._client_for(lease.backend.url).chat.completions.create(
+                model=model,
+                messages=messages,
+                extra_body=self._cache_hints(lease),
+                **filtered_kwargs
+            )
+        except BaseException as e:
+            lease.release(e)
+            raise
+        if filtered_kwargs.get("stream"):
+            return PooledStream(response, lease)
+        lease.release()
+        return response
+
+    async def chat_completion_raw(self, messages, model=None, **kwargs):
+        """Streaming запрос с ретрансляцией сырых SSE кадров upstream (без парсинга чанков)"""
+        model = model or self.model
+        supported_params = ['temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty', 'stop', 'tools', 'tool_choice', 'stream_options']
+        filtered_kwargs = {k: v for k, v in kwargs.items() if k in supported_params and v is not None}
+
+        body = {"model": model, "messages": messages, "stream": True, **filtered_kwargs}
+        lease = self._acquire_backend(model, messages, kwargs.get("model_spec"))
+        if lease is None:
+            return await open_sse_stream(self._get_client(model, kwargs.get("model_spec")), body)
+        body.update(self._cache_hints(lease))
+        try:
+            frames = await open_sse_stream(self._client_for(lease.backend.url), body)
+        except BaseException as e:
+            lease.release(e)
+            raise
+        return PooledStream(frames, lease)
+
+    def _acquire_backend(self, model, messages, spec=None):
+        """Бэкенд из пула или None, если пула нет или у модели свой base_url"""
+        if self.pool is None or self._model_spec(model, spec).base_url:
+            return None
+        return self.pool.acquire(messages)
+
+    def _cache_hints(self, lease):
+        """Параметры llama-server для переиспользования KV-кэша промпта"""
+        hints = {"cache_prompt": True}
+        if lease.slot is not None:
+            hints["id_slot"] = lease.slot
+        return hints
+
+    async def aclose(self):
+        if self.pool is not None:
+            await self.pool.aclose()
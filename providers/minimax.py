@@ -1,23 +1,40 @@
 from openai import AsyncOpenAI
 import asyncio
 from config import config as Config
+from utils.http_pool import http_pool
 import time
 from typing import AsyncGenerator, Dict, Any
 
 
 class MiniMaxProvider:
-    def __init__(self):
-        provider_config = Config.get_provider_config("minimax")
+    def __init__(self, provider_config=None):
+        provider_config = Config.get_provider_config("minimax") if provider_config is None else provider_config
         self.api_key = provider_config.get("api_key", "")
         self.base_url = provider_config.get("base_url", "https://api.minimax.io/v1")
-        # OpenAI-compatible client
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url
-        )
+        # OpenAI-compatible clients, one per base_url
+        self.clients = {}
         # Get first model from settings
         models = provider_config.get("models", [])
         self.model = models[0]["name"] if models else "MiniMax-M2.7"
+
+    @property
+    def client(self):
+        return self._get_client(None)
+
+    def _get_client(self, model, spec=None):
+        spec = spec or Config.get_model_registry().model("minimax", model)
+        base_url = spec.base_url or self.base_url
+        client = self.clients.get(base_url)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=base_url,
+                http_client=http_pool.get_client("minimax"),
+                timeout=http_pool.get_timeout("minimax"),
+                max_retries=0
+            )
+            self.clients[base_url] = client
+        return client
     
     class _MockChunk:
         """Mock chunk object with attributes and model_dump method."""
@@ -35,7 +52,8 @@ class MiniMaxProvider:
         def dict(self):
             return self._data
 
-    async def chat_completion(self, messages, **kwargs):
+    async def chat_completion(self, messages, model=None, **kwargs):
+        model = model or self.model
         # Extract system message if present (OpenAI format supports system role)
         # MiniMax likely supports system role directly, but we keep compatibility
         system = None
@@ -64,20 +82,20 @@ class MiniMaxProvider:
         
         if stream:
             # Return an async generator for streaming
-            return self._stream_response(api_messages, filtered_kwargs)
+            return self._stream_response(model, api_messages, filtered_kwargs, kwargs.get("model_spec"))
         else:
             # Non-streaming
-            response = await self.client.chat.completions.create(
-                model=self.model,
+            response = await self._get_client(model, kwargs.get("model_spec")).chat.completions.create(
+                model=model,
                 messages=api_messages,
                 **filtered_kwargs
             )
             return response
 
-    async def _stream_response(self, messages, filtered_kwargs) -> AsyncGenerator[Dict[str, Any], None]:
+    async def _stream_response(self, model, messages, filtered_kwargs, spec=None) -> AsyncGenerator[Dict[str, Any], None]:
         """Yield chunks in OpenAI-compatible format from MiniMax stream."""
-        stream = await self.client.chat.completions.create(
-            model=self.model,
+        stream = await self._get_client(model, spec).chat.completions.create(
+            model=model,
             messages=messages,
             stream=True,
             **filtered_kwargs
@@ -1,20 +1,40 @@
 from openai import AsyncOpenAI
+from providers.sse import open_sse_stream
 import asyncio
 from config import config as Config
+from utils.http_pool import http_pool
 
 class MoonshotProvider:
-    def __init__(self):
-        # Получаем base_url из конфигурации
-        moonshot_config = Config.get_provider_config("moonshot")
-        base_url = moonshot_config.get("base_url", "https://api.moonshot.ai/v1")
+    def __init__(self, provider_config=None):
+        moonshot_config = Config.get_provider_config("moonshot") if provider_config is None else provider_config
+        self.base_url = moonshot_config.get("base_url", "https://api.moonshot.ai/v1")
+        self.api_key = moonshot_config.get("api_key", "")
         
-        self.client = AsyncOpenAI(
-            api_key=Config.MOONSHOT_API_KEY,
-            base_url=base_url
-        )
-        self.model = Config.MOONSHOT_MODEL
+        self.clients = {}  # Один клиент на каждый base_url
+        models = moonshot_config.get("models", [])
+        self.model = models[0]["name"] if models else "kimi-k2-0711-preview"
 
-    async def chat_completion(self, messages, **kwargs):
+    @property
+    def client(self):
+        return self._get_client(None)
+
+    def _get_client(self, model, spec=None):
+        spec = spec or Config.get_model_registry().model("moonshot", model)
+        base_url = spec.base_url or self.base_url
+        client = self.clients.get(base_url)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=base_url,
+                http_client=http_pool.get_client("moonshot"),
+                timeout=http_pool.get_timeout("moonshot"),
+                max_retries=0
+            )
+            self.clients[base_url] = client
+        return client
+
+    def _build_request(self, messages, model=None, **kwargs):
+        model = model or self.model
         # Filter out unsupported parameters for Moonshot
         supported_params = ['temperature', 'max_tokens', 'stream', 'top_p', 'frequency_penalty', 'presence_penalty', 'stop', 'tools', 'tool_choice']
         filtered_kwargs = {k: v for k, v in kwargs.items() if k in supported_params and v is not None}
@@ -23,15 +43,15 @@ class MoonshotProvider:
         filtered_kwargs = {k: v for k, v in filtered_kwargs.items() if v is not None}
         
         # Специальная обработка для модели kimi-k2.5, которая поддерживает только temperature=1
-        if self.model == "kimi-k2.5" and "temperature" in filtered_kwargs:
+        if model == "kimi-k2.5" and "temperature" in filtered_kwargs:
             # Если передано temperature отличное от 1, либо убираем, либо устанавливаем 1
             if filtered_kwargs["temperature"] != 1.0:
-                print(f"Warning: Model {self.model} only supports temperature=1. Using temperature=1 instead of {filtered_kwargs['temperature']}")
+                print(f"Warning: Model {model} only supports temperature=1. Using temperature=1 instead of {filtered_kwargs['temperature']}")
                 filtered_kwargs["temperature"] = 1.0
         
         # Создаем базовый запрос
         request_data = {
-            "model": self.model,
+            "model": model,
             "messages": messages
         }
         
@@ -39,11 +59,28 @@ class MoonshotProvider:
         for param in supported_params:
             if param in filtered_kwargs:
                 request_data[param] = filtered_kwargs[param]
+        return request_data
+
+    async def chat_completion(self, messages, **kwargs):
+        request_data = self._build_request(messages, **kwargs)
         
         try:
-            response = await self.client.chat.completions.create(**request_data)
+            response = await self._get_client(request_data["model"], kwargs.get("model_spec")).chat.completions.create(**request_data)
             return response
         except Exception as e:
             # Логируем ошибку для диагностики
             print(f"Moonshot API error: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    async def chat_completion_raw(self, messages, **kwargs):
+        """Streaming запрос с ретрансляцией сырых SSE кадров upstream (без парсинга чанков)"""
+        request_data = self._build_request(messages, **kwargs)
+        request_data["stream"] = True
+        if kwargs.get("stream_options"):
+            request_data["stream_options"] = kwargs["stream_options"]
+
+        try:
+            return await open_sse_stream(self._get_client(request_data["model"], kwargs.get("model_spec")), request_data)
+        except Exception as e:
+            print(f"Moonshot API error: {e}")
+            raise
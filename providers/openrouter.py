@@ -3,13 +3,14 @@ import asyncio
 import aiohttp
 import json
 from config import config as Config
+from utils.http_pool import http_pool
 import logging
 
 logger = logging.getLogger(__name__)
 
 class OpenRouterProvider:
-    def __init__(self):
-        provider_config = Config.get_provider_config("openrouter")
+    def __init__(self, provider_config=None):
+        provider_config = Config.get_provider_config("openrouter") if provider_config is None else provider_config
         self.api_key = provider_config.get("api_key", "")
         self.base_url = provider_config.get("base_url", "https://openrouter.ai/api/v1")
         self.default_headers = {
@@ -17,15 +18,31 @@ class OpenRouterProvider:
             "X-Title": "proxy-llm",
             "User-Agent": "proxy-llm/1.0.0"
         }
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url,
-            default_headers=self.default_headers
-        )
+        self.clients = {}  # Один клиент на каждый base_url
         # Получаем первую модель из настроек
         models = provider_config.get("models", [])
         self.model = models[0]["name"] if models else "anthropic/claude-sonnet-4"
 
+    @property
+    def client(self):
+        return self._get_client(None)
+
+    def _get_client(self, model, spec=None):
+        spec = spec or Config.get_model_registry().model("openrouter", model)
+        base_url = spec.base_url or self.base_url
+        client = self.clients.get(base_url)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=base_url,
+                default_headers=self.default_headers,
+                http_client=http_pool.get_client("openrouter"),
+                timeout=http_pool.get_timeout("openrouter"),
+                max_retries=0
+            )
+            self.clients[base_url] = client
+        return client
+
     async def get_models(self):
         """Получить список доступных моделей от OpenRouter"""
         try:
@@ -42,7 +59,8 @@ class OpenRouterProvider:
             logger.error(f"Error fetching models: {e}")
             return []
 
-    async def chat_completion(self, messages, **kwargs):
+    async def chat_completion(self, messages, model=None, **kwargs):
+        model = model or self.model
         # Поддерживаемые параметры для OpenRouter
         supported_params = [
             'temperature', 'max_tokens', 'stream', 'top_p', 'frequency_penalty',
@@ -55,8 +73,8 @@ class OpenRouterProvider:
         # Вместо этого будем рассчитывать usage на стороне сервера
 
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
+            response = await self._get_client(model, kwargs.get("model_spec")).chat.completions.create(
+                model=model,
                 messages=messages,
                 **filtered_kwargs
             )
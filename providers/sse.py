@@ -0,0 +1,105 @@
+import json
+from openai import AsyncOpenAI
+
+# Разделители SSE кадров (спецификация допускает и \r\n)
+FRAME_SEPARATORS = (b"\n\n", b"\r\n\r\n")
+DONE_DATA = b"[DONE]"
+CONTENT_KEY = b'"content":'
+USAGE_KEY = b'"usage":'
+
+_decoder = json.JSONDecoder()
+
+
+async def open_sse_stream(client: AsyncOpenAI, body):
+    """Открыть streaming запрос к /chat/completions и вернуть итератор сырых SSE кадров.
+
+    Запрос отправляет сам SDK (with_raw_response): заголовки, таймауты
+    клиента и ошибки статуса те же, что при обычном вызове, но тело ответа
+    не разбирается на чанки. Соединение и проверка статуса выполняются сразу,
+    чтобы ошибки upstream возникали до начала ответа клиенту.
+    """
+    params = dict(body)
+    response = await client.chat.completions.with_raw_response.create(
+        model=params.pop("model"),
+        messages=params.pop("messages"),
+        stream=True,
+        # Остальные параметры уходят в тело запроса как есть, включая неизвестные SDK
+        # (stream_options, cache_prompt и id_slot llama-server)
+        extra_body={key: value for key, value in params.items() if key != "stream"},
+        timeout=client.timeout,
+    )
+    return _iter_frames(response.http_response)
+
+
+async def _iter_frames(response):
+    """Нарезка байтового потока на SSE кадры (вместе с разделителем) без парсинга JSON"""
+    buffer = b""
+    try:
+        async for data in response.aiter_bytes():
+            buffer += data
+            while True:
+                end = -1
+                for separator in FRAME_SEPARATORS:
+                    pos = buffer.find(separator)
+                    if pos != -1 and (end == -1 or pos + len(separator) < end):
+                        end = pos + len(separator)
+                if end == -1:
+                    break
+                frame, buffer = buffer[:end], buffer[end:]
+                yield frame
+        if buffer.strip():
+            yield buffer + b"\n\n"
+    finally:
+        await response.aclose()
+
+
+def is_done_frame(frame):
+    """Кадр завершения стрима; по спецификации SSE пробел после "data:" необязателен"""
+    for line in frame.splitlines():
+        if line.startswith(b"data:"):
+            value = line[5:]
+            return (value[1:] if value.startswith(b" ") else value) == DONE_DATA
+    return False
+
+
+def extract_delta_content(frame):
+    """Быстро достать delta.content из кадра без полного разбора JSON.
+
+    Внутри JSON-строк кавычки экранированы, поэтому '"content":' может
+    встретиться только как ключ (ключ reasoning_content сюда не попадает).
+    """
+    pos = frame.find(CONTENT_KEY)
+    if pos == -1:
+        return ""
+    text = frame[pos + len(CONTENT_KEY):].decode("utf-8", errors="ignore").lstrip()
+    if not text.startswith('"'):
+        return ""  # content: null
+    try:
+        value, _ = _decoder.raw_decode(text)
+    except ValueError:
+        return ""
+    return value if isinstance(value, str) else ""
+
+
+def extract_usage(frame):
+    """usage из кадра upstream и признак наличия в кадре choices.
+
+    JSON разбирается только у кадров с непустым usage (последний кадр при
+    stream_options.include_usage), остальные отсеиваются поиском подстроки.
+    Возвращает (usage или None, есть ли в кадре choices).
+    """
+    pos = frame.find(USAGE_KEY)
+    if pos == -1 or frame[pos + len(USAGE_KEY):].lstrip().startswith(b"null"):
+        return None, True
+    start = frame.find(b"data:")
+    try:
+        payload = json.loads(frame[start + 5:] if start != -1 else frame)
+    except ValueError:
+        return None, True
+    if not isinstance(payload, dict):
+        return None, True
+    choices = payload.get("choices") or []
+    usage = payload.get("usage")
+    if not usage and choices and isinstance(choices[0], dict):
+        usage = choices[0].get("usage")  # Moonshot кладет usage в последний choice
+    return usage or None, bool(choices)
@@ -1,28 +1,56 @@
 from openai import AsyncOpenAI
+from providers.sse import open_sse_stream
 import asyncio
 from config import config as Config
+from utils.http_pool import http_pool
 
 class XAIProvider:
-    def __init__(self):
-        provider_config = Config.get_provider_config("xai")
+    def __init__(self, provider_config=None):
+        provider_config = Config.get_provider_config("xai") if provider_config is None else provider_config
         self.api_key = provider_config.get("api_key", "")
         self.base_url = provider_config.get("base_url", "https://api.x.ai/v1")
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url
-        )
+        self.clients = {}  # Один клиент на каждый base_url
         # Получаем первую модель из настроек
         models = provider_config.get("models", [])
         self.model = models[0]["name"] if models else "grok-4"
 
-    async def chat_completion(self, messages, **kwargs):
+    @property
+    def client(self):
+        return self._get_client(None)
+
+    def _get_client(self, model, spec=None):
+        spec = spec or Config.get_model_registry().model("xai", model)
+        base_url = spec.base_url or self.base_url
+        client = self.clients.get(base_url)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=base_url,
+                http_client=http_pool.get_client("xai"),
+                timeout=http_pool.get_timeout("xai"),
+                max_retries=0
+            )
+            self.clients[base_url] = client
+        return client
+
+    async def chat_completion(self, messages, model=None, **kwargs):
+        model = model or self.model
         # Filter out unsupported parameters for xAI
         supported_params = ['temperature', 'max_tokens', 'stream', 'top_p', 'frequency_penalty', 'presence_penalty', 'stop', 'tools', 'tool_choice']
         filtered_kwargs = {k: v for k, v in kwargs.items() if k in supported_params and v is not None}
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
+        response = await self._get_client(model, kwargs.get("model_spec")).chat.completions.create(
+            model=model,
             messages=messages,
             **filtered_kwargs
         )
-        return response
\ No newline at end of file
+        return response
+
+    async def chat_completion_raw(self, messages, model=None, **kwargs):
+        """Streaming запрос с ретрансляцией сырых SSE кадров upstream (без парсинга чанков)"""
+        model = model or self.model
+        supported_params = ['temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty', 'stop', 'tools', 'tool_choice', 'stream_options']
+        filtered_kwargs = {k: v for k, v in kwargs.items() if k in supported_params and v is not None}
+
+        body = {"model": model, "messages": messages, "stream": True, **filtered_kwargs}
+        return await open_sse_stream(self._get_client(model, kwargs.get("model_spec")), body)
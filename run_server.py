@@ -48,12 +48,15 @@ async def lifespan(app):
                 model_names = [model["name"] for model in models]
                 logger.info(f"  {provider_name}: модели {', '.join(model_names)}")
     
-    yield
+    # Lifespan самого сервера (общий HTTP пул и т.п.)
+    async with server_lifespan(app):
+        yield
     
     # Код остановки
     logger.info("Завершение работы сервера...")
 
-# Добавляем lifespan к приложению
+# Добавляем lifespan к приложению, сохраняя lifespan из server.py
+server_lifespan = app.router.lifespan_context
 app.router.lifespan_context = lifespan
 
 def run_server():
@@ -1,4 +1,3 @@
-
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -6,17 +5,54 @@ from typing import List, Dict, Any, Optional, Union
 import time
 import logging
 import asyncio
+import inspect
+import anyio
+from fastapi.responses import StreamingResponse
 from providers.deepseek import DeepSeekProvider
 from providers.moonshot import MoonshotProvider
 from providers.local import LocalProvider
-from utils.token_counter import TokenCounter
+from providers.sse import is_done_frame, extract_delta_content, extract_usage
+from contextlib import asynccontextmanager
+from utils.token_counter import TokenCounter, parse_usage
+from utils.http_pool import http_pool
+from utils.model_router import ModelRouter
+from utils.response_cache import ResponseCache, completion_from_entry, replay_sse
+from utils.single_flight import SingleFlight
+from utils.log_store import LogStore
+from utils.metrics import Metrics
+from utils.retry import RetryPolicy, classify_retryable
+from utils.circuit_breaker import Failover
+from utils.concurrency import ConcurrencyLimits, QueueFullError, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from utils.rate_limiter import RateLimits, RateLimitWaitTooLong
+from utils.hedging import Hedging, prefetch_first_chunk
+from utils.adaptive_router import AdaptiveRouter
+from utils.overflow import OverflowPolicy
+from utils.model_registry import ModelRegistry
+from utils.tokenizer_registry import TokenizerRegistry
+from utils.settings_reload import SettingsSnapshot, SettingsReloader
 from config import config as Config
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """Жизненный цикл сервера: клиенты общего HTTP пула создаются первыми запросами
+    в event loop сервера (провайдеры не открывают их при импорте) и закрываются при остановке"""
+    if Config.get_tokenizer_config().get("preload", False):
+        token_counter.preload()  # В фоне: запуск не ждет загрузки токенизаторов
+    settings_reloader.start()
+    yield
+    await settings_reloader.aclose()
+    for provider in settings_snapshot.providers.values():
+        if hasattr(provider, "aclose"):
+            await provider.aclose()  # Фоновые задачи провайдеров (проверки бэкендов)
+    await http_pool.aclose()
+    token_counter.close()
+    logger.info("HTTP pool closed")
+
+app = FastAPI(lifespan=lifespan)
 
 # Middleware для логирования
 @app.middleware("http")
@@ -49,50 +85,246 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Провайдеры
-providers = {}
 provider_configs = Config.get_providers()
 
-for provider_name, provider_config in provider_configs.items():
-    if provider_config.get("enabled", False):
-        api_key = provider_config.get("api_key", "")
-        if provider_name == "deepseek" and api_key:
-            providers["deepseek"] = DeepSeekProvider()
-            logger.info("DeepSeek provider initialized")
-        elif provider_name == "moonshot" and api_key:
-            providers["moonshot"] = MoonshotProvider()
-            logger.info("Moonshot provider initialized")
-        elif provider_name == "local":
-            providers["local"] = LocalProvider()
-            logger.info("Local provider initialized")
-        elif provider_name == "xai" and api_key:
-            from providers.xai import XAIProvider
-            providers["xai"] = XAIProvider()
-            logger.info("xAI provider initialized")
-        elif provider_name == "openrouter" and api_key:
-            from providers.openrouter import OpenRouterProvider
-            providers["openrouter"] = OpenRouterProvider()
-            logger.info("OpenRouter provider initialized")
-        elif provider_name == "gigachat" and api_key:
-            from providers.gigachat import GigaChatProvider
-            providers["gigachat"] = GigaChatProvider()
-            logger.info("GigaChat provider initialized")
-        elif provider_name == "minimax" and api_key:
-            from providers.minimax import MiniMaxProvider
-            providers["minimax"] = MiniMaxProvider()
-            logger.info("MiniMax provider initialized")
-
-current_provider = Config.get_default_provider() if Config.get_default_provider() in providers else "local"
-token_counter = TokenCounter()
+def create_provider(provider_name, provider_config):
+    """Провайдер по настройкам или None, если он выключен или для него нет ключа.
+
+    Секция провайдера передается явно: снимок строится до применения новых настроек в Config.
+    """
+    if not provider_config.get("enabled", False):
+        return None
+    api_key = provider_config.get("api_key", "")
+    if provider_name == "deepseek" and api_key:
+        provider = DeepSeekProvider(provider_config)
+        logger.info("DeepSeek provider initialized")
+    elif provider_name == "moonshot" and api_key:
+        provider = MoonshotProvider(provider_config)
+        logger.info("Moonshot provider initialized")
+    elif provider_name == "local":
+        provider = LocalProvider(provider_config)
+        logger.info("Local provider initialized")
+    elif provider_name == "xai" and api_key:
+        from providers.xai import XAIProvider
+        provider = XAIProvider(provider_config)
+        logger.info("xAI provider initialized")
+    elif provider_name == "openrouter" and api_key:
+        from providers.openrouter import OpenRouterProvider
+        provider = OpenRouterProvider(provider_config)
+        logger.info("OpenRouter provider initialized")
+    elif provider_name == "gigachat" and api_key:
+        from providers.gigachat import GigaChatProvider
+        provider = GigaChatProvider(provider_config)
+        logger.info("GigaChat provider initialized")
+    elif provider_name == "minimax" and api_key:
+        from providers.minimax import MiniMaxProvider
+        provider = MiniMaxProvider(provider_config)
+        logger.info("MiniMax provider initialized")
+    else:
+        provider = None
+    return provider
+
+def provider_settings(settings, provider_name):
+    """Все, от чего зависит объект провайдера: его секция (из моделей - только имена) и общая секция http.
+
+    Цены, лимиты и base_url моделей провайдер читает из реестра моделей при
+    каждом вызове, поэтому их изменение не требует нового объекта провайдера.
+    """
+    provider_config = settings.get("providers", {}).get(provider_name)
+    if provider_config is None:
+        return None
+    return (
+        {key: value for key, value in provider_config.items() if key != "models"},
+        [model.get("name") for model in provider_config.get("models", [])],
+        settings.get("http"),
+    )
+
+def build_snapshot(previous=None, settings=None, model_registry=None):
+    """Снимок провайдеров и маршрутов из settings (по умолчанию - текущих настроек Config).
+
+    Снимок строится без изменения Config, поэтому новые настройки применяются
+    только вместе с готовым снимком. Провайдеры, настройки которых не
+    изменились с previous, переиспользуются вместе с клиентами и соединениями.
+    """
+    settings = Config.get_settings(settings)
+    model_registry = model_registry or Config.get_model_registry()
+    providers = {}
+    for provider_name, provider_config in Config.get_providers(settings).items():
+        if (previous is not None and provider_name in previous.providers
+                and provider_settings(previous.settings, provider_name) == provider_settings(settings, provider_name)):
+            providers[provider_name] = previous.providers[provider_name]
+            continue
+        provider = create_provider(provider_name, provider_config)
+        if provider is not None:
+            providers[provider_name] = provider
+    default_provider = Config.get_default_provider(settings) if Config.get_default_provider(settings) in providers else "local"
+    model_router = ModelRouter.build(Config.get_providers(settings), providers.keys(), default_provider)
+    return SettingsSnapshot(
+        version=previous.version + 1 if previous is not None else 1,
+        settings=settings,
+        model_registry=model_registry,
+        providers=providers,
+        model_router=model_router,
+        # Политики повторов временных ошибок upstream (секция "retry" в settings.json)
+        retry_policies={name: RetryPolicy.from_config(Config.get_retry_config(name, settings)) for name in providers},
+        # Алиасы с политиками выбора маршрута по EWMA замерам, цене и окну контекста
+        adaptive_router=AdaptiveRouter.from_config(
+            Config.get_routing_config(settings), model_registry, model_router, metrics),
+    )
+
+# Circuit breaker'ы провайдеров и переключение на запасные маршруты
+failover = Failover.from_config(Config.get_failover_config())
+# Лимиты одновременных запросов к провайдерам и моделям с очередью по приоритету
+concurrency_limits = ConcurrencyLimits.from_config(Config.get_concurrency_config(), provider_configs)
+# Клиентские квоты RPM/TPM провайдеров и моделей
+rate_limits = RateLimits.from_config(Config.get_rate_limit_config(), provider_configs)
+# Токенизаторы моделей из настроек; большие промпты токенизируются в пуле потоков, не останавливая event loop
+token_counter = TokenCounter.from_config(Config.get_tokenizer_config(), provider_configs)
 
 # Хранилище для логов запросов и ответов
-request_logs = []
-response_logs = []
-MAX_LOGS = 100  # Максимальное количество хранимых логов
+MAX_LOGS = Config.get_logging_config().get("max_logs", 100)  # Максимальное количество хранимых логов
+log_store = LogStore(MAX_LOGS)
 
 # Глобальная статистика стоимости
 total_cost = 0.0
 
+# Кэш ответов для повторяющихся детерминированных запросов
+response_cache = ResponseCache.from_config(Config.get_cache_config())
+
+# Объединение одновременных одинаковых запросов
+single_flight = SingleFlight.from_config(Config.get_single_flight_config())
+
+# Метрики для /metrics (счетчики и гистограммы задержек по provider/model)
+metrics = Metrics(ewma_alpha=Config.get_routing_config().get("ewma_alpha", 0.2))
+# Дублирование медленных стримов на запасной маршрут (задержка - перцентиль TTFT)
+hedging = Hedging(metrics)
+# Local-first: избыток запросов к перегруженному локальному бэкенду уходит в облако
+overflow = OverflowPolicy.from_config(Config.get_overflow_config(), metrics)
+
+# Провайдеры, маршруты и реестр моделей; при перезагрузке settings.json снимок подменяется целиком
+settings_snapshot = build_snapshot()
+current_provider = Config.get_default_provider() if Config.get_default_provider() in settings_snapshot.providers else "local"
+
+# Секции, которые читаются только при запуске: их изменение требует перезапуска
+RESTART_SECTIONS = ("server", "logging", "cache", "single_flight", "rate_limit", "concurrency", "failover")
+
+def load_settings_file(path):
+    """Прочитать, проверить и подготовить новые настройки (выполняется в пуле потоков)"""
+    settings = Config.read_settings(path)
+    model_registry = ModelRegistry.from_config(settings["providers"], settings.get("max_tokens", 8000))
+    return settings, model_registry
+
+def apply_settings(prepared):
+    """Построить снимок из новых настроек и подменить текущий; при ошибке настройки не меняются"""
+    global settings_snapshot, current_provider
+    settings, model_registry = prepared
+    previous = settings_snapshot
+    # Все строится до применения: Config и снимок подменяются вместе, без await между ними
+    snapshot = build_snapshot(previous, settings, model_registry)
+    tokenizer_config = Config.get_tokenizer_config(settings)
+    tokenizer_registry = TokenizerRegistry.from_config(tokenizer_config, Config.get_providers(settings))
+    tokenizer_registry.inherit(token_counter.registry)
+    # Неверные пороги overflow отклоняют перезагрузку целиком (update проверяет все до изменения)
+    overflow_config = Config.get_overflow_config(settings)
+    if overflow_config != previous.settings.get("overflow"):
+        overflow.update({name: overflow_config[name] for name in OverflowPolicy.SETTINGS if name in overflow_config})
+
+    Config.apply_settings(settings, model_registry)
+    settings_snapshot = snapshot
+    token_counter.registry = tokenizer_registry
+    # Лимиты провайдеров и моделей проверены в read_settings; занятые слоты и уровни квот сохраняются
+    concurrency_limits.update(Config.get_providers(settings))
+    rate_limits.update(Config.get_providers(settings))
+    if tokenizer_config != previous.settings.get("tokenizer"):
+        token_counter.update(**{name: tokenizer_config[name] for name in TokenCounter.SETTINGS if name in tokenizer_config})
+    if tokenizer_config.get("preload", False):
+        token_counter.preload()  # Загружаются только новые спецификации, остальные взяты из прежнего реестра
+    routing_config = Config.get_routing_config()
+    if routing_config.get("ewma_alpha", 0.2) != metrics.ewma_alpha:
+        metrics.set_ewma_alpha(routing_config.get("ewma_alpha", 0.2))
+    settings_reloader.update(Config.get_reload_config())
+    if settings.get("default_provider") != previous.settings.get("default_provider") or current_provider not in snapshot.providers:
+        current_provider = Config.get_default_provider() if Config.get_default_provider() in snapshot.providers else "local"
+
+    # Запросы в работе держат старые объекты провайдеров; закрываются только их фоновые задачи.
+    # HTTP клиенты прежних настроек http закрываются, когда эти запросы завершатся
+    replaced = [name for name, provider in previous.providers.items() if snapshot.providers.get(name) is not provider]
+    for name in replaced:
+        if hasattr(previous.providers[name], "aclose"):
+            asyncio.ensure_future(previous.providers[name].aclose())
+    if replaced:
+        http_pool.retire_unused(snapshot.providers.keys())
+    return {
+        "version": snapshot.version,
+        "added": [name for name in snapshot.providers if name not in previous.providers],
+        "removed": [name for name in previous.providers if name not in snapshot.providers],
+        "rebuilt": [name for name in replaced if name in snapshot.providers],
+        "reused": [name for name, provider in snapshot.providers.items() if previous.providers.get(name) is provider],
+        "restart_required": [
+            section for section in RESTART_SECTIONS if settings.get(section) != previous.settings.get(section)
+        ],
+    }
+
+# Перезагрузка settings.json: по изменению файла и через POST /admin/reload
+settings_reloader = SettingsReloader.from_config(
+    Config.get_reload_config(), Config.get_settings_path(), load_settings_file, apply_settings
+)
+
+def save_response_log(response_log):
+    log_store.add_response(response_log)
+
+async def close_upstream(response):
+    """Закрыть стрим upstream, чтобы бэкенд сразу освободил слот генерации"""
+    try:
+        if hasattr(response, "aclose"):
+            await response.aclose()  # Итератор SSE кадров или async generator провайдера
+        elif hasattr(getattr(response, "response", None), "aclose"):
+            await response.response.aclose()  # AsyncStream из OpenAI SDK
+    except Exception as e:
+        logger.error(f"Error closing upstream stream: {e}")
+
+class ManagedStreamingResponse(StreamingResponse):
+    """StreamingResponse, который освобождает ресурсы стрима при любом завершении ответа.
+
+    Если клиент отключился до первого чанка, starlette отменяет отправку, не
+    начав итерацию тела, и finally генераторов не выполняется. Поэтому
+    ресурсы (соединение с upstream, слот, замер, удержание HTTP пула)
+    освобождают обработчики on_close: они вызываются один раз после
+    закрытия итератора тела, в обратном порядке регистрации.
+    """
+
+    def __init__(self, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = []
+
+    def on_close(self, callback):
+        """callback - функция или корутинная функция без аргументов"""
+        self._on_close.append(callback)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Освобождение не должно прерываться отменой запроса
+            with anyio.CancelScope(shield=True):
+                await self.aclose()
+
+    async def aclose(self):
+        """Закрыть тело и вызвать on_close (ответ, чье тело читает фоновая задача, закрывает она)"""
+        callbacks, self._on_close = self._on_close, []
+        try:
+            if hasattr(self.body_iterator, "aclose"):
+                await self.body_iterator.aclose()
+        except Exception as e:
+            logger.error(f"Error closing stream body: {e}")
+        for callback in reversed(callbacks):
+            try:
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error releasing stream resources: {e}")
+
 class ChatMessage(BaseModel):
     role: str
     content: Union[str, List[Dict[str, Any]], Dict[str, Any]]  # Поддержка всех типов content
@@ -148,7 +380,7 @@ async def health():
 async def test():
     """Быстрый тест провайдера"""
     try:
-        provider = providers[current_provider]
+        provider = settings_snapshot.providers[current_provider]
         messages = [{"role": "user", "content": "test"}]
         response = await provider.chat_completion(messages, max_tokens=5)
         return {"status": "ok", "response": response.choices[0].message.content}
@@ -157,11 +389,172 @@ async def test():
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: ChatCompletionRequest):
+    # Одновременные одинаковые запросы разделяют один вызов upstream
+    body = request.model_dump(exclude_none=True) if hasattr(request, 'model_dump') else request.dict(exclude_none=True)
+    if not single_flight.is_eligible(body):
+        return await run_chat_completion(request)
+    
+    flight_key = single_flight.make_key(body, current_provider)
+    flight = single_flight.join(flight_key)
+    if flight is not None:
+        logger.info(f"Joining in-flight request {flight_key[:12]} ({flight.followers} followers)")
+        if request.stream:
+            await flight.wait_started()
+            return subscriber_response(flight)
+        return await flight.wait()
+    
+    flight = single_flight.start(flight_key)
+    try:
+        response = await run_chat_completion(request)
+    except BaseException as e:
+        # Отмена лидера тоже должна освободить ключ и разбудить подписчиков
+        single_flight.forget(flight)
+        if not isinstance(e, Exception):
+            e = HTTPException(status_code=503, detail="Shared request was cancelled")
+        flight.set_error(e)
+        raise
+    
+    if isinstance(response, ManagedStreamingResponse):
+        # Стрим читает фоновая задача (учет стоимости выполняется один раз),
+        # а каждый клиент, включая лидера, получает кадры из своей очереди
+        single_flight.spawn_stream(flight, response.body_iterator, response.aclose)
+        return subscriber_response(flight)
+    
+    single_flight.forget(flight)
+    flight.set_result(response)
+    return response
+
+def subscriber_response(flight):
+    """Стрим общего вызова для одного клиента; клиент, ушедший до первого кадра, тоже отписывается"""
+    queue = flight.subscribe()
+    response = ManagedStreamingResponse(flight.read(queue), media_type="text/event-stream")
+    response.on_close(lambda: flight.unsubscribe(queue))
+    return response
+
+async def run_chat_completion(request):
+    """process_chat_completion, который удерживает клиенты HTTP пула до конца ответа, включая стрим"""
+    # Поколение пула берется в том же шаге event loop, что и снимок настроек в process_chat_completion
+    generation = http_pool.hold()
+    try:
+        response = await process_chat_completion(request)
+    except BaseException:
+        http_pool.release(generation)
+        raise
+    if isinstance(response, ManagedStreamingResponse):
+        response.on_close(lambda: http_pool.release(generation))
+    else:
+        http_pool.release(generation)
+    return response
+
+def build_provider_kwargs(request, model_name, spec):
+    """Параметры вызова провайдера для маршрута (spec - ModelSpec модели из реестра)"""
+    kwargs = {"max_tokens": spec.max_tokens}
+    if request.max_tokens:
+        kwargs["max_tokens"] = request.max_tokens
+    if request.temperature is not None:
+        kwargs["temperature"] = request.temperature
+    
+    kwargs["model"] = model_name
+    
+    # Передаем инструменты, если они есть
+    if request.tools is not None:
+        kwargs["tools"] = request.tools
+    if request.tool_choice is not None:
+        kwargs["tool_choice"] = request.tool_choice
+    
+    # Автоматически включаем стриминг для больших max_tokens (чтобы избежать ошибки Anthropic SDK)
+    # Для провайдеров Anthropic и совместимых (minimax) стриминг требуется для запросов > 100000 токенов
+    max_tokens_value = kwargs.get("max_tokens", 4096)
+    
+    # Проверяем, нужно ли автоматически включить стриминг
+    auto_stream = False
+    if spec.provider_type == "anthropic" and max_tokens_value > 100000:
+        auto_stream = True
+        logger.info(f"Auto-enabling streaming for large max_tokens ({max_tokens_value}) with Anthropic provider")
+    
+    if request.stream or auto_stream:
+        kwargs["stream"] = True
+        # Точный usage от upstream в последнем кадре стрима вместо локального подсчета токенов
+        if spec.stream_usage:
+            kwargs["stream_options"] = {"include_usage": True}
+    # Модель, для которой в настройках перечислены supported_params, получает только их
+    if spec.supported_params is not None:
+        kwargs = {
+            name: value for name, value in kwargs.items()
+            if name in ("model", "stream", "stream_options") or name in spec.supported_params
+        }
+    return kwargs
+
+def provider_call_factory(provider, spec, messages, kwargs):
+    """Фабрика вызова провайдера и признак ретрансляции сырых SSE кадров"""
+    # Для OpenAI-совместимых провайдеров стрим ретранслируется сырыми SSE кадрами
+    passthrough = (
+        kwargs.get("stream", False)
+        and hasattr(provider, "chat_completion_raw")
+        and spec.sse_passthrough
+    )
+    # base_url и прочие параметры модели провайдер берет из спецификации снимка настроек запроса
+    if passthrough:
+        make_call = lambda: asyncio.wait_for(
+            provider.chat_completion_raw(messages, model_spec=spec, **kwargs),
+            timeout=120.0
+        )
+    else:
+        make_call = lambda: asyncio.wait_for(
+            provider.chat_completion(messages, model_spec=spec, **kwargs),
+            timeout=120.0  # Увеличиваем таймаут для локальной модели
+        )
+    return make_call, passthrough
+
+async def process_chat_completion(request: ChatCompletionRequest):
     logger.info("=== START PROCESSING ===")
     logger.info(f"Model requested: {request.model}")
     logger.info(f"Messages count: {len(request.messages) if request.messages else 0}")
     logger.info(f"Stream: {request.stream}")
     logger.info(f"Current provider: {current_provider}")
+    # Один снимок настроек на весь запрос, включая запасные маршруты: перезагрузка
+    # settings.json не меняет провайдеров и маршруты уже идущего запроса
+    snapshot = settings_snapshot
+    providers, model_router, model_registry = snapshot.providers, snapshot.model_router, snapshot.model_registry
+    retry_policies, adaptive_router = snapshot.retry_policies, snapshot.adaptive_router
+    
+    # Алиас адаптивного роутера: маршрут выбирается по живым замерам, цене и окну контекста,
+    # иначе - маршрутизация по имени модели; неизвестные модели идут на текущий провайдер
+    routing_policy = adaptive_router.policy(request.model)
+    ranked_routes = None
+    if routing_policy is not None:
+        prompt_tokens = await token_counter.count_messages_async(
+            [msg.model_dump(exclude_none=True) for msg in request.messages or []], *routing_policy.candidates[0][:2])
+        ranked_routes = adaptive_router.rank(
+            routing_policy, prompt_tokens, request.max_tokens,
+            available=lambda name, model: name in providers and failover.is_available(name)
+        )
+        if not ranked_routes:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Prompt of {prompt_tokens} tokens does not fit the context window of any model behind '{request.model}'"
+            )
+        provider_name, model_name = ranked_routes[0]
+        logger.info(f"Routing policy '{routing_policy.policy}' for '{request.model}' chose {provider_name}/{model_name}")
+    else:
+        provider_name, model_name = model_router.resolve(request.model, current_provider)
+    if provider_name not in providers:
+        raise HTTPException(status_code=400, detail=f"Provider {provider_name} not found")
+    if model_name is None:
+        model_name = providers[provider_name].model
+    
+    # Локальный бэкенд не справляется (очередь, TTFT, число запросов): запрос уходит
+    # на облачный маршрут overflow.to, а локальный остается запасным
+    spilled_from = None
+    overflow_reason = overflow.check(provider_name, model_name)
+    if overflow_reason is not None:
+        overflow_route = model_router.routes.get(overflow.to)
+        if (overflow_route is not None and overflow_route[0] in providers
+                and overflow_route[0] != provider_name and failover.is_available(overflow_route[0])):
+            spilled_from = (provider_name, model_name)
+            provider_name, model_name = overflow_route
+            overflow.record_spill(spilled_from, overflow_route, overflow_reason)
+    logger.info(f"Routed to provider: {provider_name}, model: {model_name}")
     
     # Сохраняем запрос в лог
     user_message = ""
@@ -180,26 +573,20 @@ async def chat_completions(request: ChatCompletionRequest):
     
     request_log = {
         "timestamp": time.time(),
-        "provider": current_provider,
+        "provider": provider_name,
+        "model": model_name,
         "user_message": user_message[:500] + "..." if len(user_message) > 500 else user_message,
         "messages_count": len(request.messages) if request.messages else 0,
         "stream": request.stream
     }
+    if spilled_from is not None:
+        request_log["overflow_from"] = "/".join(spilled_from)
+        request_log["overflow_reason"] = overflow_reason
     
-    global request_logs
-    request_logs.append(request_log)
-    if len(request_logs) > MAX_LOGS:
-        request_logs = request_logs[-MAX_LOGS:]
+    log_store.add_request(request_log)
+    request_metrics = metrics.start(provider_name, model_name)
     
     try:
-        provider = providers[current_provider]
-        logger.info(f"Using provider: {current_provider}")
-        
-        # Определяем тип провайдера (openai или anthropic)
-        provider_config = Config.get_provider_config(current_provider)
-        provider_type = provider_config.get("type", "openai")
-        logger.info(f"Provider type: {provider_type}")
-        
         # Обработка сообщений - сохраняем все поля для поддержки инструментов
         messages = []
         if request.messages:
@@ -252,41 +639,225 @@ async def chat_completions(request: ChatCompletionRequest):
         
         logger.info(f"Processed messages count: {len(messages)}")
         
-        # Параметры
-        kwargs = {"max_tokens": Config.get_model_max_tokens(current_provider)}
-        if request.max_tokens:
-            kwargs["max_tokens"] = request.max_tokens
-        if request.temperature is not None:
-            kwargs["temperature"] = request.temperature
-        
-        # Передаем инструменты, если они есть
-        if request.tools is not None:
-            kwargs["tools"] = request.tools
-        if request.tool_choice is not None:
-            kwargs["tool_choice"] = request.tool_choice
-        
-        # Автоматически включаем стриминг для больших max_tokens (чтобы избежать ошибки Anthropic SDK)
-        # Для провайдеров Anthropic и совместимых (minimax) стриминг требуется для запросов > 100000 токенов
-        max_tokens_value = kwargs.get("max_tokens", 4096)
-        provider_config = Config.get_provider_config(current_provider)
-        provider_type = provider_config.get("type", "openai")
-        
-        # Проверяем, нужно ли автоматически включить стриминг
-        auto_stream = False
-        if provider_type == "anthropic" and max_tokens_value > 100000:
-            auto_stream = True
-            logger.info(f"Auto-enabling streaming for large max_tokens ({max_tokens_value}) with Anthropic provider")
-        
-        if request.stream or auto_stream:
-            kwargs["stream"] = True
+        # Основной маршрут и запасные по цепочке fallback; провайдеры с открытым
+        # circuit breaker пропускаются без ожидания их таймаута
+        candidates = [(provider_name, model_name)]
+        if failover.enabled:
+            if spilled_from is not None:
+                candidates.append(spilled_from)  # Перегруженный локальный маршрут - запасной
+            more = ranked_routes if ranked_routes is not None else model_router.chain(request.model, current_provider)[1:]
+            candidates += [route for route in more if route not in candidates]
+        moved_from = []
+        last_error = None
+        response = None
+        for provider_name, model_name in candidates:
+            if provider_name not in providers:
+                continue
+            if moved_from:
+                request_metrics.reroute(provider_name, model_name)
+            provider = providers[provider_name]
+            spec = model_registry.model(provider_name, model_name)
+            provider_type = spec.provider_type
+            logger.info(f"Using provider: {provider_name}, type: {provider_type}")
+            
+            kwargs = build_provider_kwargs(request, model_name, spec)
+            
+            # Кэш ответов: повторный детерминированный запрос не идет к upstream и не стоит денег
+            cache_key = None
+            if response_cache.is_cacheable(kwargs):
+                cache_key = response_cache.make_key(provider_name, model_name, messages, kwargs)
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"Response cache hit: {cache_key[:12]}")
+                    save_response_log({
+                        "timestamp": time.time(),
+                        "provider": provider_name,
+                        "model": model_name,
+                        "response": cached["content"][:1000] + "..." if len(cached["content"]) > 1000 else cached["content"],
+                        "input_tokens": cached["input_tokens"],
+                        "output_tokens": cached["output_tokens"],
+                        "cost": 0.0,
+                        "cached": True
+                    })
+                    request_metrics.finish()
+                    if kwargs.get("stream", False):
+                        include_usage = bool(request.stream_options and request.stream_options.get("include_usage", False))
+                        return ManagedStreamingResponse(
+                            replay_sse(cached, request.model or model_name, include_usage),
+                            media_type="text/event-stream"
+                        )
+                    return completion_from_entry(cached, request.model or model_name)
+            
+            # Breaker проверяем после кэша, чтобы попадание в кэш не тратило пробный запрос
+            breaker = failover.breaker(provider_name)
+            if not breaker.allow():
+                logger.warning(f"Circuit open for {provider_name}, skipping")
+                moved_from.append(((provider_name, model_name), "circuit open"))
+                continue
+            
+            logger.info(f"Calling provider with {len(messages)} messages and kwargs: {kwargs}")
+            
+            # Вызов провайдера с повтором временных ошибок (429, 5xx, обрыв, таймаут).
+            # Для стрима повторяется только открытие соединения, до первого байта клиенту
+            make_call, passthrough = provider_call_factory(provider, spec, messages, kwargs)
+            
+            # Квота RPM/TPM: запрос плавно ждет свободной емкости, а не получает 429 от провайдера.
+            # Для TPM резервируется промпт + max_tokens, после ответа резерв сверяется с usage
+            estimated_tokens = 0
+            if rate_limits.counts_tokens(provider_name, model_name):
+                estimated_tokens = await token_counter.count_messages_async(messages, provider_name, model_name) + kwargs.get("max_tokens", 0)
+            try:
+                reservation = await rate_limits.acquire(provider_name, model_name, estimated_tokens)
+            except RateLimitWaitTooLong as e:
+                breaker.cancel_probe()
+                logger.warning(f"{e}, rejecting request")
+                request_metrics.fail("rate_limited")
+                raise HTTPException(
+                    status_code=503,
+                    detail=str(e),
+                    headers={"Retry-After": str(int(e.retry_after) + 1)}
+                )
             
-        logger.info(f"Calling provider with {len(messages)} messages and kwargs: {kwargs}")
+            # Слот провайдера: streaming запросы IDE обслуживаются раньше фоновых
+            queued_at = time.monotonic()
+            try:
+                lease = await concurrency_limits.acquire(
+                    provider_name, model_name,
+                    PRIORITY_INTERACTIVE if kwargs.get("stream", False) else PRIORITY_BACKGROUND
+                )
+            except QueueFullError as e:
+                reservation.reconcile(0)
+                breaker.cancel_probe()
+                logger.warning(f"{e}, rejecting request")
+                request_metrics.fail("overloaded")
+                raise HTTPException(
+                    status_code=503,
+                    detail=str(e),
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+            request_metrics.queued(time.monotonic() - queued_at)
+            
+            # Hedging: если основной маршрут долго молчит, стрим дублируется на запасной
+            hedge_config = spec.hedge if kwargs.get("stream", False) and not moved_from else None
+            hedge_route = model_router.routes.get(hedge_config.get("to")) if hedge_config else None
+            if hedge_route is not None and (hedge_route[0] not in providers or hedge_route[0] == provider_name):
+                hedge_route = None
+            hedge_hold = {}  # Квота и слот запасного маршрута, пока дубль их не отпустил
+            
+            def release_hedge():
+                if "lease" in hedge_hold:
+                    hedge_hold["lease"].release()
+                if "reservation" in hedge_hold:
+                    hedge_hold["reservation"].reconcile(0)
+            
+            started = time.monotonic()
+            try:
+                if hedge_route is None:
+                    response = await retry_policies[provider_name].call(
+                        make_call,
+                        on_retry=lambda reason, delay: request_metrics.retry(reason)
+                    )
+                else:
+                    hedge_provider_name, hedge_model_name = hedge_route
+                    hedge_provider = providers[hedge_provider_name]
+                    hedge_spec = model_registry.model(hedge_provider_name, hedge_model_name)
+                    hedge_kwargs = build_provider_kwargs(request, hedge_model_name, hedge_spec)
+                    hedge_call, hedge_passthrough = provider_call_factory(hedge_provider, hedge_spec, messages, hedge_kwargs)
+                    hedge_breaker = failover.breaker(hedge_provider_name)
+                    
+                    async def open_hedge():
+                        # Дубль проходит те же лимиты, что и обычный запрос к этому провайдеру,
+                        # и сам ведет breaker запасного маршрута: успех, ошибка или отмена пробы
+                        if not hedge_breaker.allow():
+                            raise RuntimeError(f"Circuit open for {hedge_provider_name}")
+                        hedge_started = None
+                        try:
+                            hedge_tokens = 0
+                            if rate_limits.counts_tokens(hedge_provider_name, hedge_model_name):
+                                hedge_tokens = await token_counter.count_messages_async(messages, hedge_provider_name, hedge_model_name) + hedge_kwargs.get("max_tokens", 0)
+                            hedge_hold["reservation"] = await rate_limits.acquire(hedge_provider_name, hedge_model_name, hedge_tokens)
+                            hedge_hold["lease"] = await concurrency_limits.acquire(hedge_provider_name, hedge_model_name, PRIORITY_INTERACTIVE)
+                            hedge_started = time.monotonic()
+                            stream = await retry_policies[hedge_provider_name].call(lambda: prefetch_first_chunk(hedge_call, close_upstream))
+                        except Exception as e:
+                            release_hedge()
+                            if hedge_started is None:
+                                hedge_breaker.cancel_probe()  # Лимиты не пустили дубль к провайдеру
+                            elif classify_retryable(e) is None:
+                                hedge_breaker.record_success(time.monotonic() - hedge_started)
+                            else:
+                                hedge_breaker.record_failure(e)
+                            raise
+                        except BaseException:
+                            release_hedge()
+                            hedge_breaker.cancel_probe()
+                            raise
+                        hedge_breaker.record_success(time.monotonic() - hedge_started)
+                        return stream
+                    
+                    winner, response = await hedging.race(
+                        f"{provider_name}/{model_name}",
+                        lambda: retry_policies[provider_name].call(
+                            lambda: prefetch_first_chunk(make_call, close_upstream),
+                            on_retry=lambda reason, delay: request_metrics.retry(reason)
+                        ),
+                        open_hedge,
+                        hedging.delay(provider_name, model_name, hedge_config),
+                        close_upstream
+                    )
+                    if winner == 1:
+                        # Ответ идет от запасного маршрута: слот и квота основного больше не нужны,
+                        # а стрим дальше держит слот и квоту запасного
+                        logger.info(f"Hedge won: {hedge_provider_name}/{hedge_model_name}")
+                        lease.release()
+                        reservation.reconcile(0)
+                        breaker.cancel_probe()
+                        breaker = None  # Исход запасного маршрута уже записан в open_hedge
+                        lease, reservation = hedge_hold["lease"], hedge_hold["reservation"]
+                        provider_name, model_name = hedge_route
+                        provider, spec, kwargs, passthrough = hedge_provider, hedge_spec, hedge_kwargs, hedge_passthrough
+                        provider_type = spec.provider_type
+                        request_metrics.reroute(provider_name, model_name)
+                    else:
+                        release_hedge()  # Проигравший дубль отменен или его стрим уже закрыт
+            except Exception as e:
+                lease.release()
+                reservation.reconcile(0)
+                release_hedge()
+                if classify_retryable(e) is None:
+                    # Провайдер ответил, ошибка в самом запросе: переключение не поможет
+                    breaker.record_success(time.monotonic() - started)
+                    raise
+                breaker.record_failure(e)
+                request_metrics.upstream_error()
+                logger.warning(f"Provider {provider_name} failed: {e}")
+                moved_from.append(((provider_name, model_name), str(e)[:200]))
+                last_error = e
+                continue
+            except BaseException:
+                # Клиент отключился во время ожидания ответа: исход неизвестен,
+                # поэтому пробный запрос breaker не засчитывается ни успехом, ни ошибкой
+                lease.release()
+                reservation.reconcile(0)
+                release_hedge()
+                breaker.cancel_probe()
+                raise
+            if breaker is not None:
+                breaker.record_success(time.monotonic() - started)
+            break
+            
+        # Журнал переключений: почему трафик ушел с маршрута и куда
+        served = (provider_name, model_name) if response is not None else None
+        for route, reason in moved_from:
+            failover.record_event(request.model, route, served, reason)
+        if response is None:
+            if last_error is not None:
+                raise last_error
+            raise HTTPException(status_code=503, detail="All providers for this model are unavailable (circuit open)")
         
-        # Вызов провайдера
-        response = await asyncio.wait_for(
-            provider.chat_completion(messages, **kwargs),
-            timeout=120.0  # Увеличиваем таймаут для локальной модели
-        )
+        # Обычный ответ уже получен целиком; слот стрима освобождается по его завершении
+        if not kwargs.get("stream", False):
+            lease.release()
         
         # Обработка streaming response
         stream_enabled = kwargs.get("stream", False)
@@ -299,16 +870,42 @@ async def chat_completions(request: ChatCompletionRequest):
             logger.info(f"Reasoning effort: {request.reasoning_effort}")
             
             # Для streaming ответов создаем кастомный обработчик
-            from fastapi.responses import StreamingResponse
             import json
             
+            # Для OpenRouter не добавляем usage в чанки из-за ограничений API
+            include_usage = bool(request.stream_options and request.stream_options.get("include_usage", False)) and provider_name != "openrouter"
+            
+            async def stream_usage(accumulated_content, upstream_usage):
+                """(input, output, cached) из usage upstream; локальный подсчет - только если его нет"""
+                if upstream_usage is not None:
+                    return upstream_usage
+                return (
+                    await token_counter.count_messages_async(messages, provider_name, model_name),
+                    await token_counter.count_tokens_async(accumulated_content, provider_name, model_name),
+                    None
+                )
+            
+            async def record_cancelled_stream(accumulated_content, upstream_usage):
+                input_tokens, completion_tokens, cached_tokens = await stream_usage(accumulated_content, upstream_usage)
+                record_stream_response(accumulated_content, input_tokens, completion_tokens, cached_tokens, cacheable=False, cancelled=True)
+            
+            # Состояние стрима общее с release_stream: ответ может закончиться до первого чанка
+            content_parts = []
+            recorded = False
+            upstream_usage = None
+            
             async def streaming_generator():
-                # Подсчет токенов для usage статистики
-                input_tokens = token_counter.count_tokens(str(messages), current_provider)
+                nonlocal recorded, upstream_usage
+                # Usage в каждом чанке требует текущих счетчиков, поэтому локально считаем только
+                # для клиентов с include_usage; иначе итог берется из usage upstream
+                input_tokens = await token_counter.count_messages_async(messages, provider_name, model_name) if include_usage else 0
                 completion_tokens = 0
-                accumulated_content = ""
+                # Кодируем только новые дельты, а не весь накопленный текст на каждом чанке
+                completion_counter = token_counter.stream_counter(provider_name, model_name) if include_usage else None
+                has_tool_calls = False
                 
                 async for chunk in response:
+                    upstream_usage = parse_usage(getattr(chunk, "usage", None)) or upstream_usage
                     # Извлекаем контент из чанка для подсчета токенов
                     content = ""
                     if hasattr(chunk, 'content'):
@@ -319,11 +916,16 @@ async def chat_completions(request: ChatCompletionRequest):
                             delta = getattr(choices[0], 'delta')
                             if hasattr(delta, 'content'):
                                 content = getattr(delta, 'content', '')
+                            if getattr(delta, 'tool_calls', None):
+                                has_tool_calls = True
                     
-                    # Обновляем accumulated_content и completion_tokens
+                    # Обновляем накопленный контент и completion_tokens
                     if content:
-                        accumulated_content += content
-                        completion_tokens = token_counter.count_tokens(accumulated_content, current_provider)
+                        content_parts.append(content)
+                        if completion_counter is not None:
+                            completion_tokens = completion_counter.add(content)
+                    if content or has_tool_calls:
+                        request_metrics.chunk()
                     
                     # Преобразуем chunk в JSON-совместимый формат
                     if hasattr(chunk, 'model_dump'):
@@ -338,7 +940,7 @@ async def chat_completions(request: ChatCompletionRequest):
                             "id": f"chatcmpl-{int(time.time())}",
                             "object": "chat.completion.chunk",
                             "created": int(time.time()),
-                            "model": request.model or current_provider,
+                            "model": request.model or model_name,
                             "choices": [
                                 {
                                     "index": 0,
@@ -352,8 +954,7 @@ async def chat_completions(request: ChatCompletionRequest):
                         }
                     
                     # Обновляем completion_tokens во всех чанках
-                    # Для OpenRouter не добавляем usage в каждый chunk из-за ограничений API
-                    if request.stream_options and request.stream_options.get("include_usage", False) and current_provider != "openrouter":
+                    if include_usage:
                         chunk_dict["usage"] = {
                             "prompt_tokens": input_tokens,
                             "completion_tokens": completion_tokens,
@@ -373,63 +974,153 @@ async def chat_completions(request: ChatCompletionRequest):
                         yield f"data: {{\"error\": \"JSON serialization failed\"}}\n\n"
                 
                 # Финальный chunk с полной статистикой usage
-                # Для OpenRouter не добавляем финальный usage chunk из-за ограничений API
-                if request.stream_options and request.stream_options.get("include_usage", False) and current_provider != "openrouter":
-                    final_chunk = {
-                        "id": f"chatcmpl-{int(time.time())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": request.model or current_provider,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": "stop"
-                            }
-                        ],
-                        "usage": {
-                            "prompt_tokens": input_tokens,
-                            "completion_tokens": completion_tokens,
-                            "total_tokens": input_tokens + completion_tokens,
-                            "prompt_tokens_details": {
-                                "cached_tokens": 0
-                            },
-                            "prompt_cache_miss_tokens": input_tokens
+                accumulated_content = "".join(content_parts)
+                input_tokens, completion_tokens, cached_tokens = await stream_usage(accumulated_content, upstream_usage)
+                final_chunk = build_final_usage_chunk(input_tokens, completion_tokens, cached_tokens)
+                if final_chunk:
+                    yield final_chunk
+                
+                record_stream_response(accumulated_content, input_tokens, completion_tokens, cached_tokens, cacheable=not has_tool_calls)
+                recorded = True
+                
+                yield "data: [DONE]\n\n"
+            
+            async def passthrough_generator():
+                nonlocal recorded, upstream_usage
+                # Кадры upstream уходят клиенту как есть; из них только извлекается delta.content
+                # и usage, а токены считаются локально, лишь если upstream не прислал usage
+                has_tool_calls = False
+                usage_sent = False
+                
+                async for frame in response:
+                    if is_done_frame(frame):
+                        continue  # [DONE] отправим сами после usage
+                    usage, has_choices = extract_usage(frame)
+                    if usage is not None:
+                        upstream_usage = parse_usage(usage) or upstream_usage
+                        if not has_choices:
+                            # Отдельный кадр usage получает только клиент, который сам его просил
+                            if include_usage:
+                                usage_sent = True
+                                yield frame
+                            continue
+                    if b'"tool_calls"' in frame:
+                        has_tool_calls = True
+                    content = extract_delta_content(frame)
+                    if content:
+                        content_parts.append(content)
+                    if content or has_tool_calls:
+                        request_metrics.chunk()
+                    yield frame
+                
+                accumulated_content = "".join(content_parts)
+                input_tokens, completion_tokens, cached_tokens = await stream_usage(accumulated_content, upstream_usage)
+                if not usage_sent:
+                    final_chunk = build_final_usage_chunk(input_tokens, completion_tokens, cached_tokens)
+                    if final_chunk:
+                        yield final_chunk
+                
+                record_stream_response(accumulated_content, input_tokens, completion_tokens, cached_tokens, cacheable=not has_tool_calls)
+                recorded = True
+                
+                yield b"data: [DONE]\n\n"
+            
+            def build_final_usage_chunk(input_tokens, completion_tokens, cached_tokens=None):
+                if not include_usage:
+                    return None
+                final_chunk = {
+                    "id": f"chatcmpl-{int(time.time())}",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.model or model_name,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {},
+                            "finish_reason": "stop"
                         }
+                    ],
+                    "usage": {
+                        "prompt_tokens": input_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": input_tokens + completion_tokens,
+                        "prompt_tokens_details": {
+                            "cached_tokens": cached_tokens or 0
+                        },
+                        "prompt_cache_miss_tokens": input_tokens - (cached_tokens or 0)
                     }
-                    try:
-                        json_str = json.dumps(final_chunk, ensure_ascii=False)
-                        yield f"data: {json_str}\n\n"
-                    except Exception as e:
-                        logger.error(f"Final chunk JSON error: {e}")
+                }
+                try:
+                    json_str = json.dumps(final_chunk, ensure_ascii=False)
+                    return f"data: {json_str}\n\n"
+                except Exception as e:
+                    logger.error(f"Final chunk JSON error: {e}")
+                    return None
+            
+            async def track_stream(body):
+                # Ошибка стрима закрывает замер запроса с ее классом; остальное освобождает release_stream
+                try:
+                    async for frame in body:
+                        yield frame
+                except Exception as e:
+                    request_metrics.fail(e)
+                    raise
+            
+            async def release_stream():
+                # Ответ закончился любым способом, в том числе до первого чанка: закрываем upstream,
+                # освобождаем слот, а оборванный ответ учитываем как частичный
+                await close_upstream(response)
+                lease.release()
+                request_metrics.fail("cancelled")  # Без эффекта, если замер уже закрыт
+                if not recorded:
+                    await record_cancelled_stream("".join(content_parts), upstream_usage)
+            
+            def record_stream_response(accumulated_content, input_tokens, completion_tokens, cached_tokens=None, cacheable=True, cancelled=False):
+                reservation.reconcile(input_tokens + completion_tokens)
+                if not cancelled:
+                    request_metrics.finish(completion_tokens)
+                
+                # Ответы с вызовами инструментов не кэшируем: в записи кэша хранится только текст
+                if cache_key and cacheable and accumulated_content:
+                    response_cache.put(cache_key, {
+                        "content": accumulated_content,
+                        "finish_reason": "stop",
+                        "input_tokens": input_tokens,
+                        "output_tokens": completion_tokens
+                    })
                 
                 # Расчет стоимости для streaming запроса
-                request_cost = token_counter.estimate_cost(input_tokens, completion_tokens, current_provider)
+                request_cost = token_counter.estimate_cost(input_tokens, completion_tokens, provider_name, model_name, cached_tokens=cached_tokens, model_registry=model_registry)
                 global total_cost
                 total_cost += request_cost
 
                 # Сохраняем финальный ответ в лог после завершения streaming
                 response_log = {
                     "timestamp": time.time(),
-                    "provider": current_provider,
+                    "provider": provider_name,
+                    "model": model_name,
                     "response": accumulated_content[:1000] + "..." if len(accumulated_content) > 1000 else accumulated_content,
                     "input_tokens": input_tokens,
                     "output_tokens": completion_tokens,
                     "cost": request_cost
                 }
-
-                global response_logs
-                response_logs.append(response_log)
-                if len(response_logs) > MAX_LOGS:
-                    response_logs = response_logs[-MAX_LOGS:]
+                if cancelled:
+                    response_log["cancelled"] = True
+                if spilled_from is not None and provider_name != spilled_from[0]:
+                    response_log["overflow_from"] = "/".join(spilled_from)
+                    overflow.record_cost(request_cost)
+                save_response_log(response_log)
+                if cancelled:
+                    logger.info(f"Client disconnected, stream cancelled after {completion_tokens} tokens")
+                else:
                     logger.info(f"Saved streaming response to log: {accumulated_content[:100]}...")
-                
-                yield "data: [DONE]\n\n"
             
-            return StreamingResponse(
-                streaming_generator(),
+            stream = ManagedStreamingResponse(
+                track_stream(passthrough_generator() if passthrough else streaming_generator()),
                 media_type="text/event-stream"
             )
+            stream.on_close(release_stream)
+            return stream
         
         logger.info("Response received successfully")
         
@@ -471,12 +1162,19 @@ async def chat_completions(request: ChatCompletionRequest):
         
         logger.info(f"Extracted output text length: {len(output_text)}")
         
-        # Подсчет токенов
-        input_tokens = token_counter.count_tokens(str(messages), current_provider)
-        output_tokens = token_counter.count_tokens(output_text, current_provider)
+        # Токены из usage upstream; локальный подсчет - только если провайдер его не вернул
+        upstream_usage = parse_usage(response.get("usage") if isinstance(response, dict) else getattr(response, "usage", None))
+        if upstream_usage is not None:
+            input_tokens, output_tokens, cached_tokens = upstream_usage
+        else:
+            input_tokens = await token_counter.count_messages_async(messages, provider_name, model_name)
+            output_tokens = await token_counter.count_tokens_async(output_text, provider_name, model_name)
+            cached_tokens = None
+        request_metrics.finish(output_tokens)
+        reservation.reconcile(input_tokens + output_tokens)
 
         # Расчет стоимости для платных провайдеров
-        request_cost = token_counter.estimate_cost(input_tokens, output_tokens, current_provider)
+        request_cost = token_counter.estimate_cost(input_tokens, output_tokens, provider_name, model_name, cached_tokens=cached_tokens, model_registry=model_registry)
         global total_cost
         total_cost += request_cost
 
@@ -485,7 +1183,7 @@ async def chat_completions(request: ChatCompletionRequest):
             "id": f"chatcmpl-{int(time.time())}",
             "object": "chat.completion",
             "created": int(time.time()),
-            "model": request.model or current_provider,
+            "model": request.model or model_name,
             "choices": [{
                 "index": 0,
                 "message": {
@@ -497,35 +1195,58 @@ async def chat_completions(request: ChatCompletionRequest):
             "usage": {
                 "prompt_tokens": input_tokens,
                 "completion_tokens": output_tokens,
-                "total_tokens": input_tokens + output_tokens
+                "total_tokens": input_tokens + output_tokens,
+                "prompt_tokens_details": {
+                    "cached_tokens": cached_tokens or 0
+                }
             }
         }
         
         logger.info(f"Response formatted successfully. Tokens: {input_tokens}+{output_tokens}")
         
+        # Ответы с вызовами инструментов не кэшируем: в записи кэша хранится только текст
+        response_choices = getattr(response, "choices", None)
+        has_tool_calls = bool(response_choices) and bool(getattr(getattr(response_choices[0], "message", None), "tool_calls", None))
+        if cache_key and output_text and not has_tool_calls:
+            response_cache.put(cache_key, {
+                "content": output_text,
+                "finish_reason": "stop",
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens
+            })
+        
         # Сохраняем ответ в лог
         response_log = {
             "timestamp": time.time(),
-            "provider": current_provider,
+            "provider": provider_name,
+            "model": model_name,
             "response": output_text[:1000] + "..." if len(output_text) > 1000 else output_text,
             "input_tokens": input_tokens,
             "output_tokens": output_tokens,
             "cost": request_cost
         }
-
-        global response_logs
-        response_logs.append(response_log)
-        if len(response_logs) > MAX_LOGS:
-            response_logs = response_logs[-MAX_LOGS:]
+        if spilled_from is not None and provider_name != spilled_from[0]:
+            response_log["overflow_from"] = "/".join(spilled_from)
+            overflow.record_cost(request_cost)
+        save_response_log(response_log)
         
         return response_data
         
+    except HTTPException as e:
+        request_metrics.fail(e)
+        raise
     except asyncio.TimeoutError:
         logger.error("Request timeout")
+        request_metrics.fail("timeout")
         raise HTTPException(status_code=504, detail="Request timeout")
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
+        request_metrics.fail(e)
         raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        # Клиент отключился до ответа: без закрытия замера in_flight растет навсегда
+        request_metrics.fail("cancelled")
+        raise
 
 # Добавляем роутер к приложению
 from fastapi import APIRouter
@@ -536,13 +1257,27 @@ app.include_router(v1_router)
 @app.get("/providers")
 async def list_providers():
     """Список доступных провайдеров"""
-    return {"providers": list(providers.keys()), "current": current_provider}
+    return {"providers": list(settings_snapshot.providers.keys()), "current": current_provider}
+
+@app.get("/v1/models")
+async def list_models():
+    """Список моделей из таблицы маршрутизации (формат OpenAI)"""
+    return {
+        "object": "list",
+        "data": [
+            {"id": name, "object": "model", "owned_by": provider, "root": model}
+            for name, provider, model in settings_snapshot.model_router.list_models()
+        ] + [
+            {"id": alias, "object": "model", "owned_by": "router"}
+            for alias in settings_snapshot.adaptive_router.list_aliases()
+        ]
+    }
 
 @app.post("/switch-provider/{provider_name}")
 async def switch_provider(provider_name: str):
     """Переключение провайдера"""
     global current_provider
-    if provider_name not in providers:
+    if provider_name not in settings_snapshot.providers:
         raise HTTPException(status_code=400, detail=f"Provider {provider_name} not found")
     current_provider = provider_name
     return {"message": f"Switched to {provider_name}", "provider": current_provider}
@@ -571,38 +1306,146 @@ async def debug_cline_request(request: Request):
 @app.get("/logs/requests")
 async def get_request_logs():
     """Получить логи запросов"""
-    return {"request_logs": request_logs}
+    return {"request_logs": list(log_store.requests)}
 
 @app.get("/logs/responses")
 async def get_response_logs():
     """Получить логи ответов"""
-    return {"response_logs": response_logs}
+    return {"response_logs": list(log_store.responses)}
 
 @app.get("/logs/all")
 async def get_all_logs():
     """Получить все логи (запросы + ответы)"""
-    # Объединяем и сортируем по времени
-    all_logs = []
-    for log in request_logs:
-        all_logs.append({"type": "request", **log})
-    for log in response_logs:
-        all_logs.append({"type": "response", **log})
-    
-    all_logs.sort(key=lambda x: x["timestamp"])  # reverse=False по умолчанию
-    return {"logs": all_logs[-50:]}  # Возвращаем последние 50 (новые)
+    # Общая лента уже хранится в порядке поступления, сортировка не нужна
+    return {"logs": log_store.recent(50)}  # Возвращаем последние 50 (новые)
+
+@app.get("/logs")
+async def get_logs_since(since: int = 0, limit: int = 500):
+    """Получить только новые записи общей ленты (seq больше since), не больше limit старейших"""
+    return {"logs": log_store.since(since, limit), "last_seq": log_store.last_seq}
+
+@app.get("/logs/stream")
+async def stream_logs(request: Request, since: Optional[int] = None):
+    """SSE поток: новые записи логов (event: log) и изменения статистики (event: stats)"""
+    import json
+    from fastapi.responses import StreamingResponse
+
+    async def event_generator():
+        queue = log_store.subscribe()
+        try:
+            last_seq = since if since is not None else log_store.last_seq
+            for entry in log_store.since(last_seq):
+                last_seq = entry["seq"]
+                yield f"event: log\ndata: {json.dumps(entry, ensure_ascii=False)}\n\n"
+
+            last_stats = {}
+            idle = 0.0
+            while not await request.is_disconnected():
+                try:
+                    entry = await asyncio.wait_for(queue.get(), timeout=1.0)
+                    if entry["seq"] > last_seq:
+                        last_seq = entry["seq"]
+                        yield f"event: log\ndata: {json.dumps(entry, ensure_ascii=False)}\n\n"
+                    idle = 0.0
+                    if not queue.empty():
+                        continue
+                except asyncio.TimeoutError:
+                    idle += 1.0
+
+                # Отправляем только изменившиеся поля статистики
+                stats = collect_stats()
+                delta = {k: v for k, v in stats.items() if last_stats.get(k) != v}
+                if delta:
+                    last_stats = stats
+                    yield f"event: stats\ndata: {json.dumps(delta, ensure_ascii=False)}\n\n"
+                elif idle >= 15.0:
+                    idle = 0.0
+                    yield ": keep-alive\n\n"
+        finally:
+            log_store.unsubscribe(queue)
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+@app.get("/failover")
+async def get_failover():
+    """Состояние circuit breaker'ов и последние переключения трафика"""
+    return failover.snapshot()
+
+@app.get("/overflow")
+async def get_overflow():
+    """Пороги local-first overflow и запросы, ушедшие в облако"""
+    return overflow.stats()
+
+@app.post("/overflow")
+async def update_overflow(changes: Dict[str, Any]):
+    """Изменить пороги overflow без перезапуска сервера"""
+    try:
+        return overflow.update(changes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/admin/reload")
+async def get_reload_status():
+    """Версия текущих настроек и история перезагрузок settings.json"""
+    return {"version": settings_snapshot.version, **settings_reloader.stats()}
+
+@app.post("/admin/reload")
+async def reload_settings():
+    """Перечитать settings.json без перезапуска; при ошибке остаются прежние настройки"""
+    try:
+        return await settings_reloader.reload()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Settings were not reloaded: {e}")
+
+def collect_stats():
+    return {
+        "total_requests": log_store.total_requests,
+        "total_tokens": log_store.total_tokens,
+        "total_cost": total_cost,
+        "last_seq": log_store.last_seq,
+        "cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "concurrency": concurrency_limits.stats(),
+        "rate_limits": rate_limits.stats(),
+        "hedging": hedging.stats(),
+        "routing": settings_snapshot.adaptive_router.stats(),
+        "overflow": overflow.stats(),
+        "tokenizer": token_counter.stats(),
+        "local_backends": {
+            name: provider.pool.stats()
+            for name, provider in settings_snapshot.providers.items() if getattr(provider, "pool", None) is not None
+        },
+        "settings": {"version": settings_snapshot.version, **settings_reloader.stats()},
+        "http_pool": http_pool.stats(),
+    }
 
 # Endpoint для статистики (для совместимости с GUI)
 @app.get("/stats")
 async def get_stats():
     """Получить статистику сервера"""
-    global total_cost
     return {
-        "total_requests": len(request_logs),
-        "total_tokens": sum(log.get("input_tokens", 0) + log.get("output_tokens", 0) for log in response_logs),
-        "total_cost": total_cost,
+        **collect_stats(),
         "requests": []  # Для совместимости со старым GUI
     }
 
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    from fastapi.responses import PlainTextResponse
+    cache_stats = response_cache.stats()
+    flight_stats = single_flight.stats()
+    text = metrics.render([
+        ("llm_proxy_cost_total", "Estimated cost of all requests", "counter", total_cost),
+        ("llm_proxy_tokens_total", "Input and output tokens of all responses", "counter", log_store.total_tokens),
+        ("llm_proxy_cache_hits_total", "Response cache hits", "counter", cache_stats["hits"]),
+        ("llm_proxy_cache_misses_total", "Response cache misses", "counter", cache_stats["misses"]),
+        ("llm_proxy_coalesced_requests_total", "Requests served by joining an in-flight call", "counter", flight_stats["coalesced"]),
+        ("llm_proxy_settings_reloads_total", "Successful reloads of settings.json", "counter", settings_reloader.reloads),
+        ("llm_proxy_settings_reload_failures_total", "Rejected reloads of settings.json", "counter", settings_reloader.failures),
+        ("llm_proxy_settings_reload_seconds", "Duration of the last settings.json reload", "gauge", settings_reloader.last_duration or 0.0),
+    ])
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Добавляем обработчик для отлова ошибок валидации Pydantic
 from fastapi import Request
 from fastapi.responses import JSONResponse
@@ -0,0 +1,166 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+FASTEST = "fastest"
+CHEAPEST = "cheapest"
+
+
+class RoutingPolicy:
+    """Политика алиаса: маршруты-кандидаты и правило выбора между ними"""
+
+    def __init__(self, alias, policy, candidates, max_ttft=None, max_error_rate=0.5):
+        self.alias = alias
+        self.policy = policy
+        self.candidates = candidates  # [(provider, model, context_window, input_price, output_price)]
+        self.max_ttft = max_ttft      # секунды
+        self.max_error_rate = max_error_rate
+        self.decisions = {}           # "provider/model" -> сколько раз выбран
+        self.rejected = 0             # промпт не поместился ни в одну модель
+
+
+class AdaptiveRouter:
+    """Выбор маршрута для алиаса по живым замерам, цене и окну контекста.
+
+    Алиасы задаются в секции routing.aliases settings.json. Для запроса
+    оцениваются все кандидаты алиаса: модели, в чье окно контекста промпт не
+    помещается, отбрасываются; остальные сравниваются по EWMA time-to-first-token
+    и скорости генерации, доле ошибок и цене из pricing. Политика fastest
+    выбирает минимальное ожидаемое время ответа, cheapest - минимальную цену
+    среди маршрутов с TTFT не выше max_ttft_ms.
+
+    Выбор - один проход по кандидатам с чтением EWMA из Metrics, без
+    блокировок. Остальные подходящие кандидаты в порядке из настроек служат
+    запасными маршрутами.
+    """
+
+    def __init__(self, metrics, policies=None, default_ttft=1.0, default_tokens_per_second=50.0,
+                 default_output_tokens=500):
+        self.metrics = metrics
+        self.policies = policies or {}
+        # Оценки для маршрутов без замеров: новый маршрут получает шанс и начинает измеряться
+        self.default_ttft = default_ttft
+        self.default_tokens_per_second = default_tokens_per_second
+        self.default_output_tokens = default_output_tokens
+
+    @classmethod
+    def from_config(cls, routing_config, model_registry, model_router, metrics):
+        router = cls(
+            metrics,
+            default_ttft=routing_config.get("default_ttft", 1.0),
+            default_tokens_per_second=routing_config.get("default_tokens_per_second", 50.0),
+            default_output_tokens=routing_config.get("default_output_tokens", 500),
+        )
+        for alias, alias_config in routing_config.get("aliases", {}).items():
+            if alias in model_router.routes:
+                logger.warning(f"Routing alias '{alias}' shadows a model of the same name")
+            names = alias_config.get("candidates") or [name for name, _, _ in model_router.list_models()]
+            candidates = []
+            for name in names:
+                route = model_router.routes.get(name)
+                if route is None:
+                    logger.warning(f"Routing candidate '{name}' for '{alias}' is not a known model or provider, skipping")
+                    continue
+                if any(candidate[:2] == route for candidate in candidates):
+                    continue
+                spec = model_registry.model(*route)
+                candidates.append((route[0], route[1], spec.context_window, spec.input_cache_miss, spec.output))
+            if not candidates:
+                logger.warning(f"Routing alias '{alias}' has no usable candidates, skipping")
+                continue
+            policy = alias_config.get("policy", FASTEST)
+            if policy not in (FASTEST, CHEAPEST):
+                logger.warning(f"Unknown routing policy '{policy}' for '{alias}', using {FASTEST}")
+                policy = FASTEST
+            max_ttft_ms = alias_config.get("max_ttft_ms")
+            router.policies[alias] = RoutingPolicy(
+                alias, policy, candidates,
+                max_ttft=max_ttft_ms / 1000.0 if max_ttft_ms is not None else None,
+                max_error_rate=alias_config.get("max_error_rate", 0.5),
+            )
+        return router
+
+    def policy(self, requested_model):
+        """Политика для имени модели из запроса или None, если это не алиас роутера"""
+        return self.policies.get(requested_model) if requested_model else None
+
+    def rank(self, policy, prompt_tokens, max_tokens=None, available=None):
+        """Маршруты для запроса: лучший первым, затем остальные подходящие по порядку настроек.
+
+        Пустой список - промпт не помещается ни в одну модель алиаса.
+        available(provider, model) отсеивает недоступные сейчас маршруты.
+        """
+        fitting = []
+        best = best_score = None
+        fallback = fallback_score = None
+        for provider_name, model_name, context_window, input_price, output_price in policy.candidates:
+            # Промпт, не помещающийся в окно контекста, модель гарантированно отвергнет
+            if context_window is not None and prompt_tokens >= context_window:
+                continue
+            route = (provider_name, model_name)
+            fitting.append(route)
+            if available is not None and not available(provider_name, model_name):
+                continue
+
+            stats = self.metrics.route_stats(provider_name, model_name)
+            ttft = self.default_ttft
+            tokens_per_second = self.default_tokens_per_second
+            output_tokens = self.default_output_tokens
+            error_rate = 0.0
+            measured_ttft = stats.ttft if stats is not None else None
+            if stats is not None:
+                ttft = measured_ttft if measured_ttft is not None else ttft
+                tokens_per_second = stats.tokens_per_second or tokens_per_second
+                output_tokens = stats.output_tokens if stats.output_tokens is not None else output_tokens
+                error_rate = stats.error_rate
+            if max_tokens:
+                output_tokens = min(output_tokens, max_tokens)
+            # Ожидаемое время ответа с учетом повторной попытки после ошибки
+            latency = (ttft + output_tokens / tokens_per_second) / max(1.0 - error_rate, 0.05)
+
+            if fallback is None or latency < fallback_score:
+                fallback, fallback_score = route, latency
+            if policy.policy == FASTEST:
+                score = latency
+            else:
+                # Маршрут без замеров допускается: первый же запрос его измерит
+                if policy.max_ttft is not None and measured_ttft is not None and measured_ttft > policy.max_ttft:
+                    continue
+                if error_rate > policy.max_error_rate:
+                    continue
+                # Цена в pricing указана за миллион токенов; при равной цене выигрывает быстрый
+                score = (prompt_tokens * input_price + output_tokens * output_price, latency)
+            if best is None or score < best_score:
+                best, best_score = route, score
+
+        if not fitting:
+            policy.rejected += 1
+            return []
+        # Ни один маршрут не укладывается в ограничения cheapest: берем самый быстрый
+        chosen = best or fallback or fitting[0]
+        key = "/".join(chosen)
+        policy.decisions[key] = policy.decisions.get(key, 0) + 1
+        return [chosen] + [route for route in fitting if route != chosen]
+
+    def list_aliases(self):
+        return list(self.policies)
+
+    def stats(self):
+        aliases = {}
+        for alias, policy in self.policies.items():
+            routes = {}
+            for provider_name, model_name, context_window, _, _ in policy.candidates:
+                route_stats = self.metrics.route_stats(provider_name, model_name)
+                routes[f"{provider_name}/{model_name}"] = {
+                    "context_window": context_window,
+                    **(route_stats.snapshot() if route_stats is not None else {}),
+                }
+            aliases[alias] = {
+                "policy": policy.policy,
+                "max_ttft_ms": round(policy.max_ttft * 1000) if policy.max_ttft is not None else None,
+                "decisions": dict(policy.decisions),
+                "rejected_context": policy.rejected,
+                "routes": routes,
+            }
+        return aliases
+
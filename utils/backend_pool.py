@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from utils.http_pool import http_pool
+from utils.retry import classify_retryable
+
+logger = logging.getLogger(__name__)
+
+
+class Backend:
+    """Один llama-server из пула"""
+
+    def __init__(self, url, slots=None):
+        self.url = url.rstrip("/")
+        self.slots = slots          # Число слотов сервера (-np), нужно для закрепления слота
+        self.healthy = True
+        self.outstanding = 0        # Запросов в работе
+        self.conversations = 0      # Закрепленных за бэкендом разговоров
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+
+    @property
+    def health_url(self):
+        # /health у llama-server лежит в корне, а не под /v1
+        root = self.url[:-3] if self.url.endswith("/v1") else self.url
+        return f"{root}/health"
+
+    def snapshot(self):
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "conversations": self.conversations,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class BackendLease:
+    """Запрос, занявший бэкенд; release() можно вызывать повторно"""
+
+    def __init__(self, pool, backend, slot=None):
+        self.pool = pool
+        self.backend = backend
+        self.slot = slot
+        self._released = False
+
+    def release(self, error=None):
+        if self._released:
+            return
+        self._released = True
+        self.backend.outstanding -= 1
+        if error is not None and classify_retryable(error) == "connect":
+            self.pool.mark_down(self.backend, error)
+
+
+class PooledStream:
+    """Стрим бэкенда из пула: при закрытии или окончании освобождает бэкенд.
+
+    Класс, а не async generator: у генератора, который ни разу не
+    итерировали, aclose() не выполняет finally и бэкенд остался бы занят.
+    """
+
+    def __init__(self, stream, lease):
+        self._stream = stream
+        self._iterator = None
+        self._lease = lease
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = self._stream.__aiter__()
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._lease.release()
+            raise
+        except Exception as e:
+            self._lease.release(e)
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self._stream, "aclose"):
+                await self._stream.aclose()
+            elif hasattr(getattr(self._stream, "response", None), "aclose"):
+                await self._stream.response.aclose()
+        finally:
+            self._lease.release()
+
+
+class BackendPool:
+    """Пул локальных llama-server с привязкой разговора к бэкенду.
+
+    Разговор определяется хэшем стабильного префикса сообщений (первые
+    affinity_messages сообщений: system и первый запрос пользователя) и
+    отправляется на тот же бэкенд, а при pin_slots - и в тот же слот, чтобы
+    llama-server переиспользовал KV-кэш промпта и не считал prefill заново.
+    Новые разговоры идут на бэкенд с наименьшим числом запросов в работе.
+
+    Фоновая проверка /health выводит упавшие бэкенды из пула и возвращает
+    поднявшиеся. Разговоры ушедшего бэкенда открепляются и при следующем
+    запросе распределяются по оставшимся.
+    """
+
+    def __init__(self, backends, affinity_messages=2, max_conversations=10000,
+                 pin_slots=False, probe_interval=10.0, probe_timeout=2.0):
+        self.backends = backends
+        self.affinity_messages = affinity_messages
+        self.max_conversations = max_conversations
+        self.pin_slots = pin_slots
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._affinity = OrderedDict()  # ключ разговора -> Backend (LRU)
+        self._probe_task = None
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        self.rebalanced = 0
+
+    @classmethod
+    def from_config(cls, backends_config, pool_config):
+        backends = []
+        for item in backends_config:
+            if isinstance(item, str):
+                backends.append(Backend(item))
+            else:
+                backends.append(Backend(item["url"], item.get("slots")))
+        return cls(
+            backends,
+            affinity_messages=pool_config.get("affinity_messages", 2),
+            max_conversations=pool_config.get("max_conversations", 10000),
+            pin_slots=pool_config.get("pin_slots", False),
+            probe_interval=pool_config.get("probe_interval", 10.0),
+            probe_timeout=pool_config.get("probe_timeout", 2.0),
+        )
+
+    def conversation_key(self, messages):
+        """Хэш стабильного префикса разговора (не меняется, пока разговор растет)"""
+        prefix = [
+            (message.get("role"), message.get("content"))
+            for message in messages[:self.affinity_messages]
+        ]
+        data = json.dumps(prefix, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+    def acquire(self, messages):
+        """Выбрать бэкенд для запроса и занять его; вернуть BackendLease"""
+        self._ensure_probing()
+        key = self.conversation_key(messages)
+        backend = self._affinity.get(key)
+        if backend is not None and backend.healthy:
+            self._affinity.move_to_end(key)
+            self.affinity_hits += 1
+        else:
+            self.affinity_misses += 1
+            if backend is not None:
+                backend.conversations -= 1
+            backend = self._least_loaded()
+            self._affinity[key] = backend
+            self._affinity.move_to_end(key)
+            backend.conversations += 1
+            if len(self._affinity) > self.max_conversations:
+                _, evicted = self._affinity.popitem(last=False)
+                evicted.conversations -= 1
+        backend.outstanding += 1
+        backend.requests += 1
+        slot = None
+        if self.pin_slots and backend.slots:
+            slot = int(key[:8], 16) % backend.slots
+        return BackendLease(self, backend, slot)
+
+    def _least_loaded(self):
+        candidates = [backend for backend in self.backends if backend.healthy] or self.backends
+        return min(candidates, key=lambda backend: (backend.outstanding, backend.conversations))
+
+    def mark_down(self, backend, error):
+        backend.failures += 1
+        backend.last_error = str(error)[:200]
+        if not backend.healthy:
+            return
+        backend.healthy = False
+        logger.warning(f"Local backend {backend.url} left the pool: {backend.last_error}")
+        self._rebalance(backend)
+
+    def mark_up(self, backend):
+        if backend.healthy:
+            return
+        backend.healthy = True
+        backend.last_error = None
+        logger.info(f"Local backend {backend.url} joined the pool")
+
+    def _rebalance(self, backend):
+        """Открепить разговоры ушедшего бэкенда: следующий запрос выберет новый"""
+        keys = [key for key, owner in self._affinity.items() if owner is backend]
+        for key in keys:
+            del self._affinity[key]
+        backend.conversations = 0
+        self.rebalanced += len(keys)
+
+    def _ensure_probing(self):
+        if self._probe_task is None and self.probe_interval:
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    async def _probe_loop(self):
+        while True:
+            # Клиент берется на каждый круг: после перезагрузки секции http прежний закрывается
+            generation = http_pool.hold()
+            try:
+                client = http_pool.get_client("local")
+                await asyncio.gather(*(self._probe(client, backend) for backend in self.backends))
+            finally:
+                http_pool.release(generation)
+            await asyncio.sleep(self.probe_interval)
+
+    async def _probe(self, client, backend):
+        try:
+            response = await client.get(backend.health_url, timeout=self.probe_timeout)
+        except Exception as e:
+            self.mark_down(backend, e)
+            return
+        # 503 - модель еще загружается
+        if response.status_code == 200:
+            self.mark_up(backend)
+        else:
+            self.mark_down(backend, f"health check returned {response.status_code}")
+
+    async def aclose(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    def stats(self):
+        return {
+            "backends": {backend.url: backend.snapshot() for backend in self.backends},
+            "conversations": len(self._affinity),
+            "affinity_hits": self.affinity_hits,
+            "affinity_misses": self.affinity_misses,
+            "rebalanced": self.rebalanced,
+        }
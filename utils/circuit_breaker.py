@@ -0,0 +1,169 @@
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Автомат closed / open / half-open для одного провайдера.
+
+    В closed учитываются исходы вызовов за скользящее окно. Плохим считается
+    вызов с ошибкой или медленнее slow_call_seconds; если плохих не меньше
+    failure_rate (при минимуме min_calls вызовов), breaker открывается и
+    запросы сразу идут мимо провайдера. Через open_seconds он переходит в
+    half-open и пропускает half_open_calls пробных вызовов: успех закрывает
+    breaker, ошибка снова открывает.
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=5, window_seconds=60.0,
+                 slow_call_seconds=60.0, open_seconds=30.0, half_open_calls=1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.last_error = None
+        self._calls = deque()  # (время, плохой ли вызов)
+        self._probes = 0
+
+    @classmethod
+    def from_config(cls, name, breaker_config):
+        return cls(
+            name,
+            failure_rate=breaker_config.get("failure_rate", 0.5),
+            min_calls=breaker_config.get("min_calls", 5),
+            window_seconds=breaker_config.get("window_seconds", 60.0),
+            slow_call_seconds=breaker_config.get("slow_call_seconds", 60.0),
+            open_seconds=breaker_config.get("open_seconds", 30.0),
+            half_open_calls=breaker_config.get("half_open_calls", 1),
+        )
+
+    def allow(self):
+        """Можно ли сейчас отправить запрос провайдеру"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.state = HALF_OPEN
+            self._probes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_calls:
+                return False
+            self._probes += 1
+        return True
+
+    def is_available(self):
+        """Пропустит ли breaker запрос сейчас (без изменения состояния, в отличие от allow)"""
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.open_seconds
+        if self.state == HALF_OPEN:
+            return self._probes < self.half_open_calls
+        return True
+
+    def cancel_probe(self):
+        """Пробный запрос так и не был отправлен (например, очередь переполнена)"""
+        if self.state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record_success(self, latency):
+        slow = self.slow_call_seconds is not None and latency > self.slow_call_seconds
+        if self.state == HALF_OPEN:
+            if slow:
+                self._open("slow probe")
+            else:
+                self._close()
+            return
+        self._record(slow)
+        if slow:
+            self.last_error = f"slow call {latency:.1f}s"
+
+    def record_failure(self, error):
+        self.last_error = str(error)[:200]
+        if self.state == HALF_OPEN:
+            self._open("probe failed")
+            return
+        self._record(True)
+
+    def _record(self, bad):
+        now = time.monotonic()
+        self._calls.append((now, bad))
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+        total = len(self._calls)
+        if self.state == CLOSED and total >= self.min_calls:
+            bad_calls = sum(1 for _, is_bad in self._calls if is_bad)
+            if bad_calls / total >= self.failure_rate:
+                self._open(f"{bad_calls}/{total} bad calls")
+
+    def _open(self, reason):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.last_error = f"{reason}: {self.last_error}" if self.last_error else reason
+        self._calls.clear()
+
+    def _close(self):
+        self.state = CLOSED
+        self._calls.clear()
+        self._probes = 0
+
+    def snapshot(self):
+        bad_calls = sum(1 for _, is_bad in self._calls if is_bad)
+        info = {
+            "state": self.state,
+            "calls": len(self._calls),
+            "bad_calls": bad_calls,
+            "last_error": self.last_error,
+        }
+        if self.state == OPEN:
+            info["retry_in"] = round(max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)), 1)
+        return info
+
+
+class Failover:
+    """Breaker'ы провайдеров и журнал решений о переключении трафика"""
+
+    def __init__(self, enabled=True, breaker_config=None, max_events=100):
+        self.enabled = enabled
+        self.breaker_config = breaker_config or {}
+        self.breakers = {}
+        self.events = deque(maxlen=max_events)
+
+    @classmethod
+    def from_config(cls, failover_config):
+        return cls(
+            enabled=failover_config.get("enabled", True),
+            breaker_config=failover_config.get("breaker", {}),
+            max_events=failover_config.get("max_events", 100),
+        )
+
+    def breaker(self, provider_name):
+        breaker = self.breakers.get(provider_name)
+        if breaker is None:
+            breaker = CircuitBreaker.from_config(provider_name, self.breaker_config)
+            self.breakers[provider_name] = breaker
+        return breaker
+
+    def is_available(self, provider_name):
+        breaker = self.breakers.get(provider_name)
+        return breaker is None or breaker.is_available()
+
+    def record_event(self, requested_model, from_route, to_route, reason):
+        self.events.append({
+            "timestamp": time.time(),
+            "requested_model": requested_model,
+            "from": "/".join(from_route),
+            "to": "/".join(to_route) if to_route else None,
+            "reason": reason,
+        })
+
+    def snapshot(self):
+        return {
+            "enabled": self.enabled,
+            "breakers": {name: breaker.snapshot() for name, breaker in self.breakers.items()},
+            "events": list(self.events),
+        }
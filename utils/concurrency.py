@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты очереди: меньше - раньше
+PRIORITY_INTERACTIVE = 0  # Streaming запросы IDE, пользователь ждет первый токен
+PRIORITY_BACKGROUND = 1   # Обычные (не streaming) запросы
+
+
+class QueueFullError(Exception):
+    """Очередь к провайдеру переполнена или ожидание слота превысило лимит"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Too many queued requests for {name}")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """Не более limit одновременных вызовов и очередь ожидающих с приоритетом.
+
+    Внутри одного приоритета очередь FIFO. Освободившийся слот передается
+    следующему ожидающему напрямую, поэтому новый запрос не может обогнать
+    очередь.
+    """
+
+    def __init__(self, name, limit, max_queue=100):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = []  # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self.rejected = 0
+
+    @property
+    def queued(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority, timeout=None, retry_after=2):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(self.name, retry_after)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if not self._abandon(future):
+                return  # Слот успели выдать одновременно с таймаутом
+            self.rejected += 1
+            raise QueueFullError(self.name, retry_after)
+        except BaseException:
+            if not self._abandon(future):
+                self.release()
+            raise
+
+    def _abandon(self, future):
+        """Снять ожидание; False, если слот уже был передан этому ожидающему"""
+        if future.done():
+            return False
+        future.cancel()
+        return True
+
+    def release(self):
+        # Слот переходит первому живому ожидающему, счетчик active не меняется
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def resize(self, limit, max_queue):
+        """Изменить лимит и длину очереди; занятые слоты и ожидающие сохраняются"""
+        self.limit = limit
+        self.max_queue = max_queue
+        # Новые слоты сразу отдаются ожидающим; при уменьшении лимита лишние слоты уходят по мере release
+        while self.active < self.limit and self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def stats(self):
+        return {"limit": self.limit, "active": self.active, "queued": self.queued, "rejected": self.rejected}
+
+
+class Lease:
+    """Занятые слоты запроса; release() можно вызывать повторно"""
+
+    def __init__(self, limiters):
+        self._limiters = limiters
+
+    def release(self):
+        limiters, self._limiters = self._limiters, []
+        for limiter in reversed(limiters):
+            limiter.release()
+
+
+class ConcurrencyLimits:
+    """Лимиты одновременных запросов по провайдерам и моделям.
+
+    Лимит провайдера - max_concurrency в его настройках, лимит модели -
+    max_concurrency в описании модели. Без настроек запросы не ограничиваются.
+    """
+
+    def __init__(self, max_queue=100, queue_timeout=60.0, retry_after=2):
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._limiters = {}
+
+    @classmethod
+    def from_config(cls, concurrency_config, provider_configs):
+        limits = cls(
+            max_queue=concurrency_config.get("max_queue", 100),
+            queue_timeout=concurrency_config.get("queue_timeout", 60.0),
+            retry_after=concurrency_config.get("retry_after", 2),
+        )
+        limits.update(provider_configs)
+        return limits
+
+    def update(self, provider_configs):
+        """Применить лимиты из новых настроек провайдеров.
+
+        Лимитеры остаются прежними объектами: занятые слоты и очередь не
+        сбрасываются, меняются только limit и max_queue. Лимитер, который
+        убрали из настроек, обслуживает уже выданные слоты до их освобождения.
+        """
+        limiters = {}
+        for provider_name, provider_config in provider_configs.items():
+            max_queue = provider_config.get("max_queue", self.max_queue)
+            if provider_config.get("max_concurrency"):
+                limiters[(provider_name, None)] = (provider_name, provider_config["max_concurrency"], max_queue)
+            for model in provider_config.get("models", []):
+                if model.get("max_concurrency"):
+                    limiters[(provider_name, model["name"])] = (
+                        f"{provider_name}/{model['name']}", model["max_concurrency"], model.get("max_queue", max_queue))
+        for key, (name, limit, max_queue) in limiters.items():
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiters[key] = ConcurrencyLimiter(name, limit, max_queue)
+            else:
+                if (limiter.limit, limiter.max_queue) != (limit, max_queue):
+                    logger.info(f"Concurrency limit for {name}: {limiter.limit} -> {limit}, queue {limiter.max_queue} -> {max_queue}")
+                    limiter.resize(limit, max_queue)
+                limiters[key] = limiter
+        self._limiters = limiters
+
+    async def acquire(self, provider_name, model_name, priority):
+        """Занять слот модели и слот провайдера (в этом порядке); вернуть Lease"""
+        acquired = []
+        try:
+            for key in ((provider_name, model_name), (provider_name, None)):
+                limiter = self._limiters.get(key)
+                if limiter is not None:
+                    await limiter.acquire(priority, self.queue_timeout, self.retry_after)
+                    acquired.append(limiter)
+        except BaseException:
+            Lease(acquired).release()
+            raise
+        return Lease(acquired)
+
+    def stats(self):
+        return {limiter.name: limiter.stats() for limiter in self._limiters.values()}
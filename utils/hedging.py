@@ -0,0 +1,127 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchedStream:
+    """Стрим upstream, первый чанк которого уже прочитан.
+
+    Итерация отдает сначала прочитанный чанк, затем остальные; aclose()
+    закрывает исходный стрим.
+    """
+
+    _EMPTY = object()
+
+    def __init__(self, first, iterator, source, close):
+        self._first = first
+        self._iterator = iterator
+        self._source = source
+        self._close = close
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if self._first is not self._EMPTY:
+            yield self._first
+        async for item in self._iterator:
+            yield item
+
+    async def aclose(self):
+        if hasattr(self._iterator, "aclose"):
+            await self._iterator.aclose()
+        await self._close(self._source)
+
+
+async def prefetch_first_chunk(make_call, close):
+    """Открыть стрим и дождаться первого чанка (момент, когда провайдер реально начал отвечать)"""
+    response = await make_call()
+    iterator = response.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        first = PrefetchedStream._EMPTY
+    except BaseException:
+        await close(response)
+        raise
+    return PrefetchedStream(first, iterator, response, close)
+
+
+class Hedging:
+    """Дублирование медленных стримов на запасной маршрут.
+
+    Если основной маршрут не прислал первый чанк за задержку, равную
+    заданному перцентилю его time-to-first-token, тот же запрос уходит на
+    запасной маршрут. Побеждает первый начавший отвечать, второй отменяется.
+    """
+
+    # Сколько замеров TTFT нужно, чтобы доверять перцентилю
+    MIN_SAMPLES = 20
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._stats = {}
+
+    def delay(self, provider_name, model_name, hedge_config):
+        """Задержка перед запуском дубля, секунды"""
+        delay = self.metrics.ttft_quantile(provider_name, model_name, hedge_config.get("percentile", 0.95), self.MIN_SAMPLES)
+        if delay is None:
+            delay = hedge_config.get("default_delay", 3.0)
+        return min(max(delay, hedge_config.get("min_delay", 0.5)), hedge_config.get("max_delay", 10.0))
+
+    def _record(self, route, outcome):
+        stats = self._stats.setdefault(route, {"requests": 0, "hedged": 0, "primary_wins": 0, "secondary_wins": 0, "both_failed": 0})
+        stats["requests"] += 1
+        if outcome != "not_hedged":
+            stats["hedged"] += 1
+            stats[outcome] += 1
+
+    async def race(self, route, primary, secondary, delay, close):
+        """Запустить primary(), через delay секунд - secondary(); вернуть (индекс победителя, результат).
+
+        primary и secondary - фабрики корутин, возвращающих открытый стрим.
+        Проигравший отменяется, а если он уже успел открыть стрим - стрим закрывается.
+        """
+        tasks = [asyncio.ensure_future(primary())]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                winner = 0
+                self._record(route, "not_hedged")
+                return 0, tasks[0].result()
+
+            logger.info(f"No first chunk from {route} within {delay:.2f}s, hedging")
+            tasks.append(asyncio.ensure_future(secondary()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for index, task in enumerate(tasks):
+                    if task not in done:
+                        continue
+                    if task.exception() is None:
+                        winner = index
+                        self._record(route, "primary_wins" if index == 0 else "secondary_wins")
+                        return index, task.result()
+                    logger.warning(f"Hedged {'primary' if index == 0 else 'secondary'} for {route} failed: {task.exception()}")
+            # Оба маршрута упали: ошибка основного решает, что делать дальше (failover)
+            winner = 0
+            self._record(route, "both_failed")
+            return 0, tasks[0].result()
+        finally:
+            for index, task in enumerate(tasks):
+                if index == winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                    try:
+                        await task
+                    except BaseException:
+                        pass
+                # Проигравший мог успеть открыть стрим одновременно с победителем
+                if not task.cancelled() and task.exception() is None:
+                    await close(task.result())
+
+    def stats(self):
+        return dict(self._stats)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from collections import Counter
+
+import httpx
+from config import config as Config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  HTTP/2 для httpx требует пакет h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class HTTPPool:
+    """Общий транспорт для всех провайдеров.
+
+    Провайдеры с одинаковыми параметрами пула (лимиты, HTTP/2, verify,
+    таймауты) используют один httpx.AsyncClient, поэтому соединения к каждому
+    хосту переиспользуются вместо повторных TLS рукопожатий. Клиенты
+    создаются при первом запросе внутри работающего event loop и
+    закрываются при остановке сервера (lifespan).
+
+    После перезагрузки настроек с другой секцией http клиенты, которые
+    новым настройкам не нужны, выводятся из пула (retire_unused) и
+    закрываются, когда завершатся запросы, начатые до перезагрузки: запрос
+    удерживает текущее поколение пула через hold/release.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._users = set()        # (провайдер, verify), для которых запрашивались клиенты
+        self._generation = 0
+        self._holds = Counter()    # поколение -> запросов в работе
+        self._retired = []         # (последнее поколение, которое может их использовать, клиенты)
+        self._http2_warned = False
+
+    def _pool_key(self, provider_name, verify):
+        http_config = Config.get_http_config(provider_name)
+        http2 = bool(http_config.get("http2", False))
+        if http2 and not HTTP2_AVAILABLE:
+            if not self._http2_warned:
+                logger.warning("HTTP/2 requested but package 'h2' is not installed, falling back to HTTP/1.1")
+                self._http2_warned = True
+            http2 = False
+        return (
+            http_config.get("max_connections", 100),
+            http_config.get("max_keepalive_connections", 20),
+            http_config.get("keepalive_expiry", 30.0),
+            http2,
+            verify,
+            self._timeouts(provider_name),
+        )
+
+    def get_client(self, provider_name, verify=True):
+        """Получить общий httpx клиент для провайдера"""
+        self._users.add((provider_name, verify))
+        key = self._pool_key(provider_name, verify)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            max_connections, max_keepalive, keepalive_expiry, http2, verify, _ = key
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+                http2=http2,
+                verify=verify,
+                timeout=self.get_timeout(provider_name),
+            )
+            self._clients[key] = client
+            logger.info(f"HTTP pool created: max_connections={max_connections}, keepalive={max_keepalive}, http2={http2}, verify={verify}")
+        return client
+
+    def get_timeout(self, provider_name):
+        """Таймауты connect/read/write/pool для провайдера"""
+        connect, read, write, pool = self._timeouts(provider_name)
+        return httpx.Timeout(connect=connect, read=read, write=write, pool=pool)
+
+    def _timeouts(self, provider_name):
+        timeouts = Config.get_http_config(provider_name).get("timeouts", {})
+        return (
+            timeouts.get("connect", 10.0),
+            timeouts.get("read", 600.0),
+            timeouts.get("write", 30.0),
+            timeouts.get("pool", 10.0),
+        )
+
+    def hold(self):
+        """Отметить запрос в работе; вернуть поколение пула для release"""
+        self._holds[self._generation] += 1
+        return self._generation
+
+    def release(self, generation):
+        self._holds[generation] -= 1
+        if not self._holds[generation]:
+            del self._holds[generation]
+        self._close_drained()
+
+    def retire_unused(self, provider_names):
+        """Вывести из пула клиенты, которые не нужны провайдерам provider_names при текущих настройках"""
+        keep = {self._pool_key(name, verify) for name, verify in self._users if name in provider_names}
+        retired = [key for key in self._clients if key not in keep]
+        if not retired:
+            return 0
+        self._retired.append((self._generation, [self._clients.pop(key) for key in retired]))
+        self._generation += 1
+        self._close_drained()
+        return len(retired)
+
+    def _close_drained(self):
+        # Клиенты поколения закрываются, когда завершились все запросы этого и более ранних поколений
+        oldest = min(self._holds, default=self._generation)
+        drained = [clients for generation, clients in self._retired if generation < oldest]
+        if not drained:
+            return
+        self._retired = [(generation, clients) for generation, clients in self._retired if generation >= oldest]
+        asyncio.ensure_future(self._close([client for clients in drained for client in clients]))
+
+    async def _close(self, clients):
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"Error closing HTTP client: {e}")
+
+    def stats(self):
+        return {
+            "clients": len(self._clients),
+            "generation": self._generation,
+            "requests": sum(self._holds.values()),
+            "retired": sum(len(clients) for _, clients in self._retired),
+        }
+
+    async def aclose(self):
+        """Закрыть все соединения (вызывается при остановке сервера)"""
+        clients = list(self._clients.values()) + [client for _, clients in self._retired for client in clients]
+        self._clients = {}
+        self._retired = []
+        await self._close(clients)
+
+
+http_pool = HTTPPool()
@@ -0,0 +1,81 @@
+import asyncio
+from collections import deque
+from itertools import islice
+
+
+class LogStore:
+    """Ограниченное хранилище логов запросов и ответов.
+
+    Логи лежат в deque фиксированной длины, поэтому переполнение не копирует
+    список. Общая лента хранится в порядке поступления и не требует
+    сортировки, а счетчики для /stats обновляются при вставке. Каждая запись
+    получает возрастающий seq, по которому клиенты забирают только новое,
+    а подписчики получают записи сразу через свои очереди.
+    """
+
+    # Размер очереди подписчика; при переполнении записи пропускаются,
+    # клиент видит разрыв в seq и дочитывает через /logs?since=
+    SUBSCRIBER_QUEUE_SIZE = 1000
+
+    def __init__(self, max_logs=100):
+        self.max_logs = max_logs
+        self.requests = deque(maxlen=max_logs)
+        self.responses = deque(maxlen=max_logs)
+        self.timeline = deque(maxlen=max_logs * 2)
+        self.total_requests = 0
+        self.total_responses = 0
+        self.total_tokens = 0
+        self.last_seq = 0
+        self._subscribers = set()
+
+    def _append(self, log_type, log):
+        self.last_seq += 1
+        log["seq"] = self.last_seq
+        entry = {"type": log_type, **log}
+        self.timeline.append(entry)
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                pass
+
+    def add_request(self, log):
+        self.requests.append(log)
+        self.total_requests += 1
+        self._append("request", log)
+
+    def add_response(self, log):
+        self.responses.append(log)
+        self.total_responses += 1
+        self.total_tokens += log.get("input_tokens", 0) + log.get("output_tokens", 0)
+        self._append("response", log)
+
+    def recent(self, limit):
+        """Последние записи общей ленты (старые первыми)"""
+        entries = list(islice(reversed(self.timeline), limit))
+        entries.reverse()
+        return entries
+
+    def since(self, seq, limit=None):
+        """Записи общей ленты с seq больше заданного (старые первыми), стоимость O(новых записей).
+
+        При limit возвращаются самые старые из новых записей: следующий запрос
+        с seq последней из них продолжает ленту без пропусков.
+        """
+        entries = []
+        for entry in reversed(self.timeline):
+            if entry["seq"] <= seq:
+                break
+            entries.append(entry)
+        entries.reverse()
+        if limit is not None and len(entries) > limit:
+            entries = entries[:limit]
+        return entries
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
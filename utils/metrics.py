@@ -0,0 +1,307 @@
+import time
+from bisect import bisect_left
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин.
+
+    Наблюдение - это bisect по кортежу границ и инкремент целого счетчика,
+    без выделения памяти. Накопительные значения считаются только при выводе.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (линейно внутри корзины, как histogram_quantile)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.bounds, self.counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.bounds[-1]  # Квантиль в корзине +Inf: берем верхнюю конечную границу
+
+
+class RouteStats:
+    """Экспоненциально сглаженные (EWMA) замеры маршрута для адаптивной маршрутизации.
+
+    Обновление - несколько арифметических операций над полями, чтение -
+    обычные атрибуты, поэтому роутеру не нужны блокировки.
+    """
+
+    __slots__ = ("alpha", "ttft", "tokens_per_second", "output_tokens", "error_rate", "queue_wait", "samples", "updated")
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.ttft = None               # секунды
+        self.tokens_per_second = None
+        self.output_tokens = None      # типичная длина ответа
+        self.error_rate = 0.0          # доля ошибок upstream
+        self.queue_wait = None         # секунды ожидания слота
+        self.samples = 0
+        self.updated = 0.0             # time.monotonic() последнего замера задержки
+
+    def _ewma(self, old, value):
+        return value if old is None else old + self.alpha * (value - old)
+
+    def observe_ttft(self, value):
+        self.ttft = self._ewma(self.ttft, value)
+        self.updated = time.monotonic()
+
+    def observe_queue_wait(self, value):
+        self.queue_wait = self._ewma(self.queue_wait, value)
+        self.updated = time.monotonic()
+
+    def observe_success(self, output_tokens, tokens_per_second=None):
+        self.samples += 1
+        self.error_rate -= self.alpha * self.error_rate
+        self.output_tokens = self._ewma(self.output_tokens, output_tokens)
+        if tokens_per_second:
+            self.tokens_per_second = self._ewma(self.tokens_per_second, tokens_per_second)
+
+    def observe_error(self):
+        self.samples += 1
+        self.error_rate += self.alpha * (1.0 - self.error_rate)
+
+    def snapshot(self):
+        return {
+            "ttft": round(self.ttft, 3) if self.ttft is not None else None,
+            "tokens_per_second": round(self.tokens_per_second, 1) if self.tokens_per_second is not None else None,
+            "output_tokens": round(self.output_tokens) if self.output_tokens is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "queue_wait": round(self.queue_wait, 3) if self.queue_wait is not None else None,
+            "samples": self.samples,
+        }
+
+
+class RequestMetrics:
+    """Замер одного запроса: создается в начале, отмечает чанки и завершение"""
+
+    __slots__ = ("_metrics", "_key", "_histograms", "started", "first_chunk", "last_chunk", "done")
+
+    def __init__(self, metrics, key, histograms):
+        self._metrics = metrics
+        self._key = key
+        self._histograms = histograms
+        self.started = time.perf_counter()
+        self.first_chunk = 0.0
+        self.last_chunk = 0.0
+        self.done = False
+
+    def chunk(self):
+        """Чанк с контентом: первый дает time-to-first-token, остальные - паузу между чанками"""
+        now = time.perf_counter()
+        if self.first_chunk:
+            self._histograms[2].observe(now - self.last_chunk)
+        else:
+            self.first_chunk = now
+            self._histograms[1].observe(now - self.started)
+            self._metrics._route_stats[self._key].observe_ttft(now - self.started)
+        self.last_chunk = now
+
+    def finish(self, output_tokens=0):
+        if self.done:
+            return
+        self.done = True
+        now = time.perf_counter()
+        latency, _, _, throughput, _ = self._histograms
+        latency.observe(now - self.started)
+        # Скорость генерации считаем от первого токена, для обычного ответа - от начала
+        generation = now - (self.first_chunk or self.started)
+        if output_tokens and generation > 0:
+            throughput.observe(output_tokens / generation)
+            # Ответ только из кэша (без токенов) не говорит ничего о самом маршруте
+            self._metrics._route_stats[self._key].observe_success(
+                output_tokens, output_tokens / generation if self.first_chunk else None)
+        self._metrics._in_flight[self._key] -= 1
+
+    def reroute(self, provider_name, model_name):
+        """Запрос ушел на запасной маршрут: дальнейшие замеры относятся к нему"""
+        in_flight = self._metrics._in_flight
+        in_flight[self._key] -= 1
+        self._key, self._histograms = self._metrics._series(provider_name, model_name)
+        in_flight[self._key] += 1
+
+    def queued(self, wait):
+        """Время ожидания слота в очереди к провайдеру"""
+        self._histograms[4].observe(wait)
+        self._metrics._route_stats[self._key].observe_queue_wait(wait)
+
+    def upstream_error(self):
+        """Маршрут не ответил (сбой, таймаут): учитывается в EWMA доли ошибок"""
+        self._metrics._route_stats[self._key].observe_error()
+
+    def retry(self, reason):
+        retries = self._metrics._retries
+        key = self._key + (reason,)
+        retries[key] = retries.get(key, 0) + 1
+
+    def fail(self, error):
+        if self.done:
+            return
+        self.done = True
+        errors = self._metrics._errors
+        key = self._key + (classify_error(error),)
+        errors[key] = errors.get(key, 0) + 1
+        self._metrics._in_flight[self._key] -= 1
+
+    def close(self):
+        """Запрос прерван без ответа и без ошибки (например, клиент отключился)"""
+        if not self.done:
+            self.done = True
+            self._metrics._in_flight[self._key] -= 1
+
+
+def classify_error(error):
+    """Класс ошибки для метрик: timeout, 4xx или 5xx"""
+    if isinstance(error, str):
+        return error
+    if isinstance(error, TimeoutError) or "timeout" in type(error).__name__.lower():
+        return "timeout"
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        if status == 504:
+            return "timeout"
+        if 400 <= status < 500:
+            return "4xx"
+    return "5xx"
+
+
+class Metrics:
+    """Метрики прокси в текстовом формате Prometheus, с метками provider и model"""
+
+    # Границы корзин, секунды
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+    TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+    CHUNK_GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+    # Токенов в секунду
+    TOKENS_PER_SECOND_BUCKETS = (1.0, 5.0, 10.0, 20.0, 40.0, 60.0, 100.0, 200.0, 500.0)
+    QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    HISTOGRAMS = (
+        ("llm_proxy_request_duration_seconds", "Total request latency", LATENCY_BUCKETS),
+        ("llm_proxy_time_to_first_token_seconds", "Time to first streamed content chunk", TTFT_BUCKETS),
+        ("llm_proxy_inter_chunk_seconds", "Gap between streamed content chunks", CHUNK_GAP_BUCKETS),
+        ("llm_proxy_output_tokens_per_second", "Output tokens per second of generation", TOKENS_PER_SECOND_BUCKETS),
+        ("llm_proxy_queue_wait_seconds", "Time spent waiting for a concurrency slot", QUEUE_WAIT_BUCKETS),
+    )
+
+    def __init__(self, ewma_alpha=0.2):
+        self.ewma_alpha = ewma_alpha
+        self._requests = {}     # (provider, model) -> int
+        self._errors = {}       # (provider, model, class) -> int
+        self._in_flight = {}    # (provider, model) -> int
+        self._retries = {}      # (provider, model, reason) -> int
+        self._histograms = {}   # (provider, model) -> (latency, ttft, gap, tokens/s, queue wait)
+        self._route_stats = {}  # (provider, model) -> RouteStats
+
+    def set_ewma_alpha(self, alpha):
+        """Новый коэффициент сглаживания для всех маршрутов (накопленные значения сохраняются)"""
+        self.ewma_alpha = alpha
+        for stats in self._route_stats.values():
+            stats.alpha = alpha
+
+    def _series(self, provider_name, model_name):
+        """Ключ и гистограммы пары provider/model; создаются один раз"""
+        key = (provider_name, model_name or "")
+        histograms = self._histograms.get(key)
+        if histograms is None:
+            histograms = tuple(Histogram(bounds) for _, _, bounds in self.HISTOGRAMS)
+            self._histograms[key] = histograms
+            self._route_stats[key] = RouteStats(self.ewma_alpha)
+            self._in_flight[key] = 0
+        return key, histograms
+
+    def ttft_quantile(self, provider_name, model_name, q, min_samples=1):
+        """Квантиль time-to-first-token маршрута или None, если замеров мало"""
+        histograms = self._histograms.get((provider_name, model_name or ""))
+        if histograms is None or histograms[1].count < min_samples:
+            return None
+        return histograms[1].quantile(q)
+
+    def route_stats(self, provider_name, model_name):
+        """EWMA замеры маршрута или None, если запросов к нему еще не было"""
+        return self._route_stats.get((provider_name, model_name or ""))
+
+    def in_flight(self, provider_name):
+        """Запросов в работе у провайдера по всем его моделям"""
+        return sum(value for (provider, _), value in self._in_flight.items() if provider == provider_name)
+
+    def start(self, provider_name, model_name):
+        """Начать замер запроса"""
+        key, histograms = self._series(provider_name, model_name)
+        self._requests[key] = self._requests.get(key, 0) + 1
+        self._in_flight[key] += 1
+        return RequestMetrics(self, key, histograms)
+
+    def render(self, extra_counters=()):
+        """Текст в формате Prometheus exposition.
+
+        extra_counters: (имя, описание, тип, значение) для метрик без меток.
+        """
+        lines = []
+
+        def family(name, help_text, metric_type):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        family("llm_proxy_requests_total", "Chat completion requests", "counter")
+        for key, value in self._requests.items():
+            lines.append(f"llm_proxy_requests_total{{{_labels(key)}}} {value}")
+
+        family("llm_proxy_errors_total", "Failed chat completion requests by error class", "counter")
+        for (provider_name, model_name, error_class), value in self._errors.items():
+            labels = _labels((provider_name, model_name)) + f',class="{error_class}"'
+            lines.append(f"llm_proxy_errors_total{{{labels}}} {value}")
+
+        family("llm_proxy_retries_total", "Retries of transient upstream errors by reason", "counter")
+        for (provider_name, model_name, reason), value in self._retries.items():
+            labels = _labels((provider_name, model_name)) + f',reason="{reason}"'
+            lines.append(f"llm_proxy_retries_total{{{labels}}} {value}")
+
+        family("llm_proxy_in_flight_requests", "Requests currently being processed", "gauge")
+        for key, value in self._in_flight.items():
+            lines.append(f"llm_proxy_in_flight_requests{{{_labels(key)}}} {value}")
+
+        for index, (name, help_text, bounds) in enumerate(self.HISTOGRAMS):
+            family(name, help_text, "histogram")
+            for key, histograms in self._histograms.items():
+                histogram = histograms[index]
+                labels = _labels(key)
+                cumulative = 0
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+        for name, help_text, metric_type, value in extra_counters:
+            family(name, help_text, metric_type)
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(key):
+    provider_name, model_name = key
+    return f'provider="{_escape(provider_name)}",model="{_escape(model_name)}"'
@@ -0,0 +1,91 @@
+from types import MappingProxyType
+from typing import Any, FrozenSet, Mapping, NamedTuple, Optional
+
+
+class ModelSpec(NamedTuple):
+    """Неизменяемые параметры модели провайдера, посчитанные один раз при загрузке настроек"""
+
+    provider: str
+    name: Optional[str]
+    provider_type: str
+    context_window: Optional[int]
+    max_tokens: int
+    # Цены за один токен (в settings.json - за миллион)
+    input_cache_hit: float
+    input_cache_miss: float
+    output: float
+    supported_params: Optional[FrozenSet[str]]  # None - фильтр параметров провайдера по умолчанию
+    base_url: Optional[str]                     # Собственный base_url модели, если задан
+    hedge: Optional[Mapping[str, Any]]
+    stream_usage: bool
+    sse_passthrough: bool
+
+
+class ModelRegistry:
+    """Снимок моделей из settings.json для поиска без пересчета.
+
+    Строится один раз из секции providers: для каждой пары (провайдер, модель)
+    заранее посчитаны цены за токен, окно контекста, max_tokens, допустимые
+    параметры и тип провайдера. Поиск на запрос - чтение словаря. Снимок не
+    меняется; при перезагрузке настроек строится новый и подменяется одним
+    присваиванием, поэтому запрос никогда не видит смесь старых и новых данных.
+
+    Модель, которой нет в настройках провайдера, получает параметры его первой
+    модели (как Config.get_model_config).
+    """
+
+    def __init__(self, models, defaults, default_max_tokens=8000):
+        self._models = MappingProxyType(models)      # (провайдер, модель) -> ModelSpec
+        self._defaults = MappingProxyType(defaults)  # провайдер -> ModelSpec первой модели
+        self.default_max_tokens = default_max_tokens
+
+    @classmethod
+    def from_config(cls, provider_configs, default_max_tokens=8000):
+        models = {}
+        defaults = {}
+        for provider_name, provider_config in provider_configs.items():
+            provider_models = provider_config.get("models", []) or [{}]
+            for model_config in provider_models:
+                spec = _build_spec(provider_name, provider_config, model_config, default_max_tokens)
+                if spec.name is not None:
+                    models[(provider_name, spec.name)] = spec
+                defaults.setdefault(provider_name, spec)
+        return cls(models, defaults, default_max_tokens)
+
+    def model(self, provider_name, model_name=None):
+        """Параметры модели; для неизвестной модели - первой модели провайдера"""
+        spec = self._models.get((provider_name, model_name))
+        if spec is None:
+            spec = self._defaults.get(provider_name)
+            if spec is None:
+                spec = _build_spec(provider_name, {}, {}, self.default_max_tokens)
+        return spec
+
+    def max_tokens(self, provider_name, model_name=None):
+        return self.model(provider_name, model_name).max_tokens
+
+    def models(self):
+        return list(self._models.values())
+
+    def __len__(self):
+        return len(self._models)
+
+
+def _build_spec(provider_name, provider_config, model_config, default_max_tokens):
+    pricing = model_config.get("pricing", {})
+    supported_params = model_config.get("supported_params", provider_config.get("supported_params"))
+    return ModelSpec(
+        provider=provider_name,
+        name=model_config.get("name"),
+        provider_type=provider_config.get("type", "openai"),
+        context_window=model_config.get("context_window"),
+        max_tokens=model_config.get("max_tokens", default_max_tokens),
+        input_cache_hit=pricing.get("input_cache_hit", 0.0) / 1_000_000,
+        input_cache_miss=pricing.get("input_cache_miss", 0.0) / 1_000_000,
+        output=pricing.get("output", 0.0) / 1_000_000,
+        supported_params=frozenset(supported_params) if supported_params is not None else None,
+        base_url=model_config.get("base_url"),
+        hedge=MappingProxyType(dict(model_config["hedge"])) if model_config.get("hedge") else None,
+        stream_usage=provider_config.get("stream_usage", True),
+        sse_passthrough=provider_config.get("sse_passthrough", True),
+    )
@@ -0,0 +1,75 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRouter:
+    """Таблица маршрутизации: имя модели или алиас -> (провайдер, модель).
+
+    Строится один раз из списков models в settings.json, поэтому выбор
+    провайдера для запроса - это одно чтение из словаря. Имя провайдера тоже
+    работает как алиас и указывает на его первую модель.
+
+    Цепочка отказоустойчивости задается списком fallback у модели (или у
+    провайдера для всех его моделей); элементы - такие же имена моделей,
+    алиасы или имена провайдеров.
+    """
+
+    def __init__(self, routes: Dict[str, Tuple[str, str]], fallbacks: Optional[Dict[Tuple[str, Optional[str]], List[str]]] = None):
+        self.routes = routes
+        self.fallbacks = fallbacks or {}
+
+    @classmethod
+    def build(cls, provider_configs, available_providers, preferred_provider=None):
+        routes = {}
+        fallbacks = {}
+        # Провайдер по умолчанию первым, чтобы при совпадении имен моделей выигрывал он
+        order = sorted(available_providers, key=lambda name: name != preferred_provider)
+        for provider_name in order:
+            provider_config = provider_configs.get(provider_name, {})
+            models = provider_config.get("models", [])
+            provider_fallback = list(provider_config.get("fallback", []))
+            if provider_fallback:
+                fallbacks[(provider_name, None)] = provider_fallback
+            for model in models:
+                model_name = model.get("name")
+                if not model_name:
+                    continue
+                model_fallback = list(model.get("fallback", provider_fallback))
+                if model_fallback:
+                    fallbacks[(provider_name, model_name)] = model_fallback
+                for key in [model_name] + list(model.get("aliases", [])):
+                    if key in routes and routes[key][0] != provider_name:
+                        logger.warning(f"Model '{key}' is declared by several providers, using {routes[key][0]}")
+                        continue
+                    routes.setdefault(key, (provider_name, model_name))
+            if models and provider_name not in routes:
+                routes[provider_name] = (provider_name, models[0]["name"])
+        for route, names in fallbacks.items():
+            for name in names:
+                if name not in routes:
+                    logger.warning(f"Fallback '{name}' for {route[0]} is not a known model or provider, skipping")
+        return cls(routes, fallbacks)
+
+    def resolve(self, requested_model, default_provider):
+        """Провайдер и модель для запроса; неизвестные модели идут на провайдер по умолчанию"""
+        route = self.routes.get(requested_model) if requested_model else None
+        if route is not None:
+            return route
+        return default_provider, None
+
+    def chain(self, requested_model, default_provider):
+        """Маршрут запроса и его запасные маршруты по порядку, без повторов"""
+        primary = self.resolve(requested_model, default_provider)
+        chain = [primary]
+        names = self.fallbacks.get(primary) or self.fallbacks.get((primary[0], None), [])
+        for name in names:
+            route = self.routes.get(name)
+            if route is not None and route not in chain:
+                chain.append(route)
+        return chain
+
+    def list_models(self):
+        """Все маршрутизируемые имена моделей (без алиасов-провайдеров)"""
+        return [(name, provider, model) for name, (provider, model) in self.routes.items() if name != provider]
@@ -0,0 +1,123 @@
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicy:
+    """Локальный бэкенд первым, избыток - в облако.
+
+    Запрос, направленный на провайдер source (по умолчанию local), уходит на
+    маршрут target, если у source слишком много запросов в работе или его
+    недавние EWMA замеры ожидания в очереди или time-to-first-token выше
+    порогов. Замеры старше latency_window не учитываются: пока весь трафик
+    уходит в облако, новых замеров у source нет, и устаревшая задержка не
+    должна держать его выключенным. Пороги меняются на лету через update().
+    """
+
+    # Параметры, которые можно менять без перезапуска, и их типы
+    SETTINGS = {
+        "enabled": bool,
+        "from": str,
+        "to": str,
+        "max_in_flight": int,
+        "max_queue_wait": float,
+        "max_ttft": float,
+        "latency_window": float,
+    }
+    # Ключ настроек from хранится в атрибуте source (from - ключевое слово Python)
+    ATTRIBUTES = {"from": "source"}
+
+    def __init__(self, metrics, enabled=False, source="local", to=None, max_in_flight=None,
+                 max_queue_wait=2.0, max_ttft=5.0, latency_window=30.0, max_events=100):
+        self.metrics = metrics
+        self.enabled = enabled
+        self.source = source
+        self.to = to                          # Модель, алиас или провайдер для избытка
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait  # секунды
+        self.max_ttft = max_ttft              # секунды
+        self.latency_window = latency_window
+        self.spilled = 0
+        self.spilled_cost = 0.0
+        self.reasons = {}
+        self.events = deque(maxlen=max_events)
+
+    @classmethod
+    def from_config(cls, overflow_config, metrics):
+        return cls(
+            metrics,
+            enabled=overflow_config.get("enabled", False),
+            source=overflow_config.get("from", "local"),
+            to=overflow_config.get("to"),
+            max_in_flight=overflow_config.get("max_in_flight"),
+            max_queue_wait=overflow_config.get("max_queue_wait", 2.0),
+            max_ttft=overflow_config.get("max_ttft", 5.0),
+            latency_window=overflow_config.get("latency_window", 30.0),
+        )
+
+    def check(self, provider_name, model_name):
+        """Причина увести запрос с маршрута или None, если source справляется"""
+        if not self.enabled or not self.to or provider_name != self.source:
+            return None
+        if self.max_in_flight is not None:
+            in_flight = self.metrics.in_flight(provider_name)
+            if in_flight >= self.max_in_flight:
+                return "in_flight"
+        stats = self.metrics.route_stats(provider_name, model_name)
+        if stats is None or time.monotonic() - stats.updated > self.latency_window:
+            return None
+        if self.max_queue_wait is not None and stats.queue_wait is not None and stats.queue_wait > self.max_queue_wait:
+            return "queue_wait"
+        if self.max_ttft is not None and stats.ttft is not None and stats.ttft > self.max_ttft:
+            return "ttft"
+        return None
+
+    def record_spill(self, from_route, to_route, reason):
+        self.spilled += 1
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        self.events.append({
+            "timestamp": time.time(),
+            "from": "/".join(from_route),
+            "to": "/".join(to_route),
+            "reason": reason,
+        })
+        logger.info(f"Overflow: {'/'.join(from_route)} is saturated ({reason}), sending to {'/'.join(to_route)}")
+
+    def record_cost(self, cost):
+        self.spilled_cost += cost
+
+    def update(self, changes):
+        """Изменить пороги на лету; ValueError для неизвестных параметров и неверных значений"""
+        updated = {}
+        for name, value in changes.items():
+            kind = self.SETTINGS.get(name)
+            if kind is None:
+                raise ValueError(f"Unknown overflow setting '{name}'")
+            if value is not None and name != "enabled":
+                try:
+                    value = kind(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Invalid value for overflow setting '{name}': {value!r}")
+            elif name == "enabled" and not isinstance(value, bool):
+                raise ValueError(f"Invalid value for overflow setting 'enabled': {value!r}")
+            if name == "from" and not value:
+                raise ValueError("Overflow setting 'from' must name a provider")
+            updated[name] = value
+        for name, value in updated.items():
+            setattr(self, self.ATTRIBUTES.get(name, name), value)
+        logger.info(f"Overflow settings updated: {updated}")
+        return self.settings()
+
+    def settings(self):
+        return {name: getattr(self, self.ATTRIBUTES.get(name, name)) for name in self.SETTINGS}
+
+    def stats(self):
+        return {
+            **self.settings(),
+            "spilled": self.spilled,
+            "spilled_cost": self.spilled_cost,
+            "reasons": dict(self.reasons),
+            "events": list(self.events),
+        }
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitWaitTooLong(Exception):
+    """Ожидание квоты превысило max_wait"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Rate limit for {name} would delay the request by {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket с пополнением per_minute единиц в минуту.
+
+    Резерв списывается сразу, уровень может уйти в минус: следующий запрос
+    ждет, пока долг восполнится. Так запросы выстраиваются в очередь с
+    равномерными интервалами, а не получают отказ всплеском.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = float(self.capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """Сколько секунд придется ждать, если списать amount сейчас"""
+        self._refill()
+        # Запрос больше емкости ждет только до полного ведра, иначе он не прошел бы никогда
+        deficit = min(amount, self.capacity) - self.level
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def stats(self):
+        self._refill()
+        return {"level": round(self.level, 1), "capacity": self.capacity, "per_minute": round(self.rate * 60)}
+
+
+class Reservation:
+    """Резерв квоты запроса; reconcile() сверяет оценку токенов с фактом"""
+
+    def __init__(self, token_buckets, reserved_tokens):
+        self._token_buckets = token_buckets
+        self.reserved_tokens = reserved_tokens
+
+    def reconcile(self, actual_tokens):
+        buckets, self._token_buckets = self._token_buckets, []
+        difference = self.reserved_tokens - actual_tokens
+        for bucket in buckets:
+            if difference > 0:
+                bucket.give_back(difference)
+            elif difference < 0:
+                bucket.take(-difference)
+
+
+class RateLimits:
+    """Клиентские лимиты RPM/TPM по провайдерам и моделям.
+
+    Настраиваются секцией rate_limit ({"rpm": ..., "tpm": ...}) у провайдера
+    или у модели. Для TPM резервируется оценка промпта плюс max_tokens, после
+    ответа резерв сверяется с фактическим usage.
+    """
+
+    def __init__(self, max_wait=60.0):
+        self.max_wait = max_wait
+        self._buckets = {}  # (provider, model | None) -> {"rpm": TokenBucket, "tpm": TokenBucket}
+
+    @classmethod
+    def from_config(cls, rate_limit_config, provider_configs):
+        limits = cls(max_wait=rate_limit_config.get("max_wait", 60.0))
+        limits.update(provider_configs)
+        return limits
+
+    def update(self, provider_configs):
+        """Применить квоты из новых настроек провайдеров.
+
+        Ведро с прежними rpm/tpm и burst переиспользуется вместе с текущим
+        уровнем, иначе перезагрузка обнуляла бы накопленный долг.
+        """
+        buckets = {}
+        for provider_name, provider_config in provider_configs.items():
+            self._add(buckets, (provider_name, None), provider_config.get("rate_limit"))
+            for model in provider_config.get("models", []):
+                self._add(buckets, (provider_name, model.get("name")), model.get("rate_limit"))
+        self._buckets = buckets
+
+    def _add(self, buckets, key, config):
+        if not config:
+            return
+        scope = {}
+        previous = self._buckets.get(key, {})
+        for kind in ("rpm", "tpm"):
+            if config.get(kind):
+                bucket = TokenBucket(config[kind], config.get(f"{kind}_burst"))
+                if kind in previous and (previous[kind].rate, previous[kind].capacity) == (bucket.rate, bucket.capacity):
+                    bucket = previous[kind]
+                scope[kind] = bucket
+        if scope:
+            buckets[key] = scope
+
+    def _scopes(self, provider_name, model_name):
+        return [self._buckets[key] for key in ((provider_name, model_name), (provider_name, None)) if key in self._buckets]
+
+    def counts_tokens(self, provider_name, model_name):
+        """Нужна ли оценка токенов запроса (есть TPM лимит)"""
+        return any("tpm" in scope for scope in self._scopes(provider_name, model_name))
+
+    async def acquire(self, provider_name, model_name, tokens=0):
+        """Дождаться квоты и списать 1 запрос и tokens токенов"""
+        scopes = self._scopes(provider_name, model_name)
+        if not scopes:
+            return Reservation([], 0)
+        wait = 0.0
+        for scope in scopes:
+            if "rpm" in scope:
+                wait = max(wait, scope["rpm"].wait_time(1))
+            if "tpm" in scope:
+                wait = max(wait, scope["tpm"].wait_time(tokens))
+        if wait > self.max_wait:
+            raise RateLimitWaitTooLong(f"{provider_name}/{model_name}", wait)
+
+        # Списываем сразу: следующие запросы увидят долг и встанут за этим
+        token_buckets = []
+        for scope in scopes:
+            if "rpm" in scope:
+                scope["rpm"].take(1)
+            if "tpm" in scope:
+                scope["tpm"].take(tokens)
+                token_buckets.append(scope["tpm"])
+        reservation = Reservation(token_buckets, tokens)
+        if wait > 0:
+            logger.info(f"Rate limit for {provider_name}/{model_name}: waiting {wait:.2f}s")
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                # Клиент ушел, не дождавшись квоты: возвращаем резерв
+                for scope in scopes:
+                    if "rpm" in scope:
+                        scope["rpm"].give_back(1)
+                reservation.reconcile(0)
+                raise
+        return reservation
+
+    def stats(self):
+        return {
+            "/".join(filter(None, key)): {kind: bucket.stats() for kind, bucket in buckets.items()}
+            for key, buckets in self._buckets.items()
+        }
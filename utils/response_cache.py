@@ -0,0 +1,221 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Кэш ответов по точному совпадению запроса.
+
+    Память - LRU с ограничением по числу записей, объему и TTL. Необязательный
+    дисковый уровень хранит те же записи JSON-файлами и переживает перезапуск.
+    Запись - это итог ответа (текст, finish_reason, usage), поэтому ее можно
+    отдать как обычный JSON или проиграть как SSE стрим.
+    """
+
+    def __init__(self, enabled=False, max_entries=1000, max_bytes=50 * 1024 * 1024, ttl=3600,
+                 disk_path=None, only_deterministic=True):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.only_deterministic = only_deterministic
+        self._entries = OrderedDict()  # key -> (expires_at, size, entry)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        if self.disk_path:
+            os.makedirs(self.disk_path, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cache_config):
+        return cls(
+            enabled=cache_config.get("enabled", False),
+            max_entries=cache_config.get("max_entries", 1000),
+            max_bytes=cache_config.get("max_bytes", 50 * 1024 * 1024),
+            ttl=cache_config.get("ttl", 3600),
+            disk_path=cache_config.get("disk_path"),
+            only_deterministic=cache_config.get("only_deterministic", True),
+        )
+
+    def is_cacheable(self, kwargs):
+        """Кэшируем только детерминированные запросы (temperature 0), если не настроено иначе"""
+        if not self.enabled:
+            return False
+        if self.only_deterministic:
+            return kwargs.get("temperature") == 0
+        return True
+
+    @staticmethod
+    def make_key(provider_name, model_name, messages, kwargs):
+        """Канонический хэш запроса; stream не входит в ключ, чтобы stream и non-stream делили записи"""
+        params = {k: v for k, v in kwargs.items() if k not in ("stream", "stream_options") and v is not None}
+        payload = json.dumps(
+            {"provider": provider_name, "model": model_name, "messages": messages, "params": params},
+            sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        item = self._entries.get(key)
+        now = time.time()
+        if item is not None:
+            expires_at, size, entry = item
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._remove(key)
+
+        entry = self._disk_get(key, now)
+        if entry is not None:
+            self.hits += 1
+            self.disk_hits += 1
+            self._store(key, entry, entry.get("expires_at", now + self.ttl))
+            return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        expires_at = time.time() + self.ttl
+        entry = {**entry, "expires_at": expires_at}
+        self._store(key, entry, expires_at)
+        self._disk_put(key, entry)
+
+    def _store(self, key, entry, expires_at):
+        size = len(entry.get("content") or "") + 256
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, size, entry)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_file(self, key):
+        return os.path.join(self.disk_path, f"{key}.json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_path:
+            return None
+        path = self._disk_file(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading cache entry {path}: {e}")
+            return None
+        if entry.get("expires_at", 0) <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def _disk_put(self, key, entry):
+        if not self.disk_path:
+            return
+        path = self._disk_file(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error writing cache entry {path}: {e}")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+def completion_from_entry(entry, model):
+    """Ответ chat.completion из записи кэша"""
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": entry["content"]
+            },
+            "finish_reason": entry.get("finish_reason") or "stop"
+        }],
+        "usage": {
+            "prompt_tokens": entry["input_tokens"],
+            "completion_tokens": entry["output_tokens"],
+            "total_tokens": entry["input_tokens"] + entry["output_tokens"]
+        }
+    }
+
+
+def _split_for_replay(content, target=24):
+    """Нарезка текста на куски примерно как у настоящего стрима (по границам слов)"""
+    pieces = []
+    start = 0
+    while start < len(content):
+        end = min(start + target, len(content))
+        if end < len(content):
+            space = content.rfind(" ", start + 1, end)
+            if space > start:
+                end = space
+        pieces.append(content[start:end])
+        start = end
+    return pieces
+
+
+def replay_sse(entry, model, include_usage=False):
+    """Проиграть запись кэша как SSE стрим chat.completion.chunk"""
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+
+    def frame(delta, finish_reason=None, usage=None):
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        if usage is not None:
+            chunk["usage"] = usage
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+    yield frame({"role": "assistant", "content": ""})
+    for piece in _split_for_replay(entry["content"] or ""):
+        yield frame({"content": piece})
+    usage = None
+    if include_usage:
+        usage = {
+            "prompt_tokens": entry["input_tokens"],
+            "completion_tokens": entry["output_tokens"],
+            "total_tokens": entry["input_tokens"] + entry["output_tokens"]
+        }
+    yield frame({}, entry.get("finish_reason") or "stop", usage)
+    yield "data: [DONE]\n\n"
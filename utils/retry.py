@@ -0,0 +1,115 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def classify_retryable(error):
+    """Причина повтора для временной ошибки upstream или None, если повторять нельзя"""
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        if status == 429:
+            return "429"
+        if status in (500, 502, 503, 504) or status >= 520:
+            return "5xx"
+        return None
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException)) or "timeout" in type(error).__name__.lower():
+        return "timeout"
+    # APIConnectionError SDK, обрыв соединения и ошибки транспорта httpx
+    if isinstance(error, (ConnectionError, httpx.TransportError)) or type(error).__name__ == "APIConnectionError":
+        return "connect"
+    return None
+
+
+def parse_retry_after(error):
+    """Задержка из заголовков Retry-After / retry-after-ms ответа upstream, секунды"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    # Retry-After может быть HTTP датой
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """Повтор временных ошибок upstream: экспоненциальная задержка с полным jitter.
+
+    Повторяются 429, 5xx, обрывы соединения и таймауты. Retry-After из ответа
+    upstream имеет приоритет над расчетной задержкой. Бюджет на запрос - это
+    число повторов и общее время: если следующая попытка не укладывается в
+    max_elapsed, возвращается последняя ошибка. Встроенные повторы OpenAI SDK
+    отключены (max_retries=0), чтобы задержки не складывались.
+    """
+
+    def __init__(self, enabled=True, max_retries=3, base_delay=0.5, max_delay=8.0, max_elapsed=30.0):
+        self.enabled = enabled
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+
+    @classmethod
+    def from_config(cls, retry_config):
+        return cls(
+            enabled=retry_config.get("enabled", True),
+            max_retries=retry_config.get("max_retries", 3),
+            base_delay=retry_config.get("base_delay", 0.5),
+            max_delay=retry_config.get("max_delay", 8.0),
+            max_elapsed=retry_config.get("max_elapsed", 30.0),
+        )
+
+    def backoff(self, attempt):
+        """Задержка перед повтором номер attempt (с 0): случайная в [0, base * 2^attempt]"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def call(self, make_call, on_retry=None):
+        """Выполнить make_call() с повторами.
+
+        make_call возвращает новую корутину на каждую попытку. Для стримов сюда
+        передается только открытие соединения, поэтому повтор возможен лишь до
+        того, как клиент получил первый байт ответа.
+        on_retry(reason, delay) вызывается перед каждым повтором.
+        """
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return await make_call()
+            except Exception as e:
+                reason = classify_retryable(e) if self.enabled else None
+                if reason is None or attempt >= self.max_retries:
+                    raise
+                retry_after = parse_retry_after(e)
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                if time.monotonic() - started + delay > self.max_elapsed:
+                    logger.warning(f"Retry budget exhausted ({reason}), giving up after {attempt + 1} attempts")
+                    raise
+                attempt += 1
+                logger.warning(f"Transient upstream error ({reason}): {e}; retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                if on_retry is not None:
+                    on_retry(reason, delay)
+                await asyncio.sleep(delay)
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class SettingsSnapshot:
+    """Провайдеры, маршруты и реестр моделей, построенные из одной версии settings.json.
+
+    Запрос берет текущий снимок в начале и работает с ним до конца, поэтому
+    перезагрузка настроек не меняет провайдера или маршрут уже идущего запроса.
+    """
+
+    __slots__ = ("version", "settings", "model_registry", "providers", "model_router",
+                 "retry_policies", "adaptive_router")
+
+    def __init__(self, version, settings, model_registry, providers, model_router, retry_policies, adaptive_router):
+        self.version = version
+        self.settings = settings
+        self.model_registry = model_registry
+        self.providers = providers
+        self.model_router = model_router
+        self.retry_policies = retry_policies
+        self.adaptive_router = adaptive_router
+
+
+class SettingsReloader:
+    """Перезагрузка settings.json без перезапуска сервера.
+
+    load(path) читает и проверяет файл и выполняется в пуле потоков;
+    apply(prepared) строит новый снимок и подменяет текущий синхронно в
+    event loop, поэтому запросы видят либо старый снимок, либо новый. Если
+    load или apply бросили исключение, остается прежний снимок, а ошибка
+    попадает в stats(). Перезагрузки выполняются по одной.
+
+    При watch_interval > 0 фоновая задача раз в watch_interval секунд
+    сравнивает mtime и размер файла и перезагружает его после изменения
+    (например, после сохранения настроек в GUI). Файл, который не удалось
+    прочитать, повторно не загружается, пока он снова не изменится.
+    """
+
+    def __init__(self, path, load, apply, watch_interval=2.0, max_events=20):
+        self.path = path
+        self.load = load
+        self.apply = apply
+        self.watch_interval = watch_interval
+        self._signature = self._stat()
+        self._lock = asyncio.Lock()
+        self._watch_task = None
+        self._running = False  # start() вызван, aclose() еще нет
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_duration = None
+        self.last_reload_at = None
+        self.events = deque(maxlen=max_events)
+
+    @classmethod
+    def from_config(cls, reload_config, path, load, apply):
+        return cls(path, load, apply, watch_interval=cls._watch_interval(reload_config))
+
+    @staticmethod
+    def _watch_interval(reload_config):
+        return reload_config.get("watch_interval", 2.0) if reload_config.get("watch", True) else 0
+
+    def update(self, reload_config):
+        """Применить секцию reload из новых настроек: интервал проверки и включение/выключение слежения"""
+        self.watch_interval = self._watch_interval(reload_config)
+        if self._running:
+            self.start()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def reload(self, reason="manual"):
+        """Перечитать файл и подменить снимок; вернуть итог или бросить ошибку (снимок не меняется)"""
+        async with self._lock:
+            started = time.monotonic()
+            signature = self._stat()
+            try:
+                prepared = await asyncio.get_running_loop().run_in_executor(None, self.load, self.path)
+                result = self.apply(prepared)
+            except Exception as e:
+                self._signature = signature
+                self.failures += 1
+                self.last_error = str(e)[:500]
+                self._record(reason, started, error=self.last_error)
+                logger.error(f"Settings reload ({reason}) failed, keeping the current settings: {e}")
+                raise
+            self._signature = signature
+            self.reloads += 1
+            self.last_error = None
+            self.last_reload_at = time.time()
+            event = self._record(reason, started, result=result)
+            logger.info(f"Settings reloaded ({reason}) in {event['duration_ms']} ms: {result}")
+            return event
+
+    def _record(self, reason, started, result=None, error=None):
+        self.last_duration = time.monotonic() - started
+        event = {
+            "timestamp": time.time(),
+            "reason": reason,
+            "duration_ms": round(self.last_duration * 1000, 1),
+            "ok": error is None,
+        }
+        if error is not None:
+            event["error"] = error
+        if result is not None:
+            event.update(result)
+        self.events.append(event)
+        return event
+
+    def start(self):
+        self._running = True
+        if self._watch_task is None and self.watch_interval:
+            self._watch_task = asyncio.get_running_loop().create_task(self._watch_loop())
+
+    async def _watch_loop(self):
+        # watch_interval может измениться при перезагрузке; 0 завершает слежение
+        while self.watch_interval:
+            await asyncio.sleep(self.watch_interval)
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            try:
+                await self.reload("file changed")
+            except Exception:
+                pass  # Уже записано в stats(); прежний снимок продолжает работать
+        self._watch_task = None
+
+    async def aclose(self):
+        self._running = False
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "watching": self._watch_task is not None,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_duration_ms": round(self.last_duration * 1000, 1) if self.last_duration is not None else None,
+            "last_reload_at": self.last_reload_at,
+            "events": list(self.events),
+        }
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class Flight:
+    """Один общий вызов upstream и его подписчики.
+
+    Для обычного ответа подписчики ждут результат лидера. Для стрима
+    фоновая задача публикует кадры, а каждый подписчик читает свою очередь;
+    опоздавший подписчик сначала получает уже опубликованные кадры.
+    Очередь регистрируется в subscribe, а не при первом чтении: подписчик,
+    ушедший до начала ответа, тоже снимается через unsubscribe. Когда стрим
+    покидает последний подписчик, вызывается on_abandoned.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.followers = 0
+        self.result = None
+        self.error = None
+        self._done = asyncio.Event()
+        self._started = asyncio.Event()  # Первый кадр стрима или завершение
+        self._items = []
+        self._queues = []
+        self._finished = False
+        self.on_abandoned = None
+
+    # Обычный (не streaming) ответ
+
+    def set_result(self, result):
+        self.result = result
+        self._done.set()
+
+    def set_error(self, error):
+        # Стриминговые подписчики могли присоединиться до ответа лидера:
+        # их очереди тоже нужно завершить, иначе они ждут вечно
+        self.finish(error)
+
+    async def wait(self):
+        await self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    # Streaming ответ
+
+    async def wait_started(self):
+        """Дождаться первого кадра; ошибку до начала стрима бросить, пока ответ еще не начат"""
+        await self._started.wait()
+        if not self._items and self.error is not None:
+            raise self.error
+
+    def publish(self, item):
+        self._items.append(item)
+        self._started.set()
+        for queue in self._queues:
+            queue.put_nowait(item)
+
+    def finish(self, error=None):
+        self.error = error
+        self._finished = True
+        for queue in self._queues:
+            queue.put_nowait(_END)
+        self._started.set()
+        self._done.set()
+
+    def subscribe(self):
+        """Очередь нового подписчика с уже опубликованными кадрами; кадры читает read"""
+        queue = asyncio.Queue()
+        for item in self._items:
+            queue.put_nowait(item)
+        if self._finished:
+            queue.put_nowait(_END)
+        self._queues.append(queue)
+        return queue
+
+    async def read(self, queue):
+        while True:
+            item = await queue.get()
+            if item is _END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def unsubscribe(self, queue):
+        if queue not in self._queues:
+            return
+        self._queues.remove(queue)
+        if not self._queues and not self._finished and self.on_abandoned is not None:
+            self.on_abandoned()
+
+
+class SingleFlight:
+    """Объединение одновременных одинаковых запросов в один вызов upstream"""
+
+    def __init__(self, enabled=True, only_deterministic=True):
+        self.enabled = enabled
+        self.only_deterministic = only_deterministic
+        self._flights = {}
+        self._tasks = set()  # Фоновые задачи стримов: event loop хранит только слабые ссылки
+        self.leaders = 0
+        self.coalesced = 0
+
+    @classmethod
+    def from_config(cls, flight_config):
+        return cls(
+            enabled=flight_config.get("enabled", True),
+            only_deterministic=flight_config.get("only_deterministic", True),
+        )
+
+    def is_eligible(self, body):
+        """При семплировании (temperature > 0) одинаковые запросы могут быть намеренными"""
+        if not self.enabled:
+            return False
+        if self.only_deterministic:
+            return body.get("temperature") == 0
+        return True
+
+    @staticmethod
+    def make_key(body, provider_name):
+        payload = json.dumps({"provider": provider_name, "body": body}, sort_keys=True,
+                             ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def join(self, key):
+        """Присоединиться к уже идущему вызову, если он есть"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            self.coalesced += 1
+        return flight
+
+    def start(self, key):
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def forget(self, flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def spawn_stream(self, flight, body_iterator, close=None):
+        """Запустить run_stream в фоне, сохранив ссылку на задачу до ее завершения"""
+        task = asyncio.create_task(self.run_stream(flight, body_iterator, close))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def run_stream(self, flight, body_iterator, close=None):
+        """Фоновая задача: читает стрим лидера и раздает кадры подписчикам.
+
+        Если все клиенты отключились, задача отменяется. В конце вызывается
+        close (освобождение ресурсов ответа лидера, включая соединение с upstream).
+        """
+        error = None
+        task = asyncio.current_task()
+
+        def abandon():
+            # Новые одинаковые запросы не должны присоединяться к отменяемому стриму
+            self.forget(flight)
+            task.cancel()
+
+        flight.on_abandoned = abandon
+        try:
+            async for item in body_iterator:
+                flight.publish(item)
+        except Exception as e:
+            logger.error(f"Shared stream failed: {e}")
+            error = e
+        finally:
+            self.forget(flight)
+            flight.finish(error)
+            if close is not None:
+                await close()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._flights),
+            "streams": len(self._tasks),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
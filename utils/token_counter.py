@@ -1,30 +1,307 @@
-import tiktoken
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import regex
 from config import config as Config
+from utils.tokenizer_registry import TokenizerRegistry
+
+
+class StreamingTokenCounter:
+    """Инкрементальный подсчет токенов для одного стрима.
+
+    BPE никогда не склеивает токены через границу фрагментов предварительного
+    разбиения (regex-паттерн энкодинга tiktoken или pre-tokenizer
+    HuggingFace), поэтому завершенные фрагменты можно посчитать один раз и
+    забыть. Хвост из последних фрагментов держим открытым: следующая дельта
+    может его удлинить или переразбить. У энкодинга без такого разбиения
+    хвост фиксируется кусками по пробелу, когда он длиннее 2 * COMMIT_CHARS:
+    подсчет остается линейным, а погрешность - не больше токена на стыке.
+    """
+
+    # Сколько последних фрагментов не фиксируем (дельта может изменить разбиение последнего
+    # фрагмента и пробельного фрагмента перед ним)
+    HOLDBACK_PIECES = 2
+    # Сколько последних символов не фиксируем у энкодинга без разбиения на фрагменты
+    COMMIT_CHARS = 256
+
+    _patterns = {}
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.committed_tokens = 0
+        self.pending = ""
+        self._pending_tokens = 0
+        self._split = self._get_splitter(encoding)
+
+    @classmethod
+    def _get_splitter(cls, encoding):
+        """text -> [(конец фрагмента, фрагмент)] или None, если энкодинг не разбивает текст"""
+        pat_str = getattr(encoding, "_pat_str", None)
+        if pat_str is not None:
+            if pat_str not in cls._patterns:
+                cls._patterns[pat_str] = regex.compile(pat_str)
+            pattern = cls._patterns[pat_str]
+            return lambda text: [(match.end(), match.group()) for match in pattern.finditer(text)]
+        if getattr(encoding, "can_split", False):
+            return encoding.split_pieces
+        return None
+
+    def _encode_piece(self, piece):
+        encode_piece = getattr(self.encoding, "encode_piece", None) or getattr(self.encoding, "_encode_single_piece", None)
+        if encode_piece is not None:
+            return len(encode_piece(piece))
+        return len(self.encoding.encode_ordinary(piece))
+
+    def add(self, delta):
+        """Добавить дельту и вернуть текущее количество токенов во всем выводе"""
+        if not delta:
+            return self.total
+        self.pending += delta
+
+        if self._split is not None:
+            pieces = self._split(self.pending)
+            if len(pieces) > self.HOLDBACK_PIECES:
+                stable = pieces[:-self.HOLDBACK_PIECES]
+                for _, piece in stable:
+                    self.committed_tokens += self._encode_piece(piece)
+                self.pending = self.pending[stable[-1][0]:]
+        elif len(self.pending) > 2 * self.COMMIT_CHARS:
+            cut = self.pending.rfind(" ", 0, len(self.pending) - self.COMMIT_CHARS)
+            if cut <= 0:
+                cut = len(self.pending) - self.COMMIT_CHARS
+            self.committed_tokens += len(self.encoding.encode_ordinary(self.pending[:cut]))
+            self.pending = self.pending[cut:]
+
+        self._pending_tokens = len(self.encoding.encode_ordinary(self.pending))
+        return self.total
+
+    @property
+    def total(self):
+        return self.committed_tokens + self._pending_tokens
+
+
+def parse_usage(usage):
+    """Токены из usage upstream (dict или объект SDK): (prompt, completion, cached) или None.
+
+    cached - токены промпта из кэша провайдера: prompt_cache_hit_tokens у
+    DeepSeek, prompt_tokens_details.cached_tokens у OpenAI-совместимых API,
+    cached_tokens у Moonshot.
+    """
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        if hasattr(usage, "model_dump"):
+            usage = usage.model_dump()
+        else:
+            usage = getattr(usage, "__dict__", {})
+    prompt_tokens = usage.get("prompt_tokens")
+    completion_tokens = usage.get("completion_tokens")
+    if not isinstance(prompt_tokens, int) or not isinstance(completion_tokens, int):
+        return None
+    cached_tokens = usage.get("prompt_cache_hit_tokens")
+    if cached_tokens is None:
+        details = usage.get("prompt_tokens_details")
+        if isinstance(details, dict):
+            cached_tokens = details.get("cached_tokens")
+    if cached_tokens is None:
+        cached_tokens = usage.get("cached_tokens")
+    return prompt_tokens, completion_tokens, cached_tokens if isinstance(cached_tokens, int) else 0
+
 
 class TokenCounter:
-    def __init__(self):
-        self.encodings = {
-            "deepseek": tiktoken.get_encoding("cl100k_base"),  # DeepSeek использует cl100k_base как OpenAI
-            "moonshot": tiktoken.get_encoding("cl100k_base")   # Moonshot тоже
+    """Подсчет токенов и стоимости.
+
+    Длинные тексты (больше inline_chars символов) count_tokens_async кодирует
+    в пуле из max_workers потоков: tiktoken отпускает GIL, и event loop
+    продолжает обслуживать другие стримы, пока считается большой промпт.
+    Короткие тексты кодируются сразу, без накладных расходов пула.
+
+    Промпт считается по сообщениям (count_messages) с LRU кэшем токенов
+    каждого сообщения по хэшу его содержимого: агенты каждый ход присылают
+    весь разговор заново, и кодировать приходится только новые сообщения.
+
+    Токенизатор выбирается по модели через TokenizerRegistry; асинхронные
+    методы загружают его при первом обращении в пуле потоков.
+    """
+
+    # Разметка чата по правилам OpenAI: служебные токены на каждое сообщение,
+    # на поле name и на начало ответа ассистента
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_NAME = 1
+    REPLY_PRIMING_TOKENS = 3
+    # Поля сообщения, которые входят в промпт
+    MESSAGE_FIELDS = ("role", "content", "name", "tool_calls", "tool_call_id")
+    SETTINGS = ("inline_chars", "max_workers", "cache_entries")  # Применяются при перезагрузке настроек
+
+    def __init__(self, inline_chars=20000, max_workers=2, cache_entries=10000, registry=None):
+        self.registry = registry or TokenizerRegistry()
+        self.inline_chars = inline_chars
+        self.max_workers = max_workers
+        self.cache_entries = cache_entries
+        self._executor = None
+        self._message_cache = OrderedDict()  # (энкодинг, хэш сообщения) -> токены
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @classmethod
+    def from_config(cls, tokenizer_config, provider_configs=None):
+        return cls(
+            inline_chars=tokenizer_config.get("inline_chars", 20000),
+            max_workers=tokenizer_config.get("max_workers", 2),
+            cache_entries=tokenizer_config.get("cache_entries", 10000),
+            registry=TokenizerRegistry.from_config(tokenizer_config, provider_configs or {}),
+        )
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tokenizer")
+        return self._executor
+
+    async def _encoding_async(self, provider, model):
+        """Энкодинг модели; первая загрузка (чтение файлов словаря) идет в пуле потоков"""
+        encoding = self.registry.loaded(provider, model)
+        if encoding is None:
+            encoding = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), self.registry.encoding, provider, model)
+        return encoding
+
+    def preload(self):
+        """Загрузить все токенизаторы из настроек в фоне, не задерживая запуск"""
+        return asyncio.get_running_loop().run_in_executor(self._get_executor(), self.registry.preload)
+
+    def count_tokens(self, text, provider, model=None):
+        return len(self.registry.encoding(provider, model).encode(text))
+
+    async def count_tokens_async(self, text, provider, model=None):
+        """count_tokens, не блокирующий event loop на больших текстах"""
+        encoding = await self._encoding_async(provider, model)
+        if len(text) <= self.inline_chars:
+            return len(encoding.encode(text))
+        return await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), lambda: len(encoding.encode(text)))
+
+    @classmethod
+    def _message_parts(cls, message):
+        """Тексты полей сообщения, которые кодируются, и признак поля name"""
+        parts = []
+        for field in cls.MESSAGE_FIELDS:
+            value = message.get(field)
+            if value is None:
+                continue
+            if not isinstance(value, str):
+                value = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+            parts.append(value)
+        return parts, message.get("name") is not None
+
+    def _encode_message(self, encoding, message):
+        """Токены одного сообщения вместе с его разметкой"""
+        parts, has_name = self._message_parts(message)
+        tokens = self.TOKENS_PER_MESSAGE + sum(len(encoding.encode(part)) for part in parts)
+        return tokens + self.TOKENS_PER_NAME if has_name else tokens
+
+    def _lookup_messages(self, messages, encoding):
+        """Сумма токенов сообщений из кэша и список (ключ, сообщение) тех, которых в кэше нет"""
+        total = self.REPLY_PRIMING_TOKENS
+        missing = []
+        for message in messages:
+            parts, has_name = self._message_parts(message)
+            digest = hashlib.blake2b(digest_size=16)
+            for part in parts:
+                digest.update(part.encode("utf-8", errors="surrogatepass"))
+                digest.update(b"\x00")
+            key = (encoding.name, has_name, digest.digest())
+            tokens = self._message_cache.get(key)
+            if tokens is None:
+                self.cache_misses += 1
+                missing.append((key, message))
+            else:
+                self.cache_hits += 1
+                self._message_cache.move_to_end(key)
+                total += tokens
+        return total, missing
+
+    def _store_messages(self, missing, counts):
+        for (key, _), tokens in zip(missing, counts):
+            self._message_cache[key] = tokens
+            if len(self._message_cache) > self.cache_entries:
+                self._message_cache.popitem(last=False)
+        return sum(counts)
+
+    def count_messages(self, messages, provider, model=None):
+        """Токены промпта: сумма по сообщениям (из кэша, если сообщение уже встречалось)"""
+        encoding = self.registry.encoding(provider, model)
+        total, missing = self._lookup_messages(messages, encoding)
+        counts = [self._encode_message(encoding, message) for _, message in missing]
+        return total + self._store_messages(missing, counts)
+
+    async def count_messages_async(self, messages, provider, model=None):
+        """count_messages, кодирующий большие новые сообщения в пуле потоков.
+
+        Кэш читается и обновляется только в event loop, в пул уходит лишь кодирование.
+        """
+        encoding = await self._encoding_async(provider, model)
+        total, missing = self._lookup_messages(messages, encoding)
+        if not missing:
+            return total
+        encode = lambda: [self._encode_message(encoding, message) for _, message in missing]
+        size = sum(len(str(message.get("content") or "")) for _, message in missing)
+        if size <= self.inline_chars:
+            counts = encode()
+        else:
+            counts = await asyncio.get_running_loop().run_in_executor(self._get_executor(), encode)
+        return total + self._store_messages(missing, counts)
+
+    def stats(self):
+        return {
+            "cached_messages": len(self._message_cache),
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "tokenizers": self.registry.stats(),
         }
 
-    def count_tokens(self, text, provider):
-        encoding = self.encodings.get(provider, tiktoken.get_encoding("cl100k_base"))
-        return len(encoding.encode(text))
+    def update(self, inline_chars=None, max_workers=None, cache_entries=None):
+        """Применить новые настройки на лету; пул потоков другого размера создается при следующем вызове"""
+        if inline_chars is not None:
+            self.inline_chars = inline_chars
+        if cache_entries is not None:
+            self.cache_entries = cache_entries
+            while len(self._message_cache) > cache_entries:
+                self._message_cache.popitem(last=False)
+        if max_workers is not None and max_workers != self.max_workers:
+            self.max_workers = max_workers
+            self.close()  # Начатые задачи дорабатывают в прежнем пуле
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stream_counter(self, provider, model=None):
+        """Счетчик токенов для streaming ответа, кодирующий только новые дельты"""
+        return StreamingTokenCounter(self.registry.encoding(provider, model))
 
-    def estimate_cost(self, input_tokens, output_tokens, provider, cache_hit=True):
-        """Расчет стоимости на основе провайдера и типов токенов"""
-        if provider not in Config.PRICES:
-            return 0.0  # Для local провайдера стоимость не рассчитывается
+    def estimate_cost(self, input_tokens, output_tokens, provider, model=None, cache_hit=True, cached_tokens=None,
+                      model_registry=None):
+        """Расчет стоимости по ценам модели и типам токенов.
 
-        prices = Config.PRICES[provider]
+        cached_tokens - сколько токенов промпта провайдер взял из кэша (из его
+        usage); если неизвестно, все input токены считаются по cache_hit.
+        model_registry - снимок реестра моделей запроса (по умолчанию текущий).
+        """
+        prices = (model_registry or Config.get_model_registry()).model(provider, model)
 
         # Определяем тип input токенов
-        input_price = prices["input_cache_hit"] if cache_hit else prices["input_cache_miss"]
-        output_price = prices["output"]
+        if cached_tokens is not None:
+            cached_tokens = min(cached_tokens, input_tokens)
+            input_cost = cached_tokens * prices.input_cache_hit + (input_tokens - cached_tokens) * prices.input_cache_miss
+        else:
+            input_price = prices.input_cache_hit if cache_hit else prices.input_cache_miss
+            input_cost = input_tokens * input_price
 
         # Расчет стоимости (цены уже даны за токен)
-        input_cost = input_tokens * input_price
-        output_cost = output_tokens * output_price
+        output_cost = output_tokens * prices.output
 
-        return input_cost + output_cost
\ No newline at end of file
+        return input_cost + output_cost
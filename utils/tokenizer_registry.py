@@ -0,0 +1,213 @@
+import json
+import logging
+import math
+import os
+import threading
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+try:
+    from tokenizers import Tokenizer  # tokenizer.json HuggingFace требует пакет tokenizers
+    TOKENIZERS_AVAILABLE = True
+except ImportError:
+    TOKENIZERS_AVAILABLE = False
+
+DEFAULT_ENCODING = "cl100k_base"
+HF_PREFIX = "hf:"
+
+# TIKTOKEN_CACHE_DIR подставляется только на время загрузки энкодинга из assets_dir
+_tiktoken_env_lock = threading.Lock()
+
+
+class HuggingFaceEncoding:
+    """Токенизатор из tokenizer.json с интерфейсом tiktoken.Encoding (encode, encode_ordinary).
+
+    Если текст не нормализуется и предварительное разбиение не зависит от
+    начала текста (нет пробела-префикса, как у Metaspace), can_split=True:
+    split_pieces и encode_piece позволяют StreamingTokenCounter считать
+    стрим по фрагментам, как для энкодингов tiktoken.
+    """
+
+    def __init__(self, name, tokenizer):
+        self.name = name
+        self._tokenizer = tokenizer
+        self.can_split = _splits_independently(tokenizer)
+
+    def encode(self, text):
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+
+    encode_ordinary = encode
+
+    def split_pieces(self, text):
+        """Фрагменты предварительного разбиения: [(конец фрагмента в text, фрагмент)]"""
+        return [(end, piece) for piece, (_, end) in self._tokenizer.pre_tokenizer.pre_tokenize_str(text)]
+
+    def encode_piece(self, piece):
+        """Токены одного фрагмента из split_pieces (фрагменты между собой не склеиваются)"""
+        return [token.id for token in self._tokenizer.model.tokenize(piece)]
+
+
+def _splits_independently(tokenizer):
+    if tokenizer.normalizer is not None or tokenizer.pre_tokenizer is None:
+        return False
+    return not _adds_prefix_space(json.loads(tokenizer.to_str()).get("pre_tokenizer"))
+
+
+def _adds_prefix_space(config):
+    if isinstance(config, dict):
+        if config.get("add_prefix_space") or config.get("type") == "Metaspace":
+            return True
+        return any(_adds_prefix_space(value) for value in config.values())
+    if isinstance(config, list):
+        return any(_adds_prefix_space(value) for value in config)
+    return False
+
+
+class ApproximateEncoding:
+    """Оценка по длине текста, когда ни один токенизатор загрузить не удалось.
+
+    encode возвращает range нужной длины: TokenCounter использует только
+    количество токенов, а сами id без настоящего словаря не нужны.
+    """
+
+    name = "approximate"
+
+    def __init__(self, chars_per_token=3.5):
+        self.chars_per_token = chars_per_token
+
+    def encode(self, text):
+        return range(math.ceil(len(text) / self.chars_per_token))
+
+    encode_ordinary = encode
+
+
+class TokenizerRegistry:
+    """Токенизаторы моделей по имени модели из settings.json.
+
+    У модели (или у провайдера для всех его моделей) в settings.json можно
+    указать tokenizer: имя энкодинга tiktoken ("cl100k_base") или
+    "hf:<путь>" - tokenizer.json HuggingFace (файл или каталог с ним,
+    относительный путь считается от assets_dir). Модели без tokenizer
+    считаются энкодингом default.
+
+    Токенизатор загружается при первом запросе к модели и кэшируется;
+    одинаковые спецификации разных моделей делят один экземпляр. Сеть не
+    нужна: tokenizer.json читается с диска, а tiktoken берет файлы энкодингов
+    из assets_dir/tiktoken, если там есть предзаполненный кэш (на время
+    загрузки он подставляется как TIKTOKEN_CACHE_DIR). Если токенизатор
+    загрузить не удалось, модель считается энкодингом default, а без него -
+    ApproximateEncoding.
+    """
+
+    def __init__(self, model_specs=None, provider_specs=None, default=DEFAULT_ENCODING, assets_dir="tokenizers"):
+        self.model_specs = model_specs or {}        # имя модели -> спецификация
+        self.provider_specs = provider_specs or {}  # провайдер -> спецификация для его моделей
+        self.default = default
+        # Относительный путь считается от каталога проекта (рядом с settings.json)
+        self.assets_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), assets_dir)
+        self._encodings = {}                        # спецификация -> загруженный энкодинг
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_config(cls, tokenizer_config, provider_configs):
+        model_specs = {}
+        provider_specs = {}
+        for provider_name, provider_config in provider_configs.items():
+            if provider_config.get("tokenizer"):
+                provider_specs[provider_name] = provider_config["tokenizer"]
+            for model in provider_config.get("models", []):
+                if model.get("tokenizer") and model.get("name"):
+                    model_specs[model["name"]] = model["tokenizer"]
+        return cls(
+            model_specs,
+            provider_specs,
+            default=tokenizer_config.get("default", DEFAULT_ENCODING),
+            assets_dir=tokenizer_config.get("assets_dir", "tokenizers"),
+        )
+
+    def spec(self, provider, model=None):
+        """Спецификация токенизатора модели: модель, затем провайдер, затем default"""
+        return self.model_specs.get(model) or self.provider_specs.get(provider) or self.default
+
+    def loaded(self, provider, model=None):
+        """Уже загруженный энкодинг модели или None (без загрузки)"""
+        return self._encodings.get(self.spec(provider, model))
+
+    def encoding(self, provider, model=None):
+        """Энкодинг модели; при первом обращении загружается (может занять заметное время)"""
+        return self._get(self.spec(provider, model))
+
+    def _get(self, spec):
+        encoding = self._encodings.get(spec)
+        if encoding is None:
+            with self._lock:
+                encoding = self._encodings.get(spec)
+                if encoding is None:
+                    encoding = self._load(spec)
+                    self._encodings[spec] = encoding
+        return encoding
+
+    def inherit(self, previous):
+        """Взять у реестра прежних настроек уже загруженные токенизаторы с теми же спецификациями"""
+        if previous.assets_dir != self.assets_dir:
+            return
+        for spec, encoding in previous._encodings.items():
+            # Замена default для незагрузившегося токенизатора не переносится: файл мог появиться
+            if encoding.name == spec:
+                self._encodings.setdefault(spec, encoding)
+
+    def specs(self):
+        """Все спецификации из настроек - для предварительной загрузки"""
+        return list(dict.fromkeys([self.default, *self.provider_specs.values(), *self.model_specs.values()]))
+
+    def preload(self):
+        for spec in self.specs():
+            self._get(spec)
+
+    def _load(self, spec):
+        try:
+            if spec.startswith(HF_PREFIX):
+                encoding = self._load_huggingface(spec)
+            else:
+                encoding = self._load_tiktoken(spec)
+            logger.info(f"Tokenizer '{spec}' loaded")
+            return encoding
+        except Exception as e:
+            if spec != self.default:
+                logger.warning(f"Tokenizer '{spec}' is not available ({e}), counting with '{self.default}'")
+                return self._get(self.default)
+            logger.warning(f"Default tokenizer '{spec}' is not available ({e}), using an approximate count")
+            return ApproximateEncoding()
+
+    def _load_tiktoken(self, spec):
+        tiktoken_dir = os.path.join(self.assets_dir, "tiktoken")
+        # Переменная окружения видна всему процессу, поэтому ставится только на время загрузки
+        with _tiktoken_env_lock:
+            if "TIKTOKEN_CACHE_DIR" in os.environ or not os.path.isdir(tiktoken_dir):
+                return tiktoken.get_encoding(spec)
+            os.environ["TIKTOKEN_CACHE_DIR"] = tiktoken_dir
+            try:
+                return tiktoken.get_encoding(spec)
+            finally:
+                del os.environ["TIKTOKEN_CACHE_DIR"]
+
+    def _load_huggingface(self, spec):
+        path = spec[len(HF_PREFIX):]
+        if not os.path.isabs(path):
+            path = os.path.join(self.assets_dir, path)
+        if os.path.isdir(path):
+            path = os.path.join(path, "tokenizer.json")
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"{path} not found")
+        if not TOKENIZERS_AVAILABLE:
+            raise RuntimeError("the 'tokenizers' package is not installed")
+        return HuggingFaceEncoding(spec, Tokenizer.from_file(path))
+
+    def stats(self):
+        return {
+            "default": self.default,
+            "models": dict(self.model_specs),
+            "loaded": {spec: encoding.name for spec, encoding in self._encodings.items()},
+        }